@@ -0,0 +1,161 @@
+"""
+Cache of RAG answers for repeated and near-duplicate questions.
+
+A question first hits an exact entry keyed by its normalized text (case,
+whitespace and trailing punctuation are ignored). Otherwise, if an embedding
+function is given, the cached question with the most similar embedding is used
+when its cosine similarity reaches the configured threshold.
+
+The whole cache is dropped when the knowledge base generation changes, and is
+bounded by a maximum number of entries (LRU) and a time-to-live. An answer is
+only stored if neither the generation nor clear() changed while it was being
+computed: callers take version() before the lookup and pass it to put().
+
+Configuration (environment variables):
+    RAG_ANSWER_CACHE_SIZE       maximum number of cached answers (default 1000)
+    RAG_ANSWER_CACHE_TTL        seconds an answer stays valid (default 3600)
+    RAG_ANSWER_CACHE_THRESHOLD  cosine similarity for near-duplicates (default 0.95)
+"""
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_MAX_ENTRIES = int(os.environ.get("RAG_ANSWER_CACHE_SIZE", "1000"))
+DEFAULT_TTL_SECONDS = float(os.environ.get("RAG_ANSWER_CACHE_TTL", "3600"))
+DEFAULT_SIMILARITY_THRESHOLD = float(os.environ.get("RAG_ANSWER_CACHE_THRESHOLD", "0.95"))
+
+def normalize_question(question: str) -> str:
+    """
+    Returns the exact-match key of a question: "Quelle est la capitale de la France ?"
+    and "quelle est la  capitale de la france?" share the same key.
+    """
+    text = unicodedata.normalize("NFKC", question).casefold()
+    text = re.sub(r"\s+", " ", text)
+    text = re.sub(r"\s+([?!.,;:])", r"\1", text)
+    return text.strip().rstrip("?!. ")
+
+def _unit_vector(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+class AnswerCache:
+    """
+    Thread-safe LRU cache of RAG results with exact and semantic (embedding) lookups.
+    embed_fn maps a question to a vector; generation_fn returns the current knowledge base generation.
+    """
+
+    def __init__(self, embed_fn=None, generation_fn=None, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 ttl_seconds: float = DEFAULT_TTL_SECONDS,
+                 similarity_threshold: float = DEFAULT_SIMILARITY_THRESHOLD):
+        self._embed_fn = embed_fn
+        self._generation_fn = generation_fn
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._lock = threading.Lock()
+        # key -> (result, unit embedding or None, creation time)
+        self._entries = OrderedDict()
+        self._generation = None
+        # Bumped by clear(), e.g. when the model weights change
+        self._epoch = 0
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def _check_generation(self):
+        # Called with the lock held
+        if self._generation_fn is None:
+            return
+        generation = self._generation_fn()
+        if generation != self._generation:
+            self._entries.clear()
+            self._generation = generation
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl_seconds is not None and now - created_at > self.ttl_seconds
+
+    def _drop_expired(self, now: float):
+        for key in [key for key, (_, _, created_at) in self._entries.items() if self._expired(created_at, now)]:
+            del self._entries[key]
+
+    def version(self):
+        """
+        Returns the state the cached answers are valid for: take it before computing an answer
+        and pass it to put(), which drops the answer if the knowledge base or the cache changed since.
+        """
+        with self._lock:
+            self._check_generation()
+            return self._generation, self._epoch
+
+    def get(self, question: str):
+        """
+        Returns the cached result for the question (with its source documents), or None.
+        """
+        key = normalize_question(question)
+        now = time.time()
+        with self._lock:
+            self._check_generation()
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry[2], now):
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return {**entry[0], "query": question}
+            has_candidates = any(embedding is not None for _, embedding, _ in self._entries.values())
+
+        if self._embed_fn is None or not has_candidates:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        query_vector = _unit_vector(self._embed_fn(question))
+        with self._lock:
+            self._drop_expired(now)
+            candidates = [(key, entry) for key, entry in self._entries.items() if entry[1] is not None]
+            if candidates:
+                similarities = np.stack([entry[1] for _, entry in candidates]) @ query_vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    best_key, best_entry = candidates[best]
+                    self._entries.move_to_end(best_key)
+                    self.semantic_hits += 1
+                    return {**best_entry[0], "query": question}
+            self.misses += 1
+        return None
+
+    def put(self, question: str, result: dict, version=None):
+        """
+        Stores the result of a question, evicting the least recently used answers when full.
+        With the version() taken before the answer was computed, a stale answer is not stored.
+        """
+        embedding = _unit_vector(self._embed_fn(question)) if self._embed_fn is not None else None
+        with self._lock:
+            self._check_generation()
+            if version is not None and version != (self._generation, self._epoch):
+                return
+            key = normalize_question(question)
+            self._entries[key] = (result, embedding, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._epoch += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.exact_hits + self.semantic_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+            }
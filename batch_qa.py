@@ -0,0 +1,172 @@
+"""
+Offline batch question answering: nightly evaluations, FAQ pre-generation.
+
+Questions are streamed from a file and answered in batches: the questions of a
+batch are embedded in one call and retrieved with one vector query
+(TokenBudgetRetriever.batch_retrieve), then their prompts are sorted by length
+and generated in left-padded batches (generation.generate_batch). The wall time
+grows with the number of batches rather than the number of questions.
+
+Supported inputs:
+    *.jsonl  one JSON object per line: {"id": "...", "question": "..."} ("id" is optional)
+    other    plain text, one question per non-empty line
+
+Answers are appended to the output JSONL file as each batch completes:
+    {"id": "...", "question": "...", "answer": "...", "sources": ["doc-id", ...]}
+Running the same command again skips the questions already in the output, so an
+interrupted run resumes where it stopped.
+
+Usage:
+    python batch_qa.py questions.jsonl --output answers.jsonl --batch-size 32 --generate-batch-size 8
+    python batch_qa.py faq.txt --output faq_answers.jsonl --tenant radio
+"""
+import argparse
+import json
+import os
+import time
+from itertools import islice
+
+from batching import DEFAULT_MAX_BATCH_SIZE
+from knowledge_base import COLLECTION_NAME, EMBEDDING_MODEL_NAME
+
+DEFAULT_BATCH_SIZE = 32
+
+def _iter_jsonl(path: str):
+    base_name = os.path.basename(path)
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            question = (record.get("question") or "").strip()
+            if not question:
+                print(f"Skipping {base_name}:{line_number}: no 'question' field.")
+                continue
+            yield str(record.get("id") or f"{base_name}:{line_number}"), question
+
+def _iter_text(path: str):
+    base_name = os.path.basename(path)
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            question = line.strip()
+            if question:
+                yield f"{base_name}:{line_number}", question
+
+def iter_questions(path: str):
+    """
+    Streams (question_id, question) pairs from a question file without loading it in memory.
+    """
+    return _iter_jsonl(path) if path.endswith(".jsonl") else _iter_text(path)
+
+def load_answered_ids(output_path: str) -> set:
+    """
+    Returns the IDs already answered in the output file. A last line cut by an
+    interruption is removed so that the file can be appended to.
+    """
+    if not os.path.exists(output_path):
+        return set()
+    answered = set()
+    valid_bytes = 0
+    with open(output_path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                answered.add(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                break
+            valid_bytes += len(line)
+    if valid_bytes != os.path.getsize(output_path):
+        print(f"Truncating an incomplete record at the end of {output_path}.")
+        with open(output_path, "r+b") as f:
+            f.truncate(valid_bytes)
+    return answered
+
+def _batched(iterable, batch_size: int):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def answer_batch(chain, retriever, questions: list, generate_batch_size: int = DEFAULT_MAX_BATCH_SIZE) -> list:
+    """
+    Answers a list of questions with one retrieval call and padded generation batches.
+    Returns (answer, source_documents) pairs in the order of the questions.
+    """
+    from generation import generate_batch
+    from rag_module import build_rag_prompt
+    source_documents = retriever.batch_retrieve(questions)
+    prompts = [build_rag_prompt(chain, question, documents) for question, documents in zip(questions, source_documents)]
+    llm = chain.combine_documents_chain.llm_chain.llm
+    # Prompts of similar length share a generation batch: less padding to prefill
+    order = sorted(range(len(prompts)), key=lambda index: len(prompts[index]))
+    answers = [None] * len(prompts)
+    for start in range(0, len(order), generate_batch_size):
+        indexes = order[start:start + generate_batch_size]
+        for index, answer in zip(indexes, generate_batch(llm, [prompts[index] for index in indexes])):
+            answers[index] = answer.strip()
+    return list(zip(answers, source_documents))
+
+def run(input_path: str, output_path: str, batch_size: int = DEFAULT_BATCH_SIZE,
+        generate_batch_size: int = DEFAULT_MAX_BATCH_SIZE, tenant: str = None, filters: dict = None,
+        limit: int = None) -> dict:
+    """
+    Answers the questions of input_path not yet in output_path and appends them to it.
+    """
+    from rag_module import load_llm, setup_rag_chain, get_retriever
+    answered = load_answered_ids(output_path)
+    if answered:
+        print(f"Resuming: {len(answered)} question(s) already answered in {output_path}.")
+    pending = ((question_id, question) for question_id, question in iter_questions(input_path)
+               if question_id not in answered)
+    if limit is not None:
+        pending = islice(pending, limit)
+
+    llm = load_llm()
+    chain = setup_rag_chain(llm, COLLECTION_NAME, EMBEDDING_MODEL_NAME)
+    retriever = get_retriever(chain, tenant, filters)
+
+    total = 0
+    start_time = time.perf_counter()
+    with open(output_path, "a", encoding="utf-8") as output:
+        for batch in _batched(pending, batch_size):
+            batch_start = time.perf_counter()
+            results = answer_batch(chain, retriever, [question for _, question in batch], generate_batch_size)
+            for (question_id, question), (answer, documents) in zip(batch, results):
+                record = {"id": question_id, "question": question, "answer": answer,
+                          "sources": [document.metadata.get("id") for document in documents]}
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            # Answers reach the disk once per batch; a record torn by a crash is trimmed on resume
+            output.flush()
+            os.fsync(output.fileno())
+            total += len(batch)
+            elapsed = time.perf_counter() - start_time
+            print(f"  {total} questions answered ({len(batch)} in {time.perf_counter() - batch_start:.1f}s, "
+                  f"{total / elapsed:.2f} questions/sec overall)")
+
+    elapsed = time.perf_counter() - start_time
+    rate = total / elapsed if elapsed > 0 else 0.0
+    print(f"Answered {total} questions in {elapsed:.1f}s ({rate:.2f} questions/sec), written to {output_path}.")
+    return {"questions": total, "seconds": elapsed, "questions_per_sec": rate}
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a file of questions with the RAG chain, in batches.")
+    parser.add_argument("input", help="Question file (.jsonl or plain text, one question per line).")
+    parser.add_argument("--output", required=True, help="JSONL file the answers are appended to.")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="Questions embedded and retrieved together (and written per flush).")
+    parser.add_argument("--generate-batch-size", type=int, default=DEFAULT_MAX_BATCH_SIZE,
+                        help="Prompts per padded model.generate() call.")
+    parser.add_argument("--tenant", help="Search the tenant's collection.")
+    parser.add_argument("--filters", type=json.loads,
+                        help='Metadata filters as JSON, e.g. \'{"source": "faq"}\'.')
+    parser.add_argument("--limit", type=int, help="Answer at most this many new questions.")
+    args = parser.parse_args()
+    run(args.input, args.output, batch_size=args.batch_size, generate_batch_size=args.generate_batch_size,
+        tenant=args.tenant, filters=args.filters, limit=args.limit)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Dynamic request batching in front of the LLM.
+
+Concurrent callers submit prompts; a single worker thread collects them for a
+short window (or until the batch is full), runs one padded model.generate()
+call for the whole batch and routes each answer back to its caller. This keeps
+the CPU busy with one large matrix multiplication instead of many small ones.
+
+Configuration (environment variables):
+    RAG_MAX_BATCH_SIZE   maximum number of prompts per generate() call (default 8)
+    RAG_BATCH_WINDOW_MS  how long the first prompt of a batch waits for others (default 20)
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from queue import Queue, Empty
+from typing import Any, List, Optional
+
+from langchain_core.language_models.llms import LLM
+
+from generation import generate_batch
+
+DEFAULT_MAX_BATCH_SIZE = int(os.environ.get("RAG_MAX_BATCH_SIZE", "8"))
+DEFAULT_BATCH_WINDOW_MS = float(os.environ.get("RAG_BATCH_WINDOW_MS", "20"))
+# Number of recent queueing delays kept to compute percentiles
+DELAY_SAMPLES = 1000
+
+def _percentile(sorted_values, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+class MicroBatcher:
+    """
+    Collects items submitted from many threads and processes them in batches on one worker thread.
+    process_batch receives a list of items and must return one result per item, in order.
+    """
+
+    def __init__(self, process_batch, max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                 window_ms: float = DEFAULT_BATCH_WINDOW_MS, name: str = "micro-batcher"):
+        self._process_batch = process_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.window_seconds = window_ms / 1000.0
+        self.name = name
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._batches = 0
+        self._items = 0
+        self._batch_size_counts = {}
+        self._delays = deque(maxlen=DELAY_SAMPLES)
+        self._max_delay = 0.0
+
+    def _ensure_worker(self):
+        with self._lock:
+            # Threads don't survive fork(): a worker process starts its own worker thread
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._queue = Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def submit(self, item) -> Future:
+        """Queues an item and returns a Future resolved with its result."""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def _collect_batch(self):
+        first = self._queue.get()
+        batch = [first]
+        deadline = first[2] + self.window_seconds
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    # Window over: only take what is already queued
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            started = time.perf_counter()
+            self._record(len(batch), [started - enqueued for _, _, enqueued in batch])
+            try:
+                results = self._process_batch([item for item, _, _ in batch])
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+
+    def _record(self, batch_size: int, delays: list):
+        with self._lock:
+            self._batches += 1
+            self._items += batch_size
+            self._batch_size_counts[batch_size] = self._batch_size_counts.get(batch_size, 0) + 1
+            self._delays.extend(delays)
+            self._max_delay = max(self._max_delay, max(delays))
+
+    def get_metrics(self) -> dict:
+        """
+        Returns batch occupancy (average batch size relative to the maximum) and queueing delay statistics.
+        """
+        with self._lock:
+            delays = sorted(self._delays)
+            mean_batch_size = self._items / self._batches if self._batches else 0.0
+            return {
+                "max_batch_size": self.max_batch_size,
+                "window_ms": self.window_seconds * 1000.0,
+                "batches": self._batches,
+                "requests": self._items,
+                "mean_batch_size": mean_batch_size,
+                "occupancy": mean_batch_size / self.max_batch_size,
+                "batch_size_histogram": dict(sorted(self._batch_size_counts.items())),
+                "queue_delay_ms": {
+                    "mean": 1000.0 * sum(delays) / len(delays) if delays else 0.0,
+                    "p50": 1000.0 * _percentile(delays, 0.50),
+                    "p95": 1000.0 * _percentile(delays, 0.95),
+                    "max": 1000.0 * self._max_delay,
+                },
+                "queued": self._queue.qsize() if self._queue is not None else 0,
+            }
+
+class BatchedLLM(LLM):
+    """
+    LangChain LLM that sends each prompt through a MicroBatcher running generate_batch().
+    Keeps a reference to the underlying pipeline so streaming helpers still find the model.
+    """
+    pipeline: Any
+    batcher: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return "batched_huggingface_pipeline"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> str:
+        return self.batcher.submit(prompt).result()
+
+def create_batched_llm(llm, max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                       window_ms: float = DEFAULT_BATCH_WINDOW_MS) -> BatchedLLM:
+    """
+    Puts a batching scheduler in front of the HuggingFacePipeline returned by load_llm().
+    """
+    batcher = MicroBatcher(lambda prompts: generate_batch(llm, prompts), max_batch_size=max_batch_size,
+                           window_ms=window_ms, name="llm-batcher")
+    return BatchedLLM(pipeline=llm.pipeline, batcher=batcher)
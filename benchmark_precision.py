@@ -0,0 +1,130 @@
+"""
+Compares the inference precision modes of model_loader.py on CPU.
+
+Each mode runs in its own subprocess (so peak RSS is measured per mode) and
+generates greedy answers for the same RAG-style prompts. The report gives
+load time, tokens/sec, peak RSS and how often each mode's answers agree with
+the baseline mode (the first one given).
+
+Usage:
+    python benchmark_precision.py --precisions fp32 bf16 int8 --max-new-tokens 64 --output precision_benchmark.json
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from model_loader import PRECISIONS
+
+MODEL_NAME = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
+
+PROMPT_TEMPLATE = "Contexte: {context}\n\nQuestion: {question}\n\nRéponse utile:"
+PROMPTS = [
+    PROMPT_TEMPLATE.format(context="Le ciel est bleu.", question="Quelle est la couleur du ciel ?"),
+    PROMPT_TEMPLATE.format(context="Paris est la capitale de la France.", question="Quelle est la capitale de la France ?"),
+    PROMPT_TEMPLATE.format(context="Les pommes sont généralement rouges ou vertes.", question="Parle-moi des pommes."),
+    PROMPT_TEMPLATE.format(context="L'herbe est verte.", question="Quelle est la couleur de l'océan ?"),
+]
+
+def run_worker(precision: str, max_new_tokens: int, model_name: str) -> dict:
+    """
+    Loads the model in one precision mode and times greedy generation on PROMPTS.
+    """
+    import torch
+    from model_loader import load_model, load_tokenizer
+
+    start_time = time.perf_counter()
+    tokenizer = load_tokenizer(model_name)
+    model = load_model(model_name, precision=precision)
+    load_seconds = time.perf_counter() - start_time
+
+    outputs = []
+    generated_tokens = 0
+    generation_seconds = 0.0
+    for prompt in PROMPTS:
+        inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+        start_time = time.perf_counter()
+        with torch.no_grad():
+            output_ids = model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False,
+                                        pad_token_id=tokenizer.pad_token_id)
+        generation_seconds += time.perf_counter() - start_time
+        new_ids = output_ids[0, inputs["input_ids"].shape[1]:].tolist()
+        generated_tokens += len(new_ids)
+        outputs.append(new_ids)
+
+    return {
+        "precision": precision,
+        "load_seconds": load_seconds,
+        "generated_tokens": generated_tokens,
+        "generation_seconds": generation_seconds,
+        "tokens_per_sec": generated_tokens / generation_seconds if generation_seconds else 0.0,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        "answers": [tokenizer.decode(ids, skip_special_tokens=True) for ids in outputs],
+        "token_ids": outputs,
+    }
+
+def token_agreement(reference: list, candidate: list) -> float:
+    """
+    Fraction of the reference tokens generated identically before the first divergence.
+    """
+    if not reference:
+        return 1.0 if not candidate else 0.0
+    same = 0
+    for expected, actual in zip(reference, candidate):
+        if expected != actual:
+            break
+        same += 1
+    return same / len(reference)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the inference precision modes.")
+    parser.add_argument("--precisions", nargs="+", default=["fp32", "bf16", "int8"], choices=PRECISIONS,
+                        help="Modes to compare; the first one is the agreement baseline.")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--output", default="precision_benchmark.json")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--worker-output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        with open(args.worker_output, "w", encoding="utf-8") as f:
+            json.dump(run_worker(args.worker, args.max_new_tokens, args.model), f)
+        return
+
+    results = []
+    for precision in args.precisions:
+        print(f"Benchmarking {precision}...")
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as tmp:
+            worker_output = tmp.name
+        try:
+            subprocess.run([sys.executable, __file__, "--worker", precision, "--worker-output", worker_output,
+                            "--max-new-tokens", str(args.max_new_tokens), "--model", args.model], check=True)
+            with open(worker_output, "r", encoding="utf-8") as f:
+                results.append(json.load(f))
+        finally:
+            os.remove(worker_output)
+
+    baseline = results[0]
+    for result in results:
+        agreements = [token_agreement(ref, ids) for ref, ids in zip(baseline["token_ids"], result["token_ids"])]
+        result["exact_answer_match"] = sum(ref == ids for ref, ids in zip(baseline["token_ids"], result["token_ids"])) / len(agreements)
+        result["mean_token_agreement"] = sum(agreements) / len(agreements)
+        del result["token_ids"]
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"model": args.model, "baseline": baseline["precision"], "results": results}, f, indent=2, ensure_ascii=False)
+
+    print(f"\n{'mode':<6} {'load (s)':>9} {'tok/s':>8} {'RSS (MB)':>9} {'exact':>6} {'agree':>6}")
+    for result in results:
+        print(f"{result['precision']:<6} {result['load_seconds']:>9.1f} {result['tokens_per_sec']:>8.2f} "
+              f"{result['peak_rss_mb']:>9.0f} {result['exact_answer_match']:>6.2f} {result['mean_token_agreement']:>6.2f}")
+    print(f"\nResults written to {args.output}")
+
+if __name__ == "__main__":
+    main()
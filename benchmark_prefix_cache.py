@@ -0,0 +1,104 @@
+"""
+Measures the prefill time saved by reusing the key/value cache of the RAG prompt prefix.
+
+For each RAG prompt, the prefill (one forward pass over the prompt, i.e. the time
+to the first token's logits) is timed twice:
+    full    the whole prompt is prefilled from scratch
+    cached  the cached instruction block is copied (and cropped) from prefix_cache.py
+            and only the context and question are prefilled
+
+Usage:
+    python benchmark_prefix_cache.py --precision fp32 --repeats 5 --output prefix_cache_benchmark.json
+"""
+import argparse
+import json
+import time
+
+import torch
+
+from model_loader import PRECISIONS, DEFAULT_PRECISION, load_model, load_tokenizer
+from prefix_cache import PrefixCache, static_prefix
+
+MODEL_NAME = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
+
+EXAMPLES = [
+    ("Le ciel est bleu.\n\nL'herbe est verte.", "Quelle est la couleur du ciel ?"),
+    ("Paris est la capitale de la France.", "Quelle est la capitale de la France ?"),
+    ("Les pommes sont généralement rouges ou vertes.\n\nLe soleil brille.", "Parle-moi des pommes."),
+    ("L'herbe est verte.", "Quelle est la couleur de l'océan ?"),
+]
+
+def time_prefill(model, input_ids, past_key_values=None) -> float:
+    start_time = time.perf_counter()
+    with torch.no_grad():
+        if past_key_values is None:
+            model(input_ids=input_ids, use_cache=True)
+        else:
+            reused = past_key_values.get_seq_length()
+            model(input_ids=input_ids[:, reused:], past_key_values=past_key_values, use_cache=True)
+    return time.perf_counter() - start_time
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the prompt prefix key/value cache.")
+    parser.add_argument("--precision", default=DEFAULT_PRECISION, choices=PRECISIONS)
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", default="prefix_cache_benchmark.json")
+    args = parser.parse_args()
+
+    # Imported here: rag_module pulls in LangChain
+    from rag_module import RAG_PROMPT_TEMPLATE
+
+    tokenizer = load_tokenizer(args.model)
+    model = load_model(args.model, precision=args.precision)
+    cache = PrefixCache()
+    start_time = time.perf_counter()
+    cache.add(model, tokenizer, static_prefix(RAG_PROMPT_TEMPLATE))
+    build_seconds = time.perf_counter() - start_time
+
+    results = []
+    for context, question in EXAMPLES:
+        prompt = RAG_PROMPT_TEMPLATE.format(context=context, question=question)
+        input_ids = tokenizer(prompt, return_tensors="pt")["input_ids"].to(model.device)
+        time_prefill(model, input_ids) # Warm-up
+        full, cached = [], []
+        for _ in range(args.repeats):
+            full.append(time_prefill(model, input_ids))
+            # The copy of the cached prefix is part of the measured time
+            start_time = time.perf_counter()
+            past_key_values, reused = cache.lookup(model, input_ids[0])
+            lookup_seconds = time.perf_counter() - start_time
+            cached.append(lookup_seconds + time_prefill(model, input_ids, past_key_values))
+        results.append({
+            "question": question,
+            "prompt_tokens": int(input_ids.shape[1]),
+            "reused_tokens": reused,
+            "full_ms": 1000.0 * sum(full) / len(full),
+            "cached_ms": 1000.0 * sum(cached) / len(cached),
+        })
+
+    mean_full = sum(result["full_ms"] for result in results) / len(results)
+    mean_cached = sum(result["cached_ms"] for result in results) / len(results)
+    report = {
+        "model": args.model,
+        "precision": args.precision,
+        "prefix_build_seconds": build_seconds,
+        "prefix_cache": cache.stats(),
+        "mean_full_prefill_ms": mean_full,
+        "mean_cached_prefill_ms": mean_cached,
+        "prefill_saved": 1.0 - mean_cached / mean_full if mean_full else 0.0,
+        "prompts": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    print(f"\n{'prompt tokens':>13} {'reused':>7} {'full (ms)':>10} {'cached (ms)':>12}")
+    for result in results:
+        print(f"{result['prompt_tokens']:>13} {result['reused_tokens']:>7} {result['full_ms']:>10.1f} "
+              f"{result['cached_ms']:>12.1f}")
+    print(f"\nMean prefill: {mean_full:.1f} ms -> {mean_cached:.1f} ms ({report['prefill_saved']:.0%} saved)")
+    print(f"Prefix cache: {cache.stats()['megabytes']:.2f} MB, built in {build_seconds:.2f}s")
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
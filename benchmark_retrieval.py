@@ -0,0 +1,316 @@
+"""
+Retrieval-only benchmark: query latency, throughput and recall of the vector search.
+
+A synthetic corpus of short French factual passages is generated (or loaded from
+files with --corpus), together with labeled queries derived from random passages
+(or loaded with --queries). The corpus is indexed by each backend in a fresh,
+temporary directory, then every query is timed individually:
+    chroma     the production path, a ChromaDB collection (HNSW over float32 vectors)
+    quantized  quantized_index.py (IVF over int8 codes, exact re-score of the best candidates)
+
+Reported metrics:
+    latency_ms    p50 / p95 / p99 / mean of single-query search latency
+    qps           queries per second when run sequentially
+    recall@k      overlap between the returned top-k and the exact brute-force top-k
+    label_recall  fraction of queries whose labeled passage is in the returned top-k
+    backend_stats memory per vector of the index, among others
+
+The "hashing" embedder (feature hashing of words and character trigrams) needs no
+model and makes 1M-passage runs practical; "model" uses the project's cached
+MiniLM embedding function.
+
+Usage:
+    python benchmark_retrieval.py --num-passages 100000 --num-queries 1000 --k 2 --embedder hashing
+    python benchmark_retrieval.py --corpus corpus.jsonl --queries queries.jsonl --embedder model
+    python benchmark_retrieval.py --num-passages 1000000 --backend chroma quantized
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+SUBJECTS = ["Le ciel", "L'herbe", "La mer", "Le soleil", "La lune", "Le fleuve", "La montagne", "Le désert",
+            "La forêt", "Le volcan", "La ville", "Le village", "Le musée", "La bibliothèque", "Le port",
+            "La cathédrale", "Le pont", "Le château", "La gare", "L'université"]
+VERBS = ["est situé près de", "est célèbre pour", "a été construit à", "se trouve au nord de", "est visible depuis",
+         "accueille chaque année", "est connu pour", "borde", "domine", "a inspiré"]
+OBJECTS = ["Paris", "Lyon", "Marseille", "Bordeaux", "Lille", "Nantes", "Strasbourg", "Toulouse", "Nice", "Rennes",
+           "la vallée", "la côte atlantique", "les Alpes", "les Pyrénées", "la Loire", "la Seine", "le Rhône",
+           "la Méditerranée", "le Massif central", "la Bretagne"]
+QUALIFIERS = ["depuis le Moyen Âge", "au printemps", "en hiver", "pendant la journée", "la nuit",
+              "selon les historiens", "d'après les habitants", "depuis 1850", "grâce au tourisme", "chaque été"]
+
+HASHING_DIMENSION = 384
+
+def generate_corpus(num_passages: int, seed: int):
+    """
+    Yields (passage_id, text) pairs. A reference code makes every passage unique.
+    """
+    rng = random.Random(seed)
+    for index in range(num_passages):
+        text = (f"{rng.choice(SUBJECTS)} {rng.choice(VERBS)} {rng.choice(OBJECTS)} {rng.choice(QUALIFIERS)} "
+                f"(référence {rng.randrange(16 ** 6):06X}).")
+        yield f"p{index}", text
+
+def make_query(text: str, rng: random.Random) -> str:
+    """
+    Turns a passage into a question-like query by dropping a few words.
+    """
+    words = text.rstrip(".").split()
+    kept = [word for word in words if rng.random() > 0.25] or words
+    return " ".join(kept) + " ?"
+
+def generate_queries(corpus_ids, corpus_texts, num_queries: int, seed: int):
+    rng = random.Random(seed + 1)
+    queries = []
+    for _ in range(num_queries):
+        index = rng.randrange(len(corpus_ids))
+        queries.append({"query": make_query(corpus_texts[index], rng), "relevant_ids": [corpus_ids[index]]})
+    return queries
+
+def load_queries(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+class HashingEmbedder:
+    """
+    Model-free embedder: hashed bag of words and character trigrams, L2-normalized.
+    """
+
+    def __init__(self, dimension: int = HASHING_DIMENSION):
+        self.dimension = dimension
+
+    def _features(self, text: str):
+        words = re.findall(r"\w+", text.lower())
+        for word in words:
+            yield word
+            padded = f"#{word}#"
+            for start in range(len(padded) - 2):
+                yield padded[start:start + 3]
+
+    def __call__(self, texts: list) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+                value = int.from_bytes(digest, "little")
+                vectors[row, value % self.dimension] += 1.0 if (value >> 63) & 1 else -1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+def get_embedder(name: str):
+    if name == "hashing":
+        return HashingEmbedder()
+    from knowledge_base import get_embedding_function
+    embedding_function = get_embedding_function()
+    return lambda texts: np.asarray(embedding_function.embed(texts), dtype=np.float32)
+
+def embed_all(embedder, texts: list, batch_size: int) -> np.ndarray:
+    return np.concatenate([embedder(texts[start:start + batch_size]) for start in range(0, len(texts), batch_size)])
+
+class ChromaBackend:
+    """
+    The production path: a ChromaDB collection with its HNSW index, in a temporary directory.
+    """
+    name = "chroma"
+
+    def __init__(self, db_dir: str):
+        import chromadb
+        self.db_dir = db_dir
+        self.client = chromadb.PersistentClient(path=db_dir)
+        self.collection = self.client.create_collection(name="retrieval_benchmark", embedding_function=None)
+
+    def build(self, ids: list, texts: list, embeddings: np.ndarray):
+        try:
+            batch_size = self.client.get_max_batch_size()
+        except Exception:
+            batch_size = 5000
+        for start in range(0, len(ids), batch_size):
+            end = start + batch_size
+            self.collection.add(ids=ids[start:end], documents=texts[start:end], embeddings=embeddings[start:end].tolist())
+
+    def search(self, query_embedding: np.ndarray, k: int) -> list:
+        result = self.collection.query(query_embeddings=[query_embedding.tolist()], n_results=k, include=[])
+        return result["ids"][0]
+
+    def stats(self) -> dict:
+        # hnswlib keeps each float32 vector, its level-0 links (2 * M), a link count and its
+        # label in RAM; upper levels add about 1 / M of that. M is 16 in Chroma by default.
+        dimension = self.collection.get(limit=1, include=["embeddings"])["embeddings"]
+        dimension = len(dimension[0]) if len(dimension) else 0
+        hnsw_m = 16
+        stats = {"memory_bytes_per_vector": dimension * 4 + 2 * hnsw_m * 4 + 4 + 8}
+        count = self.collection.count()
+        index_bytes = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(self.db_dir)
+                          for name in names if name.endswith(".bin"))
+        if count and index_bytes:
+            stats["disk_bytes_per_vector"] = index_bytes / count
+        return stats
+
+class QuantizedBackend:
+    """
+    quantized_index.py: int8 codes in inverted lists, float16 vectors for the exact re-score, all memory-mapped.
+    """
+    name = "quantized"
+
+    def __init__(self, db_dir: str):
+        from quantized_index import QuantizedIndex
+        self.index = QuantizedIndex(os.path.join(db_dir, "quantized"))
+
+    def build(self, ids: list, texts: list, embeddings: np.ndarray):
+        self.index.rebuild(ids, texts, [{}] * len(ids), embeddings)
+
+    def search(self, query_embedding: np.ndarray, k: int) -> list:
+        return [doc_id for doc_id, _ in self.index.search(query_embedding, k)[0]]
+
+    def stats(self) -> dict:
+        stats = self.index.stats()
+        return {"memory_bytes_per_vector": stats["search_bytes_per_vector"],
+                "disk_bytes_per_vector": stats["disk_bytes_per_vector"], "lists": stats["lists"]}
+
+BACKENDS = {"chroma": ChromaBackend, "quantized": QuantizedBackend}
+
+# Maximum number of query x passage scores held in memory at once (80 MB of float32)
+EXACT_SEARCH_SCORES_PER_CHUNK = 20_000_000
+
+def exact_top_k(corpus_embeddings: np.ndarray, query_embeddings: np.ndarray, k: int):
+    """
+    Brute-force top-k by inner product (equivalent to L2 and cosine ranking for normalized vectors).
+    """
+    chunk_size = max(1, EXACT_SEARCH_SCORES_PER_CHUNK // len(corpus_embeddings))
+    top_k = []
+    for start in range(0, len(query_embeddings), chunk_size):
+        scores = query_embeddings[start:start + chunk_size] @ corpus_embeddings.T
+        candidates = np.argpartition(-scores, kth=min(k, scores.shape[1] - 1), axis=1)[:, :k]
+        for row, candidate in enumerate(candidates):
+            order = np.argsort(-scores[row, candidate])
+            top_k.append(candidate[order])
+    return top_k
+
+def percentiles_ms(latencies: list) -> dict:
+    values = np.asarray(latencies) * 1000.0
+    return {
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+    }
+
+def run_benchmark(args) -> list:
+    """
+    Runs the queries against every backend of args.backend; returns one result dict per backend.
+    """
+    if args.corpus:
+        from ingest import iter_documents
+        corpus = list(iter_documents(args.corpus))
+    else:
+        corpus = list(generate_corpus(args.num_passages, args.seed))
+    corpus_ids = [doc_id for doc_id, _ in corpus]
+    corpus_texts = [text for _, text in corpus]
+    queries = load_queries(args.queries) if args.queries else \
+        generate_queries(corpus_ids, corpus_texts, args.num_queries, args.seed)
+    print(f"Corpus: {len(corpus_ids)} passages, {len(queries)} queries, k={args.k}, embedder={args.embedder}")
+
+    embedder = get_embedder(args.embedder)
+    start_time = time.perf_counter()
+    corpus_embeddings = embed_all(embedder, corpus_texts, args.batch_size)
+    embed_seconds = time.perf_counter() - start_time
+    query_embeddings = embed_all(embedder, [query["query"] for query in queries], args.batch_size)
+    print(f"Embedded corpus in {embed_seconds:.1f}s ({len(corpus_ids) / embed_seconds:.0f} passages/sec)")
+
+    exact = exact_top_k(corpus_embeddings, query_embeddings, args.k)
+    exact_ids = [[corpus_ids[index] for index in row] for row in exact]
+
+    return [run_backend(args, backend_name, corpus_ids, corpus_texts, corpus_embeddings, queries,
+                        query_embeddings, exact_ids, embed_seconds) for backend_name in args.backend]
+
+def run_backend(args, backend_name, corpus_ids, corpus_texts, corpus_embeddings, queries, query_embeddings,
+                exact_ids, embed_seconds) -> dict:
+    db_dir = os.path.join(args.db_dir, backend_name) if args.db_dir else \
+        tempfile.mkdtemp(prefix="retrieval_benchmark_")
+    try:
+        backend = BACKENDS[backend_name](db_dir)
+        start_time = time.perf_counter()
+        backend.build(corpus_ids, corpus_texts, corpus_embeddings)
+        build_seconds = time.perf_counter() - start_time
+        print(f"Built {backend_name} index in {build_seconds:.1f}s")
+
+        # Warm-up queries are not measured
+        for query_embedding in query_embeddings[:min(10, len(query_embeddings))]:
+            backend.search(query_embedding, args.k)
+
+        latencies, recalls, label_hits = [], [], []
+        total_start = time.perf_counter()
+        for query, query_embedding, expected in zip(queries, query_embeddings, exact_ids):
+            start_time = time.perf_counter()
+            returned = backend.search(query_embedding, args.k)
+            latencies.append(time.perf_counter() - start_time)
+            recalls.append(len(set(returned) & set(expected)) / len(expected))
+            relevant = set(query.get("relevant_ids") or [])
+            if relevant:
+                label_hits.append(bool(relevant & set(returned)))
+        total_seconds = time.perf_counter() - total_start
+        backend_stats = backend.stats()
+    finally:
+        if not args.db_dir:
+            shutil.rmtree(db_dir, ignore_errors=True)
+
+    return {
+        "backend": backend_name,
+        "embedder": args.embedder,
+        "num_passages": len(corpus_ids),
+        "num_queries": len(queries),
+        "k": args.k,
+        "embedding_dimension": int(corpus_embeddings.shape[1]),
+        "embed_seconds": embed_seconds,
+        "build_seconds": build_seconds,
+        "latency_ms": percentiles_ms(latencies),
+        "qps": len(queries) / total_seconds if total_seconds else 0.0,
+        f"recall@{args.k}": float(np.mean(recalls)),
+        "label_recall": float(np.mean(label_hits)) if label_hits else None,
+        "backend_stats": backend_stats,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the retrieval side of the RAG pipeline.")
+    parser.add_argument("--backend", nargs="+", default=["chroma"], choices=sorted(BACKENDS),
+                        help="Backends to compare on the same corpus and queries.")
+    parser.add_argument("--num-passages", type=int, default=10000)
+    parser.add_argument("--num-queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=2)
+    parser.add_argument("--embedder", default="hashing", choices=["hashing", "model"])
+    parser.add_argument("--batch-size", type=int, default=1024, help="Embedding batch size.")
+    parser.add_argument("--corpus", nargs="+", help="Corpus files (.jsonl or text) instead of a synthetic corpus.")
+    parser.add_argument("--queries", help='Queries JSONL: {"query": "...", "relevant_ids": ["..."]} per line.')
+    parser.add_argument("--db-dir", help="Keep the benchmark index in this directory instead of a temporary one.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="retrieval_benchmark.json")
+    args = parser.parse_args()
+
+    runs = run_benchmark(args)
+    with open(args.output, "w", encoding="utf-8") as f:
+        # A single backend keeps the original one-object format
+        json.dump(runs[0] if len(runs) == 1 else runs, f, indent=2)
+
+    for results in runs:
+        latency = results["latency_ms"]
+        print(f"\n[{results['backend']}]")
+        print(f"Latency (ms): p50 {latency['p50']:.2f}  p95 {latency['p95']:.2f}  p99 {latency['p99']:.2f}")
+        print(f"QPS: {results['qps']:.1f}")
+        print(f"Recall@{args.k} vs exact search: {results[f'recall@{args.k}']:.3f}")
+        if results["label_recall"] is not None:
+            print(f"Labeled passage in top-{args.k}: {results['label_recall']:.3f}")
+        memory = results["backend_stats"].get("memory_bytes_per_vector")
+        if memory is not None:
+            print(f"Index memory per vector: {memory} bytes")
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Compares speculative decoding modes (generation.py, RAG_SPECULATIVE) with plain greedy generation.
+
+The same RAG prompts are answered by the same loaded model in each mode; "off"
+is always run first as the reference. The report gives tokens/sec and the
+speed-up over "off", the acceptance rate of the draft tokens, the tokens
+produced per forward pass of the model, and whether every answer is identical
+to the reference (it should be: decoding is greedy).
+
+Usage:
+    python benchmark_speculative.py --modes prompt_lookup draft --max-new-tokens 150
+    python benchmark_speculative.py --prompts prompts.jsonl   ({"context": "...", "question": "..."} per line)
+"""
+import argparse
+import json
+import time
+
+import torch
+
+from generation import SPECULATIVE_MODES, MAX_NEW_TOKENS, generate_ids, get_model_and_tokenizer, get_speculative_stats
+from rag_module import RAG_PROMPT_TEMPLATE, load_llm
+
+# Answers to these questions mostly restate their context, as RAG answers do
+CONTEXTS = [
+    ("La tour Eiffel a été construite par Gustave Eiffel pour l'Exposition universelle de 1889 à Paris. "
+     "Elle mesure 330 mètres de haut et a été le monument le plus haut du monde jusqu'en 1930.",
+     "Qui a construit la tour Eiffel et pour quelle occasion ?"),
+    ("La Loire est le plus long fleuve de France, avec une longueur de 1 006 kilomètres. Elle prend sa source "
+     "au mont Gerbier de Jonc, en Ardèche, et se jette dans l'océan Atlantique près de Saint-Nazaire.",
+     "Où la Loire prend-elle sa source et où se jette-t-elle ?"),
+    ("Une radiographie thoracique de face permet d'évaluer les poumons, le cœur et les côtes. Le patient se "
+     "tient debout, la poitrine contre le détecteur, et retient sa respiration pendant l'exposition.",
+     "Comment se déroule une radiographie thoracique de face ?"),
+    ("Le Mont Blanc culmine à 4 806 mètres d'altitude dans le massif des Alpes, à la frontière entre la France "
+     "et l'Italie. Sa première ascension a été réalisée en 1786 par Jacques Balmat et Michel Paccard.",
+     "Quand et par qui le Mont Blanc a-t-il été gravi pour la première fois ?"),
+]
+
+def load_prompts(path: str = None) -> list:
+    if path is None:
+        pairs = CONTEXTS
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        pairs = [(record["context"], record["question"]) for record in records]
+    return [RAG_PROMPT_TEMPLATE.format(context=context, question=question) for context, question in pairs]
+
+def run_mode(llm, prompts: list, mode: str, max_new_tokens: int) -> dict:
+    """
+    Answers every prompt in one speculative mode and returns timings, counters and token IDs.
+    """
+    model, tokenizer = get_model_and_tokenizer(llm)
+    stats = get_speculative_stats(model)
+
+    # Warm-up (and draft model loading), not measured
+    warm_up = tokenizer(prompts[0], return_tensors="pt").to(model.device)
+    with torch.no_grad():
+        generate_ids(model, warm_up, mode, max_new_tokens=8, pad_token_id=tokenizer.pad_token_id)
+    before = (stats.generated_tokens, stats.passes, stats.drafted_tokens)
+
+    token_ids = []
+    seconds = 0.0
+    for prompt in prompts:
+        inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+        start_time = time.perf_counter()
+        with torch.no_grad():
+            output_ids = generate_ids(model, inputs, mode, max_new_tokens=max_new_tokens,
+                                      pad_token_id=tokenizer.pad_token_id)
+        seconds += time.perf_counter() - start_time
+        token_ids.append(output_ids[0, inputs["input_ids"].shape[1]:].tolist())
+
+    generated_tokens = sum(len(ids) for ids in token_ids)
+    result = {
+        "mode": mode,
+        "generated_tokens": generated_tokens,
+        "generation_seconds": seconds,
+        "tokens_per_sec": generated_tokens / seconds if seconds else 0.0,
+        "answers": [tokenizer.decode(ids, skip_special_tokens=True) for ids in token_ids],
+        "token_ids": token_ids,
+    }
+    if mode != "off":
+        generated, passes, drafted = (after - start for after, start in
+                                      zip((stats.generated_tokens, stats.passes, stats.drafted_tokens), before))
+        result["drafted_tokens"] = drafted
+        result["acceptance_rate"] = max(0, generated - passes) / drafted if drafted else 0.0
+        result["tokens_per_pass"] = generated / passes if passes else 0.0
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark speculative decoding against greedy generation.")
+    parser.add_argument("--modes", nargs="+", default=["prompt_lookup", "draft"],
+                        choices=[mode for mode in SPECULATIVE_MODES if mode != "off"])
+    parser.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS)
+    parser.add_argument("--prompts", help="JSONL file of {\"context\", \"question\"} records.")
+    parser.add_argument("--output", default="speculative_benchmark.json")
+    args = parser.parse_args()
+
+    prompts = load_prompts(args.prompts)
+    llm = load_llm()
+    results = []
+    for mode in ["off"] + args.modes:
+        print(f"Benchmarking {mode}...")
+        results.append(run_mode(llm, prompts, mode, args.max_new_tokens))
+
+    baseline = results[0]
+    for result in results:
+        result["speedup"] = result["tokens_per_sec"] / baseline["tokens_per_sec"] if baseline["tokens_per_sec"] else 0.0
+        result["identical_answers"] = sum(ref == ids for ref, ids in zip(baseline["token_ids"], result["token_ids"])) \
+            / len(prompts)
+    for result in results:
+        del result["token_ids"]
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"max_new_tokens": args.max_new_tokens, "prompts": len(prompts), "results": results}, f,
+                  indent=2, ensure_ascii=False)
+
+    print(f"\n{'mode':<14} {'tok/s':>8} {'speedup':>8} {'accept':>7} {'tok/pass':>9} {'identical':>10}")
+    for result in results:
+        print(f"{result['mode']:<14} {result['tokens_per_sec']:>8.2f} {result['speedup']:>8.2f} "
+              f"{result.get('acceptance_rate', 0.0):>7.2f} {result.get('tokens_per_pass', 1.0):>9.2f} "
+              f"{result['identical_answers']:>10.2f}")
+    print(f"\nResults written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,412 @@
+"""
+On-disk BM25 inverted index kept next to the Chroma store.
+
+The index of a collection lives in its own directory:
+
+    CURRENT              number of the active segment
+    segment-<n>/         compacted index, loaded with numpy mmap (nothing is read until searched)
+        terms.npy          sorted vocabulary
+        offsets.npy        start of the postings of each term (CSR layout)
+        postings_docs.npy  document numbers
+        postings_freqs.npy term frequencies
+        doc_ids.npy        document IDs, doc_id_order.npy sorts them for lookups
+        doc_lengths.npy    number of terms of each document
+    ops-<n>.jsonl        adds and deletes made since segment <n> was written
+
+Writes only append to the ops log; they are replayed in memory on load, and
+by the other processes (CLI, backend workers) when they refresh() the index,
+which the RAG retriever does whenever the knowledge base generation changes.
+Once the log holds more than a fifth of the segment, both are merged into a
+new segment.
+
+Tokenization is tuned for short French factual sentences: lowercase, accents
+removed, elisions split ("l'herbe" -> "herbe"), common stop words dropped,
+words and codes kept whole so that proper nouns and references match exactly.
+
+Usage:
+    python bm25_index.py rebuild   (re-index the whole collection)
+    python bm25_index.py search "Capitale France"
+"""
+import argparse
+import fcntl
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import unicodedata
+from collections import Counter
+
+import numpy as np
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Compact once the ops log holds this many documents, or a fifth of the segment if larger
+MIN_DOCS_BEFORE_COMPACTION = 10000
+COMPACTION_RATIO = 0.2
+
+STOP_WORDS = frozenset("""
+a au aux avec ce ces c ça d dans de des du elle elles en est et eux il ils j je l la le les leur leurs lui m ma
+mais me mes moi mon n ne nos notre nous on ont ou où par pas pour qu que quel quelle quelles quels qui s sa sans
+se ses son sont sur t ta te tes toi ton tu un une vos votre vous y été être avoir
+""".split())
+
+_TOKEN_RE = re.compile(r"\w+")
+
+def _strip_accents(text: str) -> str:
+    return "".join(char for char in unicodedata.normalize("NFKD", text) if not unicodedata.combining(char))
+
+def tokenize(text: str) -> list:
+    """
+    Returns the index terms of a text.
+    """
+    terms = []
+    for word in _TOKEN_RE.findall(_strip_accents(text.lower())):
+        if word in STOP_WORDS:
+            continue
+        # Light plural folding, codes and numbers are kept as-is
+        if len(word) > 3 and word[-1] in "sx" and word.isalpha():
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+class BM25Index:
+    """
+    BM25 index of one collection: an mmapped segment plus the in-memory replay of the ops log.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.RLock()
+        self._load()
+
+    # --- Loading --------------------------------------------------------------------------------
+
+    def _current_path(self) -> str:
+        return os.path.join(self.directory, "CURRENT")
+
+    def _ops_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"ops-{segment}.jsonl")
+
+    def _segment_dir(self, segment: int) -> str:
+        return os.path.join(self.directory, f"segment-{segment}")
+
+    def _read_current(self) -> int:
+        try:
+            with open(self._current_path(), "r", encoding="utf-8") as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _load(self):
+        self.segment = self._read_current()
+        segment_dir = self._segment_dir(self.segment)
+        if os.path.isdir(segment_dir):
+            def load(name):
+                return np.load(os.path.join(segment_dir, f"{name}.npy"), mmap_mode="r")
+            self._terms = load("terms")
+            self._offsets = load("offsets")
+            self._postings_docs = load("postings_docs")
+            self._postings_freqs = load("postings_freqs")
+            self._doc_ids = load("doc_ids")
+            self._doc_id_order = load("doc_id_order")
+            self._doc_lengths = load("doc_lengths")
+            with open(os.path.join(segment_dir, "meta.json"), "r", encoding="utf-8") as f:
+                total_length = json.load(f)["total_length"]
+        else:
+            self._terms = np.array([], dtype="<U1")
+            self._offsets = np.zeros(1, dtype=np.int64)
+            self._postings_docs = np.array([], dtype=np.int32)
+            self._postings_freqs = np.array([], dtype=np.int32)
+            self._doc_ids = np.array([], dtype="<U1")
+            self._doc_id_order = np.array([], dtype=np.int64)
+            self._doc_lengths = np.array([], dtype=np.int32)
+            total_length = 0
+        self._deleted = np.zeros(len(self._doc_ids), dtype=bool)
+        self.num_docs = len(self._doc_ids)
+        self.total_length = total_length
+        # Documents added since the segment was written: id -> (term counts, length)
+        self._delta_docs = {}
+        self._delta_postings = {}
+        self._ops_offset = 0
+        self._replay()
+
+    def _replay(self):
+        path = self._ops_path(self.segment)
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            f.seek(self._ops_offset)
+            while True:
+                line = f.readline()
+                # A line still being written by another process is read at the next refresh
+                if not line.endswith("\n"):
+                    break
+                self._apply(json.loads(line))
+                self._ops_offset = f.tell()
+
+    def refresh(self):
+        """
+        Picks up the writes made by other processes since the last call.
+        """
+        with self._lock:
+            if self._read_current() != self.segment:
+                self._load()
+                return
+            try:
+                size = os.path.getsize(self._ops_path(self.segment))
+            except FileNotFoundError:
+                return
+            if size > self._ops_offset:
+                self._replay()
+
+    # --- Writes ---------------------------------------------------------------------------------
+
+    def _base_position(self, doc_id: str):
+        if not len(self._doc_ids):
+            return None
+        index = np.searchsorted(self._doc_ids, doc_id, sorter=self._doc_id_order)
+        if index < len(self._doc_ids):
+            position = int(self._doc_id_order[index])
+            if self._doc_ids[position] == doc_id:
+                return position
+        return None
+
+    def _remove(self, doc_id: str):
+        if doc_id in self._delta_docs:
+            counts, length = self._delta_docs.pop(doc_id)
+            for term in counts:
+                self._delta_postings[term].discard(doc_id)
+        else:
+            position = self._base_position(doc_id)
+            if position is None or self._deleted[position]:
+                return
+            self._deleted[position] = True
+            length = int(self._doc_lengths[position])
+        self.num_docs -= 1
+        self.total_length -= length
+
+    def _apply(self, op: dict):
+        for doc_id in op["ids"]:
+            self._remove(doc_id)
+        if op["op"] == "add":
+            for doc_id, text in zip(op["ids"], op["texts"]):
+                counts = Counter(tokenize(text))
+                length = sum(counts.values())
+                self._delta_docs[doc_id] = (counts, length)
+                for term in counts:
+                    self._delta_postings.setdefault(term, set()).add(doc_id)
+                self.num_docs += 1
+                self.total_length += length
+
+    def _write_op(self, op: dict):
+        with self._lock, open(os.path.join(self.directory, "lock"), "w") as lock_file:
+            # Serializes the writers of every process; replaying first keeps the operations ordered
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.refresh()
+            with open(self._ops_path(self.segment), "a", encoding="utf-8") as f:
+                f.write(json.dumps(op, ensure_ascii=False) + "\n")
+                self._ops_offset = f.tell()
+            self._apply(op)
+            if len(self._delta_docs) > max(MIN_DOCS_BEFORE_COMPACTION, COMPACTION_RATIO * len(self._doc_ids)):
+                self._compact()
+
+    def add(self, ids: list, texts: list):
+        """Indexes documents, replacing the ones with the same IDs."""
+        if ids:
+            self._write_op({"op": "add", "ids": list(ids), "texts": list(texts)})
+
+    def delete(self, ids: list):
+        if ids:
+            self._write_op({"op": "delete", "ids": list(ids)})
+
+    # --- Segments -------------------------------------------------------------------------------
+
+    def _write_segment(self, doc_ids: list, doc_lengths: list, postings: dict):
+        # postings: term -> (document numbers, frequencies)
+        segment = self.segment + 1
+        segment_dir = self._segment_dir(segment)
+        shutil.rmtree(segment_dir, ignore_errors=True)
+        os.makedirs(segment_dir)
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum([len(postings[term][0]) for term in terms], out=offsets[1:])
+        doc_id_array = np.array(doc_ids, dtype=str) if doc_ids else np.array([], dtype="<U1")
+
+        def save(name, array):
+            np.save(os.path.join(segment_dir, f"{name}.npy"), array)
+        save("terms", np.array(terms, dtype=str) if terms else np.array([], dtype="<U1"))
+        save("offsets", offsets)
+        save("postings_docs", np.concatenate([postings[term][0] for term in terms]).astype(np.int32)
+             if terms else np.array([], dtype=np.int32))
+        save("postings_freqs", np.concatenate([postings[term][1] for term in terms]).astype(np.int32)
+             if terms else np.array([], dtype=np.int32))
+        save("doc_ids", doc_id_array)
+        save("doc_id_order", np.argsort(doc_id_array, kind="stable").astype(np.int64))
+        save("doc_lengths", np.array(doc_lengths, dtype=np.int32))
+        with open(os.path.join(segment_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"num_docs": len(doc_ids), "total_length": int(sum(doc_lengths))}, f)
+
+        open(self._ops_path(segment), "a").close()
+        tmp_path = self._current_path() + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(str(segment))
+        os.replace(tmp_path, self._current_path())
+        previous = self.segment
+        # Processes still reading the old segment keep their mapping until they reload
+        shutil.rmtree(self._segment_dir(previous), ignore_errors=True)
+        if os.path.exists(self._ops_path(previous)):
+            os.remove(self._ops_path(previous))
+        self._load()
+
+    def _compact(self):
+        live = ~self._deleted
+        new_numbers = np.cumsum(live) - 1
+        doc_ids = [str(doc_id) for doc_id in np.asarray(self._doc_ids)[live]] + list(self._delta_docs)
+        doc_lengths = [int(length) for length in np.asarray(self._doc_lengths)[live]] + \
+                      [length for _, length in self._delta_docs.values()]
+        postings = {}
+        for term_number, term in enumerate(self._terms):
+            start, end = self._offsets[term_number], self._offsets[term_number + 1]
+            docs = np.asarray(self._postings_docs[start:end])
+            keep = live[docs]
+            if keep.any():
+                postings[str(term)] = (new_numbers[docs[keep]], np.asarray(self._postings_freqs[start:end])[keep])
+        delta_numbers = {doc_id: len(doc_ids) - len(self._delta_docs) + index
+                         for index, doc_id in enumerate(self._delta_docs)}
+        for term, delta_ids in self._delta_postings.items():
+            if not delta_ids:
+                continue
+            numbers = np.array([delta_numbers[doc_id] for doc_id in delta_ids], dtype=np.int64)
+            freqs = np.array([self._delta_docs[doc_id][0][term] for doc_id in delta_ids], dtype=np.int64)
+            if term in postings:
+                numbers = np.concatenate([postings[term][0], numbers])
+                freqs = np.concatenate([postings[term][1], freqs])
+            postings[term] = (numbers, freqs)
+        self._write_segment(doc_ids, doc_lengths, postings)
+
+    def compact(self):
+        """Merges the ops log into a new segment."""
+        with self._lock, open(os.path.join(self.directory, "lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.refresh()
+            self._compact()
+
+    def rebuild(self, documents):
+        """
+        Replaces the whole index with an iterable of (document_id, text) pairs.
+        """
+        with self._lock, open(os.path.join(self.directory, "lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            doc_ids, doc_lengths, term_docs, term_freqs = [], [], {}, {}
+            for number, (doc_id, text) in enumerate(documents):
+                counts = Counter(tokenize(text))
+                doc_ids.append(doc_id)
+                doc_lengths.append(sum(counts.values()))
+                for term, count in counts.items():
+                    term_docs.setdefault(term, []).append(number)
+                    term_freqs.setdefault(term, []).append(count)
+            postings = {term: (np.array(term_docs[term]), np.array(term_freqs[term])) for term in term_docs}
+            self.segment = self._read_current()
+            self._write_segment(doc_ids, doc_lengths, postings)
+
+    # --- Search ---------------------------------------------------------------------------------
+
+    def _term_postings(self, term: str):
+        index = int(np.searchsorted(self._terms, term))
+        if index >= len(self._terms) or self._terms[index] != term:
+            return None, None
+        start, end = self._offsets[index], self._offsets[index + 1]
+        return np.asarray(self._postings_docs[start:end]), np.asarray(self._postings_freqs[start:end])
+
+    def search(self, query: str, k: int = 10) -> list:
+        """
+        Returns the k best (document_id, score) pairs for the query, best first.
+        Writes of other processes are only seen after refresh().
+        """
+        with self._lock:
+            if self.num_docs <= 0:
+                return []
+            average_length = self.total_length / self.num_docs
+            base_scores = None
+            delta_scores = Counter()
+            for term in set(tokenize(query)):
+                docs, freqs = self._term_postings(term)
+                if docs is not None:
+                    keep = ~self._deleted[docs]
+                    docs, freqs = docs[keep], freqs[keep]
+                delta_ids = self._delta_postings.get(term) or ()
+                document_frequency = (len(docs) if docs is not None else 0) + len(delta_ids)
+                if not document_frequency:
+                    continue
+                idf = math.log(1.0 + (self.num_docs - document_frequency + 0.5) / (document_frequency + 0.5))
+                if docs is not None and len(docs):
+                    lengths = self._doc_lengths[docs]
+                    if base_scores is None:
+                        base_scores = np.zeros(len(self._doc_ids), dtype=np.float32)
+                    base_scores[docs] += idf * freqs * (BM25_K1 + 1) / (
+                        freqs + BM25_K1 * (1 - BM25_B + BM25_B * lengths / average_length))
+                for doc_id in delta_ids:
+                    counts, length = self._delta_docs[doc_id]
+                    freq = counts[term]
+                    delta_scores[doc_id] += idf * freq * (BM25_K1 + 1) / (
+                        freq + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length))
+
+            results = list(delta_scores.items())
+            if base_scores is not None:
+                candidates = np.flatnonzero(base_scores)
+                if len(candidates) > k:
+                    candidates = candidates[np.argpartition(-base_scores[candidates], k - 1)[:k]]
+                results += [(str(self._doc_ids[number]), float(base_scores[number])) for number in candidates]
+        results.sort(key=lambda item: -item[1])
+        return results[:k]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "segment": self.segment,
+                "documents": self.num_docs,
+                "segment_documents": len(self._doc_ids),
+                "pending_documents": len(self._delta_docs),
+                "terms": len(self._terms),
+            }
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_bm25_index(directory: str) -> BM25Index:
+    """
+    Returns the process-wide index stored in a directory, opening it on first use.
+    """
+    directory = os.path.abspath(directory)
+    with _indexes_lock:
+        if directory not in _indexes:
+            _indexes[directory] = BM25Index(directory)
+        return _indexes[directory]
+
+def main():
+    from knowledge_base import COLLECTION_NAME, get_or_create_collection, get_lexical_index, rebuild_lexical_index
+
+    parser = argparse.ArgumentParser(description="Maintain the BM25 index of a collection.")
+    parser.add_argument("command", choices=["rebuild", "compact", "stats", "search"])
+    parser.add_argument("query", nargs="?")
+    parser.add_argument("--collection", default=COLLECTION_NAME)
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        rebuild_lexical_index(get_or_create_collection(args.collection))
+    index = get_lexical_index(args.collection)
+    if args.command == "compact":
+        index.compact()
+    if args.command == "search":
+        index.refresh()
+        for doc_id, score in index.search(args.query or "", args.k):
+            print(f"{score:8.3f}  {doc_id}")
+        return
+    print(index.stats())
+
+if __name__ == "__main__":
+    main()
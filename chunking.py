@@ -0,0 +1,86 @@
+"""
+Token-aware chunking of documents at ingestion, and token-budget packing of the
+retrieved chunks at query time.
+
+Long documents are split into windows of at most chunk_tokens LLM tokens, each
+overlapping the previous one by overlap tokens, so a single document can never
+fill TinyLlama's 2048-token context. Chunk texts are cut from the original text
+at token boundaries (no decode round-trip). Every chunk keeps the ID of its
+document in its metadata:
+
+    {"parent_id": "doc1", "chunk_index": 0, "chunk_count": 3}
+
+A document that fits in one chunk keeps its own ID; longer ones are stored as
+"<id>#chunk<index>".
+"""
+import os
+import threading
+
+CHUNK_TOKENIZER_NAME = os.environ.get("RAG_CHUNK_TOKENIZER", "TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+DEFAULT_CHUNK_TOKENS = int(os.environ.get("RAG_CHUNK_TOKENS", "200"))
+DEFAULT_CHUNK_OVERLAP = int(os.environ.get("RAG_CHUNK_OVERLAP", "32"))
+CHUNK_ID_SEPARATOR = "#chunk"
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+def get_chunk_tokenizer():
+    """
+    Returns the (fast) tokenizer of the LLM, loaded once: budgets are expressed in LLM tokens.
+    """
+    global _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is None:
+            from transformers import AutoTokenizer
+            _tokenizer = AutoTokenizer.from_pretrained(CHUNK_TOKENIZER_NAME, use_fast=True)
+        return _tokenizer
+
+def chunk_id(document_id: str, index: int) -> str:
+    return f"{document_id}{CHUNK_ID_SEPARATOR}{index}"
+
+def split_text(text: str, tokenizer, chunk_tokens: int = DEFAULT_CHUNK_TOKENS,
+               overlap: int = DEFAULT_CHUNK_OVERLAP) -> list:
+    """
+    Splits a text into overlapping windows of at most chunk_tokens tokens.
+    """
+    if overlap >= chunk_tokens:
+        raise ValueError(f"overlap ({overlap}) must be smaller than chunk_tokens ({chunk_tokens}).")
+    offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+    if len(offsets) <= chunk_tokens:
+        return [text]
+    chunks = []
+    step = chunk_tokens - overlap
+    for start in range(0, len(offsets), step):
+        end = min(start + chunk_tokens, len(offsets))
+        chunks.append(text[offsets[start][0]:offsets[end - 1][1]].strip())
+        if end == len(offsets):
+            break
+    return chunks
+
+def iter_chunks(documents, chunk_tokens: int = DEFAULT_CHUNK_TOKENS, overlap: int = DEFAULT_CHUNK_OVERLAP,
+                tokenizer=None):
+    """
+    Streams (chunk_id, text, metadata) triples from an iterable of (document_id, text) pairs.
+    """
+    tokenizer = tokenizer or get_chunk_tokenizer()
+    for document_id, text in documents:
+        chunks = split_text(text, tokenizer, chunk_tokens, overlap)
+        for index, chunk in enumerate(chunks):
+            metadata = {"parent_id": document_id, "chunk_index": index, "chunk_count": len(chunks)}
+            yield (document_id if len(chunks) == 1 else chunk_id(document_id, index)), chunk, metadata
+
+def pack_documents(documents: list, count_tokens, token_budget: int, separator_tokens: int = 2) -> list:
+    """
+    Keeps the best-ranked documents whose total size fits in token_budget tokens.
+    Documents that do not fit are skipped so that smaller, lower-ranked ones can still
+    fill the budget; the first document is always kept so a question never gets an empty context.
+    """
+    packed = []
+    used = 0
+    for document in documents:
+        size = count_tokens(document.page_content) + separator_tokens
+        if packed and used + size > token_budget:
+            continue
+        packed.append(document)
+        used += size
+    return packed
@@ -1,9 +1,18 @@
+import time
+_start_time = time.perf_counter()
+import importlib
+import threading
 import uuid
 import subprocess
 import sys # For python executable path
-from rag_module import load_llm, setup_rag_chain, ask_question_with_rag, COLLECTION_NAME, EMBEDDING_MODEL_NAME, DB_DIR
+# Only light modules are imported here: torch, transformers and langchain are imported
+# by the background loader so that the menu is usable immediately.
 from knowledge_base import get_or_create_collection as kb_get_or_create_collection, \
-                           add_document as kb_add_document, client as kb_client
+                           client as kb_client, SEED_DOCUMENTS, \
+                           COLLECTION_NAME, EMBEDDING_MODEL_NAME, get_embedding_function
+from ingest import sync_documents
+from ingest_queue import get_ingest_queue
+_base_import_seconds = time.perf_counter() - _start_time
 
 # --- Global Variables ---
 # Path to the model. This might be updated after fine-tuning.
@@ -11,13 +20,83 @@ from knowledge_base import get_or_create_collection as kb_get_or_create_collecti
 # would use a config file or environment variable.
 CURRENT_MODEL_PATH_FOR_RAG = None # Will be set after LLM is loaded by rag_module's functions
 
-# Initialize components for RAG
-# We need to load the LLM and set up the RAG chain once when the CLI app starts.
-print("Initialisation du LLM et de la chaîne RAG...")
-llm = load_llm()
-# Note: The collection for RAG is implicitly handled by Chroma vector store in setup_rag_chain
-rag_chain = setup_rag_chain(llm, COLLECTION_NAME, EMBEDDING_MODEL_NAME)
-print("Initialisation terminée.")
+class RagComponents:
+    """
+    Loads the LLM, the RAG chain and the answer cache in a background thread.
+    Menu options that don't need the LLM (2, 3, 4) are usable while it loads.
+    """
+
+    def __init__(self):
+        # Seconds spent in each startup step, for the startup report
+        self.timings = {"import (chromadb)": _base_import_seconds}
+        self.llm = None
+        self.chain = None
+        self.answer_cache = None
+        self.stream_question_with_rag = None
+        self.rag_module = None
+        self.error = None
+        self._report_printed = False
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._load, name="rag-loader", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _timed(self, label, function):
+        step_start = time.perf_counter()
+        result = function()
+        self.timings[label] = time.perf_counter() - step_start
+        return result
+
+    def _load(self):
+        global CURRENT_MODEL_PATH_FOR_RAG
+        load_start = time.perf_counter()
+        try:
+            rag_module = self._timed("import (torch, transformers, langchain)",
+                                     lambda: importlib.import_module("rag_module"))
+            # One embedding model serves ChromaDB and the retriever (see knowledge_base.get_embedding_function)
+            self._timed("embedding model", lambda: get_embedding_function(EMBEDDING_MODEL_NAME).warm_up())
+            llm = rag_module.load_llm(timings=self.timings) # Adds the tokenizer, model and pipeline steps
+            self.llm, self.rag_module = llm, rag_module
+            # Note: The collection for RAG is implicitly handled by Chroma vector store in setup_rag_chain
+            self.chain = self._timed("RAG chain",
+                                     lambda: rag_module.setup_rag_chain(llm, COLLECTION_NAME, EMBEDDING_MODEL_NAME))
+            # Repeated (or nearly identical) questions are answered from this cache
+            self.answer_cache = rag_module.create_answer_cache()
+            self.stream_question_with_rag = rag_module.stream_question_with_rag
+            CURRENT_MODEL_PATH_FOR_RAG = rag_module.MODEL_NAME
+        except Exception as e:
+            self.error = e
+        finally:
+            self.timings["background total"] = time.perf_counter() - load_start
+            self._ready.set()
+
+    def wait(self):
+        """Blocks until the components are loaded. Raises RuntimeError if loading failed."""
+        if not self._ready.is_set():
+            print("Chargement du LLM et de la chaîne RAG en cours, veuillez patienter...")
+            self._ready.wait()
+        if self.error is not None:
+            raise RuntimeError(f"Le chargement du LLM a échoué: {self.error}")
+        if not self._report_printed:
+            self._report_printed = True
+            self.print_startup_report()
+
+    def load_adapter(self, adapter_dir: str = None) -> str:
+        """Swaps the LoRA adapter of the loaded model and forgets the answers given before."""
+        self.wait()
+        adapter_name = self.rag_module.load_adapter(self.llm, adapter_dir or self.rag_module.LORA_ADAPTER_DIR)
+        self.answer_cache.clear()
+        return adapter_name
+
+    def print_startup_report(self):
+        print("\n--- Rapport de démarrage ---")
+        for label, seconds in self.timings.items():
+            print(f"  {label:<42} {seconds:7.2f} s")
+
+# Initialize components for RAG in the background (see RagComponents)
+print("Chargement du LLM et de la chaîne RAG en arrière-plan...")
+rag_components = RagComponents()
 
 # Get the ChromaDB collection for adding documents (using knowledge_base functions)
 # This uses the client from knowledge_base.py
@@ -40,17 +119,27 @@ def display_menu():
 
 def handle_trigger_fine_tuning():
     """Handles triggering the fine-tuning script."""
-    print("\nLancement du script de fine-tuning (fine_tune_model.py)...")
+    use_lora = input("Entraîner seulement un adaptateur LoRA (rapide, quelques Mo) ? (O/n): ").strip().lower() != "n"
+    command = [sys.executable, "fine_tune_model.py"] + (["--lora"] if use_lora else [])
+    print(f"\nLancement du script de fine-tuning (fine_tune_model.py{' --lora' if use_lora else ''})...")
     print("Cela peut prendre beaucoup de temps, surtout sur CPU.")
     print("Surveillez la console pour la sortie du script de fine-tuning.")
     try:
         # Ensure using the same Python interpreter that runs cli_app.py
-        process_result = subprocess.run([sys.executable, "fine_tune_model.py"], capture_output=False, text=False, check=False)
+        process_result = subprocess.run(command, capture_output=False, text=False, check=False)
         if process_result.returncode == 0:
             print("Le script de fine-tuning semble s'être terminé avec succès.")
-            print("IMPORTANT: Pour utiliser le modèle fine-tuné, vous devez MANUELLEMENT")
-            print(f"mettre à jour le chemin du modèle dans 'rag_module.py' vers './tinyllama_finetuned'")
-            print("et redémarrer cette application CLI.")
+            if use_lora:
+                # The adapter is swapped into the running model: no restart, base weights untouched
+                try:
+                    adapter_name = rag_components.load_adapter()
+                    print(f"Adaptateur LoRA chargé dans le modèle en cours d'utilisation ({adapter_name}).")
+                except Exception as e:
+                    print(f"ERREUR: Impossible de charger l'adaptateur LoRA: {e}")
+            else:
+                print("IMPORTANT: Pour utiliser le modèle fine-tuné, vous devez MANUELLEMENT")
+                print(f"mettre à jour le chemin du modèle dans 'rag_module.py' vers './tinyllama_finetuned'")
+                print("et redémarrer cette application CLI.")
         else:
             print("ERREUR: Le script de fine-tuning s'est terminé avec un code d'erreur.")
             print(f"Code de retour: {process_result.returncode}")
@@ -76,24 +165,16 @@ def handle_provide_learning_data():
     except Exception as e:
         print(f"Erreur lors de l'écriture dans learning_data.txt: {e}")
 
-def handle_ask_question():
-    """Handles the ask question functionality."""
-    question = input("Veuillez saisir votre question: ")
-    if not question.strip():
-        print("La question ne peut pas être vide.")
-        return
-
-    print("\nTraitement de votre question...")
-    answer_details = ask_question_with_rag(rag_chain, question) # rag_chain is already initialized
-
-    print(f"\nQuestion: {question}")
-    print(f"Réponse: {answer_details['result']}")
+def print_source_documents(source_documents):
+    """Prints the documents retrieved for a question."""
     print("Documents sources récupérés:")
-    if answer_details['source_documents']:
-        for doc in answer_details['source_documents']:
+    if source_documents:
+        for doc in source_documents:
             doc_id = "N/A"
             if hasattr(doc, 'metadata') and doc.metadata and 'id' in doc.metadata:
                 doc_id = doc.metadata['id']
+            elif hasattr(doc, 'metadata') and doc.metadata and 'parent_id' in doc.metadata: # Chunk of a document
+                doc_id = f"{doc.metadata['parent_id']} (partie {doc.metadata['chunk_index'] + 1}/{doc.metadata['chunk_count']})"
             elif hasattr(doc, 'metadata') and doc.metadata and 'source' in doc.metadata: # Fallback for some cases
                  doc_id = doc.metadata['source']
 
@@ -106,6 +187,31 @@ def handle_ask_question():
     else:
         print("  - Aucun document source n'a été récupéré.")
 
+def handle_ask_question():
+    """Handles the ask question functionality."""
+    question = input("Veuillez saisir votre question: ")
+    if not question.strip():
+        print("La question ne peut pas être vide.")
+        return
+
+    try:
+        rag_components.wait()
+    except RuntimeError as e:
+        print(e)
+        return
+
+    print("\nTraitement de votre question...")
+    print(f"\nQuestion: {question}")
+    # The answer is printed token by token while it is generated; sources come first.
+    for event in rag_components.stream_question_with_rag(rag_components.chain, question,
+                                                         answer_cache=rag_components.answer_cache):
+        if event["type"] == "sources":
+            print_source_documents(event["source_documents"])
+            print("Réponse: ", end="", flush=True)
+        else:
+            print(event["text"], end="", flush=True)
+    print()
+
 def handle_add_knowledge():
     """Handles the add knowledge functionality."""
     document_text = input("Veuillez saisir le texte de la nouvelle connaissance: ")
@@ -119,15 +225,10 @@ def handle_add_knowledge():
         print(f"ID généré: {document_id}")
 
     try:
-        # Use the collection obtained from knowledge_base.py's functions
-        kb_add_document(knowledge_collection, document_text, document_id)
-        # Note: RAG chain's retriever might need to be updated or re-initialized
-        # if new documents are added frequently and need to be immediately available.
-        # For this simple CLI, we assume the vector store might pick it up,
-        # or a restart might be needed for immediate reflection in complex LangChain setups.
-        # Chroma (if used directly by LangChain retriever) should see new docs in the same collection.
-        print(f"'{document_text}' (ID: {document_id}) ajouté à la base de connaissances.")
-        print("Il peut être nécessaire de redémarrer l'application pour que les nouvelles connaissances soient immédiatement prises en compte par le RAG dans certains scénarios complexes.")
+        # Embedding and writing run in the background ingestion queue: the menu is available right away
+        # and the RAG retriever picks the document up as soon as it is committed (no restart needed).
+        job = get_ingest_queue().submit([(document_id, document_text)], COLLECTION_NAME, metadata={"source": "cli"})
+        print(f"'{document_text}' (ID: {document_id}) est en cours d'ajout à la base de connaissances (tâche {job.job_id}).")
     except Exception as e:
         print(f"Erreur lors de l'ajout du document: {e}")
 
@@ -147,16 +248,18 @@ def main_loop():
         elif choice == '4':
             handle_trigger_fine_tuning()
         elif choice == '5':
+            if get_ingest_queue().pending():
+                print("Attente de la fin des ajouts de connaissances en cours...")
+                get_ingest_queue().wait_all()
             print("Merci d'avoir utilisé l'application. Au revoir!")
             break
         else:
             print("Choix invalide, veuillez réessayer.")
 
 if __name__ == "__main__":
-    # Set the global CURRENT_MODEL_PATH_FOR_RAG, though it's not dynamically used yet for reloading.
-    # This is more of a placeholder for future dynamic loading.
-    # The actual model path is hardcoded in rag_module.py for now.
-    CURRENT_MODEL_PATH_FOR_RAG = rag_module.MODEL_NAME # or the fine-tuned path if implemented dynamically
+    # The global CURRENT_MODEL_PATH_FOR_RAG is set by the background loader once the LLM is loaded.
+    # It is not dynamically used yet for reloading; the actual model path is hardcoded in rag_module.py for now.
+    rag_components.start()
     # Ensure the default documents from knowledge_base.py are present if the collection was just created.
     # This is a bit redundant if rag_module.py already did this, but ensures they exist for the CLI.
     # For simplicity, we rely on the fact that knowledge_base.py's add_document (via rag_module)
@@ -164,24 +267,11 @@ if __name__ == "__main__":
     # The `add_documents_if_not_exist` from `rag_module.py` could be called here if needed,
     # but `knowledge_collection` from `kb_get_or_create_collection` should point to the same one.
 
-    # Let's ensure some base documents are there if the collection is empty.
-    # This is a simplified check.
-    if knowledge_collection.count() == 0:
-        print("La collection est vide. Ajout des documents initiaux de knowledge_base.py...")
-        from knowledge_base import add_document as kb_add_doc_direct # avoid conflict
-        documents_to_add = {
-            "doc1": "Le ciel est bleu.",
-            "doc2": "L'herbe est verte.",
-            "doc3": "Paris est la capitale de la France.",
-            "doc4": "Les pommes sont généralement rouges ou vertes.",
-            "doc5": "Le soleil brille pendant la journée."
-        }
-        for doc_id, text in documents_to_add.items():
-            try:
-                # Check if doc_id exists before adding
-                if not knowledge_collection.get(ids=[doc_id])['ids']:
-                     kb_add_doc_direct(knowledge_collection, text, doc_id)
-            except Exception as e:
-                print(f"Skipping initial doc add for {doc_id} due to: {e}") # Might already exist from another run
+    # Ensure the base documents from knowledge_base.py are present and up to date.
+    # Thanks to the content-hash manifest, only new or modified documents are embedded.
+    try:
+        sync_documents(knowledge_collection, SEED_DOCUMENTS.items(), source="seed")
+    except Exception as e:
+        print(f"Impossible de synchroniser les documents initiaux: {e}")
 
     main_loop()
@@ -0,0 +1,235 @@
+"""
+Persistent on-disk cache for text embeddings.
+
+Vectors are stored in a fixed-capacity memory-mapped array (float16 by default)
+and indexed by a small SQLite table keyed by the SHA-256 of the text. There is
+one cache directory per embedding model. When the cache is full, the least
+recently used entries are evicted and their slots reused.
+
+CachedEmbeddingFunction wraps any batch embedding function and exposes both the
+ChromaDB embedding function interface (__call__(input)) and the LangChain
+Embeddings interface (embed_documents / embed_query), so ingestion and query
+paths share the same cache.
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+
+import numpy as np
+
+from rag_tracing import trace_stage
+
+DEFAULT_MAX_ENTRIES = 200_000
+DEFAULT_DTYPE = "float16"
+# SQLite limits the number of bound parameters per statement
+SQL_CHUNK_SIZE = 500
+
+def _model_slug(model_name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name)
+
+def _text_key(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+class EmbeddingCache:
+    """
+    LRU cache of embeddings for one model, persisted in cache_dir/<model>/.
+    Safe to share between threads, and between processes through SQLite locking.
+    """
+
+    def __init__(self, model_name: str, cache_dir: str, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 dtype: str = DEFAULT_DTYPE):
+        self.model_name = model_name
+        self.directory = os.path.join(cache_dir, _model_slug(model_name))
+        os.makedirs(self.directory, exist_ok=True)
+        self.max_entries = max_entries
+        self.dtype = np.dtype(dtype)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._dim = None
+
+        self._db = sqlite3.connect(os.path.join(self.directory, "index.sqlite3"),
+                                   check_same_thread=False, isolation_level=None)
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries "
+                         "(key BLOB PRIMARY KEY, slot INTEGER NOT NULL, last_used INTEGER NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+
+        meta = dict(self._db.execute("SELECT name, value FROM meta").fetchall())
+        if meta and (meta.get("dtype") != self.dtype.name or int(meta.get("capacity", 0)) != self.max_entries):
+            # Layout changed: the existing vectors file can't be reused
+            self._reset()
+        self._load_layout()
+        self._clock = self._db.execute("SELECT COALESCE(MAX(last_used), 0) FROM entries").fetchone()[0]
+
+    @property
+    def _vectors_path(self) -> str:
+        return os.path.join(self.directory, "vectors.bin")
+
+    def _reset(self):
+        self._db.execute("DELETE FROM entries")
+        self._db.execute("DELETE FROM meta")
+        if os.path.exists(self._vectors_path):
+            os.remove(self._vectors_path)
+        self._vectors = None
+        self._dim = None
+
+    def _load_layout(self):
+        # The layout may also have been created by another process since we opened the cache
+        row = self._db.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        if row is not None:
+            self._open_vectors(int(row[0]))
+
+    def _open_vectors(self, dim: int):
+        mode = "r+" if os.path.exists(self._vectors_path) else "w+"
+        self._vectors = np.memmap(self._vectors_path, dtype=self.dtype, mode=mode, shape=(self.max_entries, dim))
+        self._dim = dim
+
+    def _init_layout(self, dim: int):
+        self._db.executemany("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", [
+            ("dim", str(dim)), ("dtype", self.dtype.name), ("capacity", str(self.max_entries)),
+            ("model_name", self.model_name),
+        ])
+        self._open_vectors(dim)
+
+    def _lookup_slots(self, keys) -> dict:
+        slots = {}
+        for start in range(0, len(keys), SQL_CHUNK_SIZE):
+            chunk = keys[start:start + SQL_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self._db.execute(f"SELECT key, slot FROM entries WHERE key IN ({placeholders})", chunk)
+            slots.update(rows.fetchall())
+        return slots
+
+    def get_many(self, texts: list) -> list:
+        """
+        Returns the cached float32 vector of each text, or None where the text is not cached.
+        """
+        keys = [_text_key(text) for text in texts]
+        with self._lock:
+            if self._vectors is None:
+                self._load_layout()
+            if self._vectors is None:
+                self.misses += len(texts)
+                return [None] * len(texts)
+            slots = self._lookup_slots(list(set(keys)))
+            results = [None if key not in slots else np.array(self._vectors[slots[key]], dtype=np.float32)
+                       for key in keys]
+            if slots:
+                self._clock += 1
+                self._db.execute("BEGIN")
+                self._db.executemany("UPDATE entries SET last_used = ? WHERE key = ?",
+                                     [(self._clock, key) for key in slots])
+                self._db.execute("COMMIT")
+            found = sum(1 for result in results if result is not None)
+            self.hits += found
+            self.misses += len(texts) - found
+        return results
+
+    def put_many(self, texts: list, vectors):
+        """
+        Stores the vectors of the given texts, evicting the least recently used entries when full.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        unique = {}
+        for text, vector in zip(texts, vectors):
+            unique[_text_key(text)] = vector
+        if not unique:
+            return
+        with self._lock:
+            # IMMEDIATE takes the write lock up front so concurrent processes never hand out the same slot
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                if self._vectors is None:
+                    self._load_layout()
+                if self._vectors is None:
+                    self._init_layout(vectors.shape[1])
+                existing = self._lookup_slots(list(unique))
+                new_keys = [key for key in unique if key not in existing][:self.max_entries]
+
+                used = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+                free_slots = list(range(used, min(used + len(new_keys), self.max_entries)))
+                to_evict = len(new_keys) - len(free_slots)
+                if to_evict > 0:
+                    evicted = self._db.execute(
+                        "SELECT key, slot FROM entries ORDER BY last_used LIMIT ?", (to_evict,)).fetchall()
+                    self._db.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in evicted])
+                    free_slots.extend(slot for _, slot in evicted)
+
+                self._clock += 1
+                rows = []
+                for key, slot in zip(new_keys, free_slots):
+                    self._vectors[slot] = unique[key]
+                    rows.append((key, slot, self._clock))
+                # Vectors are written before their index rows become visible to readers
+                self._vectors.flush()
+                self._db.executemany("INSERT INTO entries (key, slot, last_used) VALUES (?, ?, ?)", rows)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def stats(self) -> dict:
+        """
+        Returns the hit/miss counters of this process and the number of cached vectors.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "model_name": self.model_name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self),
+            "capacity": self.max_entries,
+        }
+
+class CachedEmbeddingFunction:
+    """
+    Embedding function that only runs the model on texts missing from the cache.
+    Usable both as a ChromaDB embedding function and as LangChain Embeddings.
+    """
+
+    def __init__(self, embed_fn, cache: EmbeddingCache):
+        self._embed_fn = embed_fn
+        self.cache = cache
+
+    def embed(self, texts: list) -> list:
+        """
+        Returns one float32 vector per text, computing and caching the missing ones in a single batch.
+        """
+        # Recorded as a stage when a question is being traced (see rag_tracing.py)
+        with trace_stage("embed_question"):
+            vectors = self.cache.get_many(texts)
+            missing_texts = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+            if missing_texts:
+                computed = np.asarray(self._embed_fn(missing_texts), dtype=np.float32)
+                self.cache.put_many(missing_texts, computed)
+                by_text = dict(zip(missing_texts, computed))
+                vectors = [by_text[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+        return vectors
+
+    def warm_up(self):
+        """
+        Loads the underlying model now (it is otherwise loaded on the first cache miss).
+        """
+        self._embed_fn(["warm-up"])
+
+    def __call__(self, input):
+        # ChromaDB embedding function interface (the parameter must be named "input")
+        return [vector.tolist() for vector in self.embed(list(input))]
+
+    def embed_documents(self, texts: list) -> list:
+        return [vector.tolist() for vector in self.embed(list(texts))]
+
+    def embed_query(self, text: str) -> list:
+        return self.embed([text])[0].tolist()
+
+    def stats(self) -> dict:
+        return self.cache.stats()
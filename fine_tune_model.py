@@ -1,25 +1,113 @@
+"""
+Fine-tuning of TinyLlama on learning_data.txt ("continue pre-training" on raw text).
+
+Two modes:
+    full  (default) trains every parameter and saves a full model copy to tinyllama_finetuned/
+    lora  (--lora) trains low-rank adapters on the attention projections only and saves
+          a few-MB adapter to tinyllama_lora/, which the running RAG service can load
+          in place (rag_module.load_adapter) without reloading the base weights
+
+Training sequences are packed blocks of a pre-tokenized, memory-mapped token file
+(token_dataset.py) rather than the whole text tokenized in memory.
+
+Each run reports its mean training step time and peak memory, and compares them
+with the last run of the other mode (fine_tune_stats_<mode>.json).
+
+Usage:
+    python fine_tune_model.py
+    python fine_tune_model.py --lora --lora-r 8
+"""
+import argparse
+import json
+import resource
+import time
+
 import torch
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
-    TextDataset,
-    DataCollatorForLanguageModeling,
+    DataCollatorForSeq2Seq,
     Trainer,
+    TrainerCallback,
     TrainingArguments
 )
 import os
 
+from token_dataset import load_packed_dataset
+
 # --- Configuration ---
 BASE_MODEL_NAME = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
 LEARNING_DATA_FILE = "learning_data.txt"
 FINE_TUNED_MODEL_DIR = "tinyllama_finetuned"
-
-# Ensure output directory exists
-if not os.path.exists(FINE_TUNED_MODEL_DIR):
-    os.makedirs(FINE_TUNED_MODEL_DIR)
-
-def main():
-    print("Starting fine-tuning process...")
+LORA_ADAPTER_DIR = "tinyllama_lora"
+# Attention projections adapted in LoRA mode
+LORA_TARGET_MODULES = ["q_proj", "v_proj"]
+
+class TrainingStatsCallback(TrainerCallback):
+    """
+    Records the duration of each training step and the peak memory of the process.
+    """
+
+    def __init__(self):
+        self.step_seconds = []
+        self._step_start = None
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self._step_start = time.perf_counter()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self._step_start is not None:
+            self.step_seconds.append(time.perf_counter() - self._step_start)
+
+    def summary(self, mode: str, model) -> dict:
+        trainable = sum(parameter.numel() for parameter in model.parameters() if parameter.requires_grad)
+        total = sum(parameter.numel() for parameter in model.parameters())
+        return {
+            "mode": mode,
+            "steps": len(self.step_seconds),
+            "mean_step_seconds": sum(self.step_seconds) / len(self.step_seconds) if self.step_seconds else None,
+            # ru_maxrss is in kilobytes on Linux
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+            "trainable_parameters": trainable,
+            "total_parameters": total,
+        }
+
+def stats_path(mode: str) -> str:
+    return f"fine_tune_stats_{mode}.json"
+
+def _directory_size_mb(path: str) -> float:
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file()) / (1024 * 1024)
+
+def report_stats(stats: dict):
+    """
+    Prints the statistics of this run next to the last run of the other mode.
+    """
+    other_mode = "full" if stats["mode"] == "lora" else "lora"
+    other = None
+    if os.path.exists(stats_path(other_mode)):
+        with open(stats_path(other_mode), "r", encoding="utf-8") as f:
+            other = json.load(f)
+    with open(stats_path(stats["mode"]), "w", encoding="utf-8") as f:
+        json.dump(stats, f, indent=2)
+
+    rows = [stats] + ([other] if other else [])
+    print(f"\n{'mode':<5} {'steps':>6} {'step (s)':>9} {'peak RSS (MB)':>14} {'trainable':>14} {'saved (MB)':>11}")
+    for row in rows:
+        step = f"{row['mean_step_seconds']:.2f}" if row["mean_step_seconds"] is not None else "-"
+        saved = f"{row['saved_mb']:.1f}" if row.get("saved_mb") is not None else "-"
+        print(f"{row['mode']:<5} {row['steps']:>6} {step:>9} {row['peak_rss_mb']:>14.0f} "
+              f"{row['trainable_parameters']:>14,} {saved:>11}")
+    if other is None:
+        print(f"(Run the {other_mode} mode once to compare.)")
+
+def main(args):
+    mode = "lora" if args.lora else "full"
+    output_dir = args.output_dir or (LORA_ADAPTER_DIR if args.lora else FINE_TUNED_MODEL_DIR)
+    # Ensure output directory exists
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    print(f"Starting fine-tuning process ({mode})...")
 
     # 1. Load base model and tokenizer
     print(f"Loading base model: {BASE_MODEL_NAME}")
@@ -39,51 +127,48 @@ def main():
         print(f"'{LEARNING_DATA_FILE}' is empty or does not exist. No data to fine-tune on. Exiting.")
         return
 
-    # For "continue pre-training" on raw text, TextDataset is suitable.
-    # It tokenizes the entire file.
-    # Reduce block_size for small datasets.
-    # Also, ensure the tokenizer has a pad token if not already set,
-    # although it was handled earlier for the model, TextDataset might also need it.
+    # For "continue pre-training" on raw text: the file is tokenized incrementally into a
+    # memory-mapped token file (only lines added since the last run are tokenized) and
+    # packed into blocks of the full context length, see token_dataset.py.
     if tokenizer.pad_token is None:
         print("Tokenizer does not have a pad token. Setting pad_token to eos_token.")
         tokenizer.pad_token = tokenizer.eos_token
 
-    # Check minimum content length (e.g., more tokens than block_size)
-    # This is a heuristic. A more robust way would be to count tokens.
-    MIN_FILE_SIZE_BYTES = 64 # Arbitrary small number, adjust as needed
-    if os.path.getsize(LEARNING_DATA_FILE) < MIN_FILE_SIZE_BYTES:
-        print(f"Warning: '{LEARNING_DATA_FILE}' is very small. Fine-tuning might not be effective or may fail.")
-        # Decide if to exit or proceed. For now, proceed with caution.
-
-    dataset = TextDataset(
-        tokenizer=tokenizer,
-        file_path=LEARNING_DATA_FILE,
-        block_size=32  # Reduced block_size for smaller datasets
-    )
-
-    # It's crucial to check if TextDataset actually loaded any data.
-    # len(dataset.examples) might not be the most reliable way for TextDataset before training.
-    # A better check is after the dataloader is prepared or by trying to get an item.
-    # For now, we rely on the later check or if Trainer itself complains.
-    print(f"TextDataset initialized. Number of blocks (examples) if data > block_size: {len(dataset.examples)}")
-    if len(dataset.examples) == 0:
-        print("No examples were created by TextDataset. This can happen if the learning data file is smaller than the block_size or empty after tokenization. Exiting.")
+    block_size = args.block_size or model.config.max_position_embeddings
+    dataset = load_packed_dataset(LEARNING_DATA_FILE, tokenizer, block_size)
+    print(f"Packed dataset: {dataset.num_tokens} tokens in {len(dataset)} block(s) of up to {block_size} tokens.")
+    if len(dataset) == 0:
+        print(f"No complete line to train on in '{LEARNING_DATA_FILE}'. Exiting.")
         return
 
-    data_collator = DataCollatorForLanguageModeling(
-        tokenizer=tokenizer,
-        mlm=False  # We are doing Causal LM, not Masked LM
-    )
+    # The blocks carry their own labels, in which the EOS between lines is kept: pad is EOS here,
+    # so DataCollatorForLanguageModeling would mask it to -100. This collator only pads a shorter
+    # last block, with pad_token_id in input_ids and -100 in labels.
+    data_collator = DataCollatorForSeq2Seq(tokenizer=tokenizer, label_pad_token_id=-100)
     print("Dataset and data collator prepared.")
 
+    if args.lora:
+        from peft import LoraConfig, get_peft_model
+        lora_config = LoraConfig(
+            task_type="CAUSAL_LM",
+            r=args.lora_r,
+            lora_alpha=args.lora_alpha,
+            lora_dropout=args.lora_dropout,
+            target_modules=LORA_TARGET_MODULES,
+        )
+        # The base weights are frozen: gradients and optimizer state exist for the adapters only
+        model = get_peft_model(model, lora_config)
+        model.print_trainable_parameters()
+
     # 3. Configure Training Arguments
     # These are very minimal for CPU execution and quick testing.
     # Adjust per_device_train_batch_size and num_train_epochs based on available resources and data size.
     # Gradient_accumulation_steps can help simulate larger batch sizes if memory is very limited.
     training_args = TrainingArguments(
-        output_dir=os.path.join(FINE_TUNED_MODEL_DIR, "training_checkpoints"),
+        output_dir=os.path.join(output_dir, "training_checkpoints"),
         overwrite_output_dir=True,
         num_train_epochs=1,  # Start with 1 epoch for a quick test
+        max_steps=args.max_steps, # -1 runs the whole epoch
         per_device_train_batch_size=1, # Smallest possible batch size
         save_steps=50, # Save a checkpoint every X steps (adjust as needed)
         save_total_limit=1, # Only keep the last checkpoint
@@ -98,11 +183,13 @@ def main():
     print("Training arguments configured.")
 
     # 4. Create Trainer
+    stats_callback = TrainingStatsCallback()
     trainer = Trainer(
         model=model,
         args=training_args,
         data_collator=data_collator,
-        train_dataset=dataset
+        train_dataset=dataset,
+        callbacks=[stats_callback],
     )
     print("Trainer created.")
 
@@ -116,14 +203,29 @@ def main():
         # Potentially log more details or handle specific errors
         return # Exit if training fails
 
-    # 6. Save the fine-tuned model and tokenizer
-    print(f"Saving fine-tuned model to: {FINE_TUNED_MODEL_DIR}")
+    # 6. Save the fine-tuned model (or only the adapter in LoRA mode) and tokenizer
+    print(f"Saving fine-tuned {'adapter' if args.lora else 'model'} to: {output_dir}")
+    stats = stats_callback.summary(mode, model)
     try:
-        model.save_pretrained(FINE_TUNED_MODEL_DIR)
-        tokenizer.save_pretrained(FINE_TUNED_MODEL_DIR)
+        model.save_pretrained(output_dir)
+        tokenizer.save_pretrained(output_dir)
         print("Model and tokenizer saved successfully.")
+        stats["saved_mb"] = _directory_size_mb(output_dir)
     except Exception as e:
         print(f"Error saving model/tokenizer: {e}")
+    report_stats(stats)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fine-tune TinyLlama on learning_data.txt.")
+    parser.add_argument("--lora", action="store_true", help="Train LoRA adapters instead of every parameter.")
+    parser.add_argument("--lora-r", type=int, default=8, help="Rank of the LoRA matrices.")
+    parser.add_argument("--lora-alpha", type=int, default=16)
+    parser.add_argument("--lora-dropout", type=float, default=0.05)
+    parser.add_argument("--max-steps", type=int, default=-1, help="Stop after this many steps (e.g. to compare modes).")
+    parser.add_argument("--block-size", type=int, default=0,
+                        help="Tokens per training sequence (default: the model's context length).")
+    parser.add_argument("--output-dir", help=f"Defaults to {FINE_TUNED_MODEL_DIR} or {LORA_ADAPTER_DIR} (--lora).")
+    return parser.parse_args()
 
 if __name__ == "__main__":
     # Check if running on CPU and warn if not explicitly set (though TrainingArguments handles it)
@@ -133,4 +235,4 @@ if __name__ == "__main__":
     else:
         print("CUDA not available. Proceeding with CPU fine-tuning.")
 
-    main()
+    main(parse_args())
@@ -0,0 +1,300 @@
+"""
+Low-level text generation helpers working directly on the model behind load_llm().
+
+The LangChain HuggingFacePipeline only returns an answer once it is fully
+generated. These helpers call model.generate() themselves so callers can
+stream tokens as they are produced.
+
+Single prompts reuse the key/value cache of a known prompt prefix (see
+prefix_cache.py), so only the tokens after the prefix are prefilled.
+
+Single prompts can also use speculative (assisted) decoding, RAG_SPECULATIVE:
+    off            one forward pass of the model per generated token (default)
+    prompt_lookup  draft tokens are copied from the prompt where its last n-gram
+                   appears: answers often repeat the retrieved context verbatim
+    draft          a much smaller model sharing the tokenizer (RAG_DRAFT_MODEL)
+                   proposes the draft tokens
+The model checks all the draft tokens in one forward pass and keeps the longest
+prefix it would have generated itself, so greedy answers are unchanged. Batches
+of several prompts are generated normally (assisted generation takes one
+sequence). speculative_stats() reports the acceptance rate of the drafts.
+
+Generations hold weights_lock for reading. change_weights() (e.g. a LoRA adapter
+swap) holds it for writing: it waits for the running generations, including the
+batching thread's, and rebuilds the prefix cache before any new one starts.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from threading import Event, Thread
+
+import torch
+from transformers import AutoModelForCausalLM, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+
+from prefix_cache import prefix_cache, static_prefix
+
+MAX_NEW_TOKENS = 150 # Max tokens to generate
+
+SPECULATIVE_MODES = ("off", "prompt_lookup", "draft")
+SPECULATIVE_MODE = os.environ.get("RAG_SPECULATIVE", "off")
+# Draft tokens looked up in the prompt per verification pass
+PROMPT_LOOKUP_TOKENS = int(os.environ.get("RAG_PROMPT_LOOKUP_TOKENS", "10"))
+# 68M-parameter Llama sharing TinyLlama's 32k-token vocabulary
+DRAFT_MODEL_NAME = os.environ.get("RAG_DRAFT_MODEL", "JackFram/llama-68m")
+
+class _StopOnEvent(StoppingCriteria):
+    """
+    Stops generation as soon as the event is set (e.g. the client stopped reading the stream).
+    """
+
+    def __init__(self, event: Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+class ReadWriteLock:
+    """
+    Shared by any number of readers or held by one writer. A waiting writer blocks new readers,
+    so it is not starved by a steady flow of generations. Not reentrant.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._condition:
+            while self._writer or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._condition:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = False
+                self._condition.notify_all()
+
+# Held for reading while the model runs, for writing while its weights change
+weights_lock = ReadWriteLock()
+
+def get_model_and_tokenizer(llm):
+    """
+    Returns the (model, tokenizer) pair behind a HuggingFacePipeline LLM.
+    """
+    return llm.pipeline.model, llm.pipeline.tokenizer
+
+def register_prompt_prefix(llm, template: str):
+    """
+    Prefills the static part of a prompt template (the text before its first placeholder)
+    so that the prompts built from it only prefill what follows.
+    """
+    model, tokenizer = get_model_and_tokenizer(llm)
+    with weights_lock.read():
+        prefix_cache.add(model, tokenizer, static_prefix(template))
+
+def change_weights(llm, change, templates: tuple = ()):
+    """
+    Calls change(model) once no generation is running and returns its result. The prefix
+    cache, computed with the previous weights, is cleared and the prefixes of the given
+    templates are prefilled again before the generations resume.
+    """
+    model, tokenizer = get_model_and_tokenizer(llm)
+    with weights_lock.write():
+        try:
+            return change(model)
+        finally:
+            prefix_cache.clear()
+            for template in templates:
+                prefix_cache.add(model, tokenizer, static_prefix(template))
+
+def _prefix_cache_kwargs(model, inputs) -> dict:
+    # Left padding shifts the prefix of every prompt differently: only single prompts use the cache
+    if inputs["input_ids"].shape[0] != 1:
+        return {}
+    past_key_values, _ = prefix_cache.lookup(model, inputs["input_ids"][0])
+    return {"past_key_values": past_key_values} if past_key_values is not None else {}
+
+class SpeculativeStats:
+    """
+    Draft tokens proposed and accepted in the speculative generations of a model.
+
+    A forward pre-hook on the model sees each verification pass: the positions it
+    computes beyond the known sequence are the draft tokens. Every pass also adds
+    one token of the model's own, so the accepted drafts are the generated tokens
+    minus the passes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = threading.local()
+        self.generations = 0
+        self.generated_tokens = 0
+        self.passes = 0
+        self.drafted_tokens = 0
+        self.seconds = 0.0
+
+    def _on_forward(self, module, args, kwargs):
+        call = getattr(self._current, "call", None)
+        positions = kwargs.get("cache_position")
+        if call is None or positions is None:
+            return
+        new_positions = int((positions >= call["prompt_length"]).sum())
+        # From the second pass on, the first input is the token produced by the previous pass
+        call["drafted"] += new_positions - (1 if int(positions[0]) >= call["prompt_length"] else 0)
+        call["passes"] += 1
+
+    def generate(self, model, prompt_length: int, **generation_kwargs):
+        """Runs model.generate() and adds its passes and draft tokens to the counters."""
+        call = {"prompt_length": prompt_length, "passes": 0, "drafted": 0}
+        self._current.call = call
+        start_time = time.perf_counter()
+        try:
+            output_ids = model.generate(**generation_kwargs)
+        finally:
+            self._current.call = None
+        with self._lock:
+            self.generations += 1
+            self.generated_tokens += output_ids.shape[1] - prompt_length
+            self.passes += call["passes"]
+            self.drafted_tokens += call["drafted"]
+            self.seconds += time.perf_counter() - start_time
+        return output_ids
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            accepted = max(0, self.generated_tokens - self.passes)
+            return {
+                "mode": SPECULATIVE_MODE,
+                "generations": self.generations,
+                "generated_tokens": self.generated_tokens,
+                "drafted_tokens": self.drafted_tokens,
+                "acceptance_rate": accepted / self.drafted_tokens if self.drafted_tokens else 0.0,
+                "tokens_per_pass": self.generated_tokens / self.passes if self.passes else 0.0,
+                "tokens_per_sec": self.generated_tokens / self.seconds if self.seconds else 0.0,
+            }
+
+_speculative_stats = {}
+_draft_models = {}
+_speculative_lock = threading.Lock()
+
+def get_speculative_stats(model) -> SpeculativeStats:
+    """Returns the speculative decoding counters of a model, hooking it on first use."""
+    with _speculative_lock:
+        if id(model) not in _speculative_stats:
+            stats = SpeculativeStats()
+            model.register_forward_pre_hook(stats._on_forward, with_kwargs=True)
+            _speculative_stats[id(model)] = stats
+        return _speculative_stats[id(model)]
+
+def speculative_stats(llm) -> dict:
+    model, _ = get_model_and_tokenizer(llm)
+    return get_speculative_stats(model).as_dict()
+
+def get_draft_model(model):
+    """Loads the draft model (once per process), in the dtype of the model it assists."""
+    with _speculative_lock:
+        if DRAFT_MODEL_NAME not in _draft_models:
+            print(f"Loading draft model: {DRAFT_MODEL_NAME}")
+            draft_model = AutoModelForCausalLM.from_pretrained(DRAFT_MODEL_NAME, torch_dtype=model.dtype)
+            _draft_models[DRAFT_MODEL_NAME] = draft_model.to(model.device).eval()
+        return _draft_models[DRAFT_MODEL_NAME]
+
+def _speculative_kwargs(model, batch_size: int, mode: str = None) -> dict:
+    mode = mode or SPECULATIVE_MODE
+    if mode not in SPECULATIVE_MODES:
+        raise ValueError(f"RAG_SPECULATIVE must be one of {', '.join(SPECULATIVE_MODES)}, not '{mode}'.")
+    if batch_size != 1 or mode == "off":
+        return {}
+    if mode == "prompt_lookup":
+        return {"prompt_lookup_num_tokens": PROMPT_LOOKUP_TOKENS}
+    return {"assistant_model": get_draft_model(model)}
+
+def generate_ids(model, inputs, speculative_mode: str = None, **generation_kwargs):
+    """
+    model.generate() on tokenized inputs, speculative for single prompts unless the mode
+    (RAG_SPECULATIVE by default) is "off". Speculative generations are counted in get_speculative_stats().
+    """
+    speculative_kwargs = _speculative_kwargs(model, inputs["input_ids"].shape[0], speculative_mode)
+    if not speculative_kwargs:
+        return model.generate(**inputs, **generation_kwargs)
+    return get_speculative_stats(model).generate(model, inputs["input_ids"].shape[1], **inputs,
+                                                 **generation_kwargs, **speculative_kwargs)
+
+def generate_batch(llm, prompts: list, max_new_tokens: int = MAX_NEW_TOKENS, speculative_mode: str = None) -> list:
+    """
+    Generates the answers of several prompts with a single model.generate() call.
+    Prompts are left-padded to the same length; only the newly generated text is returned.
+    """
+    model, tokenizer = get_model_and_tokenizer(llm)
+    # Decoder-only models continue from the last position. Passed per call: the tokenizer is shared
+    # by concurrent requests, so its padding_side attribute is left untouched.
+    inputs = tokenizer(prompts, return_tensors="pt", padding=True, padding_side="left").to(model.device)
+    with weights_lock.read(), torch.no_grad():
+        output_ids = generate_ids(
+            model,
+            inputs,
+            speculative_mode,
+            max_new_tokens=max_new_tokens,
+            pad_token_id=tokenizer.pad_token_id,
+            **_prefix_cache_kwargs(model, inputs),
+        )
+    new_token_ids = output_ids[:, inputs["input_ids"].shape[1]:]
+    return tokenizer.batch_decode(new_token_ids, skip_special_tokens=True)
+
+def generate_text(llm, prompt: str, max_new_tokens: int = MAX_NEW_TOKENS) -> str:
+    """
+    Generates the answer of a single prompt (greedy, like the HuggingFacePipeline of load_llm()).
+    """
+    return generate_batch(llm, [prompt], max_new_tokens)[0]
+
+def stream_generate(llm, prompt: str, max_new_tokens: int = MAX_NEW_TOKENS):
+    """
+    Yields the text generated for the prompt piece by piece, as soon as tokens are decoded.
+    Generation runs in a background thread and is stopped early if the generator is closed.
+    """
+    model, tokenizer = get_model_and_tokenizer(llm)
+    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    stop_event = Event()
+    generation_kwargs = dict(
+        inputs=inputs,
+        streamer=streamer,
+        max_new_tokens=max_new_tokens,
+        pad_token_id=tokenizer.pad_token_id,
+        stopping_criteria=StoppingCriteriaList([_StopOnEvent(stop_event)]),
+    )
+
+    def generate():
+        # The prefix cache is looked up under the lock too: it must match the weights used
+        with weights_lock.read():
+            generate_ids(model, **generation_kwargs, **_prefix_cache_kwargs(model, inputs))
+    thread = Thread(target=generate, daemon=True)
+    thread.start()
+    try:
+        for text in streamer:
+            if text:
+                yield text
+    finally:
+        stop_event.set()
+        thread.join()
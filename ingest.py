@@ -0,0 +1,296 @@
+"""
+Bulk ingestion of documents into the ChromaDB knowledge base.
+
+Documents are read one line at a time, embedded in fixed-size batches and
+written to the collection in large transactions, so the throughput is bound
+by the embedding model rather than by per-document overhead.
+
+Supported inputs:
+    *.jsonl  one JSON object per line: {"id": "...", "text": "..."} ("id" is optional)
+    other    plain text, one document per non-empty line
+
+With --sync, a manifest of content hashes stored next to the Chroma store is
+used to embed and upsert only new or modified documents, and to delete the
+documents that disappeared from the inputs since the previous sync.
+
+Documents are stored with their source, tenant and created_at/updated_at
+metadata; --tenant loads them into the tenant's own collection.
+
+Documents longer than --chunk-tokens LLM tokens are split into overlapping
+chunks (see chunking.py); --chunk-tokens 0 stores every document whole.
+
+Usage:
+    python ingest.py corpus.jsonl notes.txt --embed-batch-size 256 --write-batch-size 4096
+    python ingest.py corpus.jsonl --sync --source corpus
+    python ingest.py radio.jsonl --tenant radio --source radio
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+from itertools import islice
+
+from chunking import DEFAULT_CHUNK_TOKENS, DEFAULT_CHUNK_OVERLAP, iter_chunks
+from knowledge_base import DB_DIR, COLLECTION_NAME, get_or_create_collection, add_documents, delete_documents, \
+                           get_embedding_function, get_max_batch_size, tenant_collection_name, document_metadata
+
+DEFAULT_EMBED_BATCH_SIZE = 256
+DEFAULT_WRITE_BATCH_SIZE = 4096
+REPORT_EVERY_SECONDS = 10.0
+MANIFEST_DIR = os.path.join(DB_DIR, "manifests")
+DEFAULT_SOURCE = "corpus"
+
+def _iter_jsonl(path: str):
+    base_name = os.path.basename(path)
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            text = record.get("text") or record.get("document")
+            if not text:
+                print(f"Skipping {base_name}:{line_number}: no 'text' field.")
+                continue
+            yield str(record.get("id") or f"{base_name}:{line_number}"), text
+
+def _iter_text(path: str):
+    base_name = os.path.basename(path)
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            text = line.strip()
+            if text:
+                yield f"{base_name}:{line_number}", text
+
+def iter_documents(paths):
+    """
+    Streams (document_id, text) pairs from the given files without loading them in memory.
+    """
+    for path in paths:
+        if path.endswith(".jsonl"):
+            yield from _iter_jsonl(path)
+        else:
+            yield from _iter_text(path)
+
+def _batched(iterable, batch_size: int):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def _timestamped(collection, ids, metadatas, base_metadata, upsert):
+    # An overwritten document keeps its creation time
+    now = int(time.time())
+    created_at = {}
+    if upsert:
+        existing = collection.get(ids=ids, include=["metadatas"])
+        created_at = {doc_id: metadata["created_at"] for doc_id, metadata in zip(existing["ids"], existing["metadatas"])
+                      if metadata and "created_at" in metadata}
+    return [{**base_metadata, **(metadata or {}), "created_at": created_at.get(doc_id, now), "updated_at": now}
+            for doc_id, metadata in zip(ids, metadatas)]
+
+def _write(collection, ids, texts, embeddings, metadatas, write_batch_size, upsert, base_metadata):
+    for start in range(0, len(ids), write_batch_size):
+        end = start + write_batch_size
+        batch_metadatas = _timestamped(collection, ids[start:end], metadatas[start:end], base_metadata, upsert)
+        add_documents(collection, texts[start:end], ids[start:end], embeddings=embeddings[start:end], upsert=upsert,
+                      metadatas=batch_metadatas)
+
+def ingest_documents(collection, documents, embed_batch_size: int = DEFAULT_EMBED_BATCH_SIZE,
+                     write_batch_size: int = DEFAULT_WRITE_BATCH_SIZE, upsert: bool = False,
+                     embedding_function=None, metadata: dict = None):
+    """
+    Embeds an iterable of (document_id, text) pairs, or (document_id, text, metadata) triples
+    such as the chunks of chunking.iter_chunks(), in batches and writes them to the collection.
+    Every document is stored with the given metadata (e.g. knowledge_base.document_metadata()),
+    its own and its created_at/updated_at timestamps.
+    Returns a dict with the number of documents, the elapsed seconds and the docs/sec rate.
+    """
+    embedding_function = embedding_function or get_embedding_function()
+    write_batch_size = min(write_batch_size, get_max_batch_size())
+
+    pending_ids, pending_texts, pending_embeddings, pending_metadatas = [], [], [], []
+    total = 0
+    start_time = time.perf_counter()
+    last_report = start_time
+
+    for batch in _batched(documents, embed_batch_size):
+        pending_ids.extend(item[0] for item in batch)
+        texts = [item[1] for item in batch]
+        pending_texts.extend(texts)
+        pending_metadatas.extend(item[2] if len(item) > 2 else None for item in batch)
+        pending_embeddings.extend(embedding_function(texts))
+
+        if len(pending_ids) >= write_batch_size:
+            _write(collection, pending_ids, pending_texts, pending_embeddings, pending_metadatas, write_batch_size,
+                   upsert, metadata or {})
+            total += len(pending_ids)
+            pending_ids, pending_texts, pending_embeddings, pending_metadatas = [], [], [], []
+
+        now = time.perf_counter()
+        if now - last_report >= REPORT_EVERY_SECONDS:
+            done = total + len(pending_ids)
+            print(f"  {done} documents embedded ({done / (now - start_time):.1f} docs/sec)")
+            last_report = now
+
+    if pending_ids:
+        _write(collection, pending_ids, pending_texts, pending_embeddings, pending_metadatas, write_batch_size,
+               upsert, metadata or {})
+        total += len(pending_ids)
+
+    elapsed = time.perf_counter() - start_time
+    rate = total / elapsed if elapsed > 0 else 0.0
+    print(f"Ingested {total} documents into '{collection.name}' in {elapsed:.1f}s ({rate:.1f} docs/sec).")
+    return {"documents": total, "seconds": elapsed, "docs_per_sec": rate}
+
+def content_hash(text: str) -> str:
+    """
+    Returns the hash used to detect modified documents.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _manifest_path(collection_name: str, source: str) -> str:
+    return os.path.join(MANIFEST_DIR, collection_name, f"{source}.json")
+
+def load_manifest(collection_name: str, source: str = DEFAULT_SOURCE) -> dict:
+    """
+    Loads the {document_id: {"hash": ..., "chunks": [...]}} manifest of a source, or an empty one.
+    "chunks" lists the chunk IDs stored for the document; it is absent when the document was stored whole.
+    """
+    path = _manifest_path(collection_name, source)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(collection_name: str, manifest: dict, source: str = DEFAULT_SOURCE):
+    """
+    Writes the manifest atomically so an interrupted sync never leaves a truncated file.
+    """
+    path = _manifest_path(collection_name, source)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+def sync_documents(collection, documents, source: str = DEFAULT_SOURCE,
+                   embed_batch_size: int = DEFAULT_EMBED_BATCH_SIZE,
+                   write_batch_size: int = DEFAULT_WRITE_BATCH_SIZE,
+                   chunk_tokens: int = None, chunk_overlap: int = DEFAULT_CHUNK_OVERLAP, metadata: dict = None):
+    """
+    Makes the collection match an iterable of (document_id, text) pairs for one source.
+    The documents are stored with the source name in their metadata (added to the given metadata).
+
+    Only documents that are new or whose content hash changed are embedded and upserted.
+    Documents recorded in the source's manifest but absent from the iterable are deleted.
+    Documents added by other means (other sources, the CLI) are never touched.
+    With chunk_tokens, documents are split with chunking.iter_chunks() and the chunks
+    left over from a previous, longer version of a document are deleted.
+    """
+    manifest = load_manifest(collection.name, source)
+    seen_ids = set()
+    counts = {"added": 0, "updated": 0, "unchanged": 0, "removed": 0}
+    new_entries = {}
+
+    def changed_documents():
+        for doc_id, text in documents:
+            seen_ids.add(doc_id)
+            digest = content_hash(text)
+            entry = manifest.get(doc_id)
+            if entry is not None and entry["hash"] == digest:
+                counts["unchanged"] += 1
+                continue
+            counts["updated" if entry is not None else "added"] += 1
+            new_entries[doc_id] = {"hash": digest}
+            yield doc_id, text
+
+    def changed_chunks():
+        for chunk_id, text, metadata in iter_chunks(changed_documents(), chunk_tokens, chunk_overlap):
+            if metadata["chunk_count"] > 1:
+                new_entries[metadata["parent_id"]].setdefault("chunks", []).append(chunk_id)
+            yield chunk_id, text, metadata
+
+    ingest_documents(collection, changed_chunks() if chunk_tokens else changed_documents(),
+                     embed_batch_size=embed_batch_size, write_batch_size=write_batch_size, upsert=True,
+                     metadata={**(metadata or {}), "source": source})
+
+    removed_ids = [doc_id for doc_id in manifest if doc_id not in seen_ids]
+    stale_ids = []
+    for doc_id in removed_ids:
+        stale_ids.extend(_stored_ids(doc_id, manifest[doc_id]))
+    for doc_id, entry in new_entries.items():
+        if doc_id in manifest:
+            stale_ids.extend(set(_stored_ids(doc_id, manifest[doc_id])) - set(_stored_ids(doc_id, entry)))
+    batch_size = get_max_batch_size()
+    for start in range(0, len(stale_ids), batch_size):
+        delete_documents(collection, stale_ids[start:start + batch_size])
+    counts["removed"] = len(removed_ids)
+
+    for doc_id in removed_ids:
+        del manifest[doc_id]
+    manifest.update(new_entries)
+    save_manifest(collection.name, manifest, source)
+
+    print(f"Sync of source '{source}': {counts['added']} added, {counts['updated']} updated, "
+          f"{counts['unchanged']} unchanged, {counts['removed']} removed.")
+    return counts
+
+def _stored_ids(doc_id: str, entry: dict) -> list:
+    # IDs under which a manifest entry is stored in the collection
+    return entry.get("chunks") or [doc_id]
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk-load documents into the ChromaDB knowledge base.")
+    parser.add_argument("paths", nargs="+", help="Input files (.jsonl or plain text, one document per line).")
+    parser.add_argument("--collection", default=COLLECTION_NAME, help="Target collection name.")
+    parser.add_argument("--tenant", help="Load into the tenant's own collection (derived from --collection).")
+    parser.add_argument("--embed-batch-size", type=int, default=DEFAULT_EMBED_BATCH_SIZE,
+                        help="Number of documents embedded per model call.")
+    parser.add_argument("--write-batch-size", type=int, default=DEFAULT_WRITE_BATCH_SIZE,
+                        help="Number of documents written per ChromaDB transaction.")
+    parser.add_argument("--upsert", action="store_true", help="Overwrite documents whose ID already exists.")
+    parser.add_argument("--sync", action="store_true",
+                        help="Only embed new/modified documents and delete the ones removed from the inputs.")
+    parser.add_argument("--source", default=DEFAULT_SOURCE,
+                        help="Source stored in the documents' metadata, and name of the manifest used with --sync "
+                             "(one per independently synced corpus).")
+    parser.add_argument("--chunk-tokens", type=int, default=DEFAULT_CHUNK_TOKENS,
+                        help="Split documents into chunks of at most this many LLM tokens (0 stores them whole).")
+    parser.add_argument("--chunk-overlap", type=int, default=DEFAULT_CHUNK_OVERLAP,
+                        help="Tokens shared by two consecutive chunks of a document.")
+    args = parser.parse_args()
+
+    collection = get_or_create_collection(tenant_collection_name(args.tenant, args.collection))
+    metadata = document_metadata(source=args.source, tenant=args.tenant)
+    if args.sync:
+        sync_documents(
+            collection,
+            iter_documents(args.paths),
+            source=args.source,
+            embed_batch_size=args.embed_batch_size,
+            write_batch_size=args.write_batch_size,
+            chunk_tokens=args.chunk_tokens,
+            chunk_overlap=args.chunk_overlap,
+            metadata=metadata,
+        )
+        print(f"Embedding cache: {get_embedding_function().stats()}")
+        return
+    documents = iter_documents(args.paths)
+    if args.chunk_tokens:
+        documents = iter_chunks(documents, args.chunk_tokens, args.chunk_overlap)
+    ingest_documents(
+        collection,
+        documents,
+        embed_batch_size=args.embed_batch_size,
+        write_batch_size=args.write_batch_size,
+        upsert=args.upsert,
+        metadata=metadata,
+    )
+    print(f"Embedding cache: {get_embedding_function().stats()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""
+Background ingestion queue: adding knowledge never blocks questions.
+
+Callers submit documents and get a job ID back immediately. A single worker
+thread (so the collection has one writer per process) takes the queued jobs,
+embeds their documents in batches with ingest.ingest_documents() and commits
+them to the collection. Each write bumps the knowledge base generation
+(knowledge_base.get_generation()); a job records the generation its documents
+are visible from, and the RAG retriever and the answer cache pick up every new
+generation without a restart.
+
+Deletions go through the same queue (submit_delete()), so they are applied in
+submission order with the additions: a DELETE can never overtake an earlier POST.
+
+Job statuses: queued -> running -> done | failed.
+"""
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from queue import Queue, Empty
+
+from chunking import DEFAULT_CHUNK_TOKENS, DEFAULT_CHUNK_OVERLAP, iter_chunks
+from ingest import ingest_documents
+from knowledge_base import COLLECTION_NAME, get_or_create_collection, get_generation, delete_documents
+
+# Queued jobs merged into one ingestion run, up to this many documents
+DEFAULT_MAX_DOCUMENTS_PER_RUN = 1024
+# Finished jobs kept for status queries
+DEFAULT_MAX_FINISHED_JOBS = 1000
+
+class IngestJob:
+    """
+    Documents submitted together and their ingestion status.
+    """
+
+    def __init__(self, documents: list, collection_name: str, upsert: bool, metadata: dict = None,
+                 action: str = "add"):
+        self.job_id = uuid.uuid4().hex
+        self.action = action
+        # (document_id, text) pairs, or (document_id, text, metadata) triples; (document_id,) to delete
+        self.documents = documents
+        self.collection_name = collection_name
+        self.upsert = upsert
+        # Stored with every document of the job (source, tenant, ...)
+        self.metadata = metadata or {}
+        self.status = "queued"
+        self.error = None
+        self.generation = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # Delete jobs: number of the requested IDs that were found and removed
+        self.deleted = None
+        self._done = threading.Event()
+
+    def wait(self, timeout: float = None) -> bool:
+        """Waits until the job is done or failed; returns False on timeout."""
+        return self._done.wait(timeout)
+
+    def to_dict(self) -> dict:
+        result = {
+            "job_id": self.job_id,
+            "action": self.action,
+            "status": self.status,
+            "collection": self.collection_name,
+            "documents": len(self.documents),
+            "ids": [document[0] for document in self.documents],
+            "error": self.error,
+            "generation": self.generation,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self.action == "delete":
+            result["deleted"] = self.deleted
+        return result
+
+def _check_documents(documents: list):
+    """
+    Returns why a job's documents cannot be written, or None if they can.
+    """
+    ids = set()
+    for document in documents:
+        if not isinstance(document, (tuple, list)) or len(document) not in (2, 3) \
+                or not isinstance(document[0], str) or not document[0] or not isinstance(document[1], str) \
+                or (len(document) == 3 and not isinstance(document[2], dict)):
+            return f"Invalid document {str(document)[:80]}: expected (document_id, text[, metadata])"
+        if document[0] in ids:
+            return f"Duplicate document ID '{document[0]}' in the job"
+        ids.add(document[0])
+    return None
+
+def _split_shared_ids(jobs: list) -> list:
+    # An ID can only appear once per write: a job repeating an ID of the run starts a new run,
+    # which keeps the submission order (the later version of a document wins)
+    runs, run_ids = [], set()
+    for job in jobs:
+        job_ids = {document[0] for document in job.documents}
+        if not runs or run_ids & job_ids:
+            runs.append([])
+            run_ids = set()
+        runs[-1].append(job)
+        run_ids |= job_ids
+    return runs
+
+class IngestQueue:
+    """
+    Ingests submitted documents on a background thread, several queued jobs per run.
+    """
+
+    def __init__(self, chunk_tokens: int = DEFAULT_CHUNK_TOKENS, chunk_overlap: int = DEFAULT_CHUNK_OVERLAP,
+                 max_documents_per_run: int = DEFAULT_MAX_DOCUMENTS_PER_RUN,
+                 max_finished_jobs: int = DEFAULT_MAX_FINISHED_JOBS):
+        self.chunk_tokens = chunk_tokens
+        self.chunk_overlap = chunk_overlap
+        self.max_documents_per_run = max_documents_per_run
+        self.max_finished_jobs = max_finished_jobs
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self.documents_ingested = 0
+
+    def _ensure_worker(self):
+        with self._lock:
+            # Threads don't survive fork(): a worker process starts its own worker thread
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._queue = Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="ingest-worker", daemon=True)
+                self._thread.start()
+
+    def submit(self, documents, collection_name: str = COLLECTION_NAME, upsert: bool = False,
+               metadata: dict = None) -> IngestJob:
+        """
+        Queues (document_id, text) pairs, or (document_id, text, metadata) triples, for ingestion
+        and returns the job immediately. metadata is stored with every document of the job.
+        """
+        self._ensure_worker()
+        job = IngestJob(list(documents), collection_name, upsert, metadata)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._forget_finished_jobs()
+        self._queue.put(job)
+        return job
+
+    def submit_delete(self, document_ids: list, collection_name: str = COLLECTION_NAME) -> IngestJob:
+        """
+        Queues the deletion of documents (and of their chunks) behind the jobs already submitted
+        and returns the job immediately.
+        """
+        self._ensure_worker()
+        job = IngestJob([(doc_id,) for doc_id in document_ids], collection_name, False, action="delete")
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._forget_finished_jobs()
+        self._queue.put(job)
+        return job
+
+    def get_job(self, job_id: str):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def pending(self) -> int:
+        """Number of jobs queued or running."""
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job.status in ("queued", "running"))
+
+    def wait_all(self, timeout: float = None) -> bool:
+        """Waits for every submitted job to finish; returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            jobs = [job for job in self._jobs.values() if job.status in ("queued", "running")]
+        for job in jobs:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not job.wait(remaining):
+                return False
+        return True
+
+    def _forget_finished_jobs(self):
+        # Called with the lock held
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in ("done", "failed")]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self._jobs[job_id]
+
+    def _take_jobs(self) -> list:
+        # Blocks for the first job, then takes the jobs already queued (grouped by collection in _run)
+        jobs = [self._queue.get()]
+        documents = len(jobs[0].documents)
+        while documents < self.max_documents_per_run:
+            try:
+                job = self._queue.get_nowait()
+            except Empty:
+                break
+            jobs.append(job)
+            documents += len(job.documents)
+        return jobs
+
+    def _run(self):
+        while True:
+            jobs = self._take_jobs()
+            groups = OrderedDict()
+            for job in jobs:
+                if job.action == "delete":
+                    # The additions queued before the deletion are written first
+                    self._ingest_groups(groups)
+                    groups = OrderedDict()
+                    self._delete(job)
+                    continue
+                # A malformed job is failed on its own rather than failing the run it would be merged into
+                error = _check_documents(job.documents)
+                if error:
+                    job.started_at = time.time()
+                    self._finish([job], "failed", error)
+                    continue
+                groups.setdefault((job.collection_name, job.upsert), []).append(job)
+            self._ingest_groups(groups)
+
+    def _ingest_groups(self, groups: OrderedDict):
+        for (collection_name, upsert), group in groups.items():
+            for run in _split_shared_ids(group):
+                self._ingest(collection_name, upsert, run)
+
+    def _delete(self, job: IngestJob):
+        job.status, job.started_at = "running", time.time()
+        try:
+            collection = get_or_create_collection(job.collection_name)
+            ids = [document[0] for document in job.documents]
+            # A long document is stored as chunks whose parent_id is its ID
+            chunks = collection.get(where={"parent_id": {"$in": ids}}, include=["metadatas"])
+            stored = collection.get(ids=ids, include=[])["ids"]
+            delete_documents(collection, sorted(set(stored) | set(chunks["ids"])))
+            job.deleted = len(set(stored) | {metadata["parent_id"] for metadata in chunks["metadatas"]})
+            status, error = "done", None
+        except Exception as e:
+            status, error = "failed", f"{type(e).__name__}: {e}"
+            print(f"Deletion job {job.job_id} failed: {error}")
+        self._finish([job], status, error)
+
+    def _ingest(self, collection_name: str, upsert: bool, jobs: list):
+        started_at = time.time()
+        for job in jobs:
+            job.status, job.started_at = "running", job.started_at or started_at
+        try:
+            self._write(collection_name, upsert, jobs)
+            status, error = "done", None
+        except Exception as e:
+            if len(jobs) > 1:
+                # Only the job at fault should fail: the merged jobs are written again one at a time
+                print(f"Ingestion of {len(jobs)} merged jobs failed ({type(e).__name__}: {e}), retrying one by one")
+                for job in jobs:
+                    self._ingest(collection_name, upsert, [job])
+                return
+            status, error = "failed", f"{type(e).__name__}: {e}"
+            print(f"Ingestion of job {jobs[0].job_id} failed: {error}")
+        self._finish(jobs, status, error)
+
+    def _write(self, collection_name: str, upsert: bool, jobs: list):
+        collection = get_or_create_collection(collection_name) # Cached handle
+        # Jobs merged into this run may carry different metadata: it is attached to each document
+        documents = [(document[0], document[1], {**job.metadata, **(document[2] if len(document) > 2 else {})})
+                     for job in jobs for document in job.documents]
+        if self.chunk_tokens:
+            written_ids = set()
+            document_metadata = {doc_id: metadata for doc_id, _, metadata in documents}
+
+            def chunks():
+                pairs = ((doc_id, text) for doc_id, text, _ in documents)
+                for chunk_id, text, metadata in iter_chunks(pairs, self.chunk_tokens, self.chunk_overlap):
+                    written_ids.add(chunk_id)
+                    yield chunk_id, text, {**document_metadata[metadata["parent_id"]], **metadata}
+            ingest_documents(collection, chunks(), upsert=upsert)
+            if upsert:
+                self._delete_stale_chunks(collection, [doc_id for doc_id, _, _ in documents], written_ids)
+        else:
+            ingest_documents(collection, documents, upsert=upsert)
+
+    def _finish(self, jobs: list, status: str, error: str = None):
+        generation = get_generation()
+        with self._lock:
+            for job in jobs:
+                job.status, job.error, job.generation = status, error, generation
+                job.finished_at = time.time()
+                if status == "done" and job.action == "add":
+                    self.documents_ingested += len(job.documents)
+        for job in jobs:
+            job._done.set()
+
+    def _delete_stale_chunks(self, collection, parent_ids: list, written_ids: set):
+        # A replaced document may have had more chunks than its new version, or been stored whole
+        existing = collection.get(where={"parent_id": {"$in": parent_ids}}, include=[])["ids"]
+        existing += collection.get(ids=parent_ids, include=[])["ids"]
+        stale = sorted(set(existing) - written_ids)
+        if stale:
+            delete_documents(collection, stale)
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            return {"jobs": counts, "documents_ingested": self.documents_ingested, "generation": get_generation()}
+
+_ingest_queue = None
+_ingest_queue_lock = threading.Lock()
+
+def get_ingest_queue() -> IngestQueue:
+    """
+    Returns the process-wide ingestion queue.
+    """
+    global _ingest_queue
+    with _ingest_queue_lock:
+        if _ingest_queue is None:
+            _ingest_queue = IngestQueue()
+        return _ingest_queue
@@ -1,43 +1,272 @@
 import chromadb
+from chromadb.utils import embedding_functions
 import os
+import re
+import threading
+import time
+from embedding_cache import EmbeddingCache, CachedEmbeddingFunction
+from bm25_index import get_bm25_index
+from quantized_index import QuantizedCollection, get_quantized_index
 
 # Ensure the directory for persistent storage exists
-DB_DIR = "chroma_db_store"
+DB_DIR = os.environ.get("CHROMA_DB_DIR", "chroma_db_store")
 if not os.path.exists(DB_DIR):
     os.makedirs(DB_DIR)
 
+COLLECTION_NAME = "llm_knowledge"
+
+# Example documents loaded into a fresh knowledge base
+SEED_DOCUMENTS = {
+    "doc1": "Le ciel est bleu.",
+    "doc2": "L'herbe est verte.",
+    "doc3": "Paris est la capitale de la France.",
+    "doc4": "Les pommes sont généralement rouges ou vertes.",
+    "doc5": "Le soleil brille pendant la journée."
+}
+
 # Initialize a persistent ChromaDB client
 client = chromadb.PersistentClient(path=DB_DIR)
 
-def get_or_create_collection(collection_name: str = "llm_knowledge"):
+# Embedding model used for the knowledge collection (Chroma's default model)
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_CACHE_DIR = os.path.join(DB_DIR, "embedding_cache")
+
+# Vector store of the collections: "chroma" (HNSW graph over float32 vectors held in RAM)
+# or "quantized" (quantized_index.py: int8 codes in memory-mapped files, for large knowledge bases)
+VECTOR_BACKEND = os.environ.get("RAG_VECTOR_BACKEND", "chroma")
+QUANTIZED_DIR = os.path.join(DB_DIR, "quantized")
+
+# Cached embedding functions shared by ingestion, Chroma queries and the RAG retriever,
+# created on first use (one per model name).
+_embedding_functions = {}
+_embedding_functions_lock = threading.Lock()
+
+def get_embedding_function(model_name: str = EMBEDDING_MODEL_NAME):
+    """
+    Returns the embedding function for the given model, wrapped in the persistent embedding cache.
+    Texts embedded before (documents or repeated questions) are read from disk instead of re-running the model.
+    """
+    # The CLI loads models in a background thread while the menu may already embed documents
+    with _embedding_functions_lock:
+        if model_name not in _embedding_functions:
+            if model_name == EMBEDDING_MODEL_NAME:
+                base_function = embedding_functions.DefaultEmbeddingFunction()
+            else:
+                base_function = embedding_functions.SentenceTransformerEmbeddingFunction(model_name=model_name)
+            cache = EmbeddingCache(model_name, EMBEDDING_CACHE_DIR)
+            _embedding_functions[model_name] = CachedEmbeddingFunction(base_function, cache)
+        return _embedding_functions[model_name]
+
+# Collection handles opened once per process and name: looking a collection up
+# goes through the Chroma system database, too slow to repeat on every request.
+_collections = {}
+_collections_lock = threading.Lock()
+
+def get_quantized_collection(collection_name: str = COLLECTION_NAME, embedding_function=None):
+    """
+    Returns the quantized index of a collection behind the Chroma collection interface (created if missing).
+    """
+    index = get_quantized_index(os.path.join(QUANTIZED_DIR, collection_name))
+    return QuantizedCollection(collection_name, index, embedding_function or get_embedding_function())
+
+def get_or_create_collection(collection_name: str = COLLECTION_NAME):
     """
     Retrieves an existing collection or creates it if it doesn't exist.
+    The handle is cached: later calls with the same name return it without a lookup.
+    """
+    with _collections_lock:
+        if collection_name in _collections:
+            return _collections[collection_name]
+        embedding_function = get_embedding_function()
+        if VECTOR_BACKEND == "quantized":
+            collection = get_quantized_collection(collection_name, embedding_function)
+        else:
+            try:
+                collection = client.get_collection(name=collection_name, embedding_function=embedding_function)
+                print(f"Collection '{collection_name}' retrieved.")
+            except:
+                collection = client.create_collection(name=collection_name, embedding_function=embedding_function)
+                print(f"Collection '{collection_name}' created.")
+        _collections[collection_name] = collection
+        return collection
+
+# Each tenant (knowledge domain) has its own collection, so its searches never scan
+# (nor return) the documents of the other tenants.
+TENANT_SEPARATOR = "--"
+_TENANT_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]{0,39}$")
+
+def tenant_collection_name(tenant: str = None, base_name: str = COLLECTION_NAME) -> str:
+    """
+    Returns the collection of a tenant: base_name itself when tenant is None.
+    Raises ValueError for names Chroma would reject.
+    """
+    if tenant is None:
+        return base_name
+    if not _TENANT_PATTERN.match(tenant):
+        raise ValueError(f"Invalid tenant '{tenant}': use up to 40 letters, digits, '-' or '_'.")
+    return f"{base_name}{TENANT_SEPARATOR}{tenant}"
+
+def get_tenant_collection(tenant: str = None):
+    """
+    Returns the (cached) collection of a tenant, creating it on first use.
+    """
+    return get_or_create_collection(tenant_collection_name(tenant))
+
+def document_metadata(source: str = None, tenant: str = None, **extra) -> dict:
+    """
+    Builds the metadata stored with a document. created_at and updated_at (Unix seconds)
+    are added when the document is written, see ingest.ingest_documents().
+    Chroma does not store None values, so they are left out.
+    """
+    metadata = {"source": source, "tenant": tenant, **extra}
+    return {key: value for key, value in metadata.items() if value is not None}
+
+def metadata_filter(filters: dict = None):
+    """
+    Converts {"field": value, ...} conditions into a Chroma where clause, pushed down into the search.
+    A list value matches any of its items; operator dicts such as {"$gte": 1700000000} are kept as-is.
+    Returns None when there is no condition.
+    """
+    conditions = []
+    for field, value in (filters or {}).items():
+        if isinstance(value, (list, tuple)):
+            value = {"$in": list(value)}
+        conditions.append({field: value})
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+# Counter bumped on every write to the knowledge base. Stored on disk so that
+# caches in other processes (CLI, backend workers) also notice the change.
+GENERATION_FILE = os.path.join(DB_DIR, "generation")
+_generation_lock = threading.Lock()
+
+def get_generation() -> int:
+    """
+    Returns the current generation number of the knowledge base (0 if it was never written to).
     """
     try:
-        collection = client.get_collection(name=collection_name)
-        print(f"Collection '{collection_name}' retrieved.")
-    except:
-        collection = client.create_collection(name=collection_name)
-        print(f"Collection '{collection_name}' created.")
-    return collection
+        with open(GENERATION_FILE, "r", encoding="utf-8") as f:
+            return int(f.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+def bump_generation() -> int:
+    """
+    Increments the generation number after a write and returns the new value.
+    """
+    with _generation_lock:
+        generation = get_generation() + 1
+        tmp_path = f"{GENERATION_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(str(generation))
+        os.replace(tmp_path, GENERATION_FILE)
+    return generation
+
+# BM25 indexes (one per collection) kept in sync with every add and delete below
+BM25_DIR = os.path.join(DB_DIR, "bm25")
 
-def add_document(collection, document_text: str, document_id: str):
+def get_lexical_index(collection_name: str = COLLECTION_NAME):
+    """
+    Returns the BM25 index of a collection.
+    """
+    return get_bm25_index(os.path.join(BM25_DIR, collection_name))
+
+def rebuild_lexical_index(collection, page_size: int = 5000):
+    """
+    Re-indexes every document of the collection, e.g. for a collection created before the BM25 index existed.
+    """
+    def all_documents():
+        offset = 0
+        while True:
+            page = collection.get(include=["documents"], limit=page_size, offset=offset)
+            if not page["ids"]:
+                return
+            yield from zip(page["ids"], page["documents"])
+            offset += len(page["ids"])
+
+    index = get_lexical_index(collection.name)
+    index.rebuild(all_documents())
+    print(f"BM25 index of '{collection.name}' rebuilt ({index.num_docs} documents).")
+    return index
+
+def _existing_ids(collection, document_ids: list) -> set:
+    return set(collection.get(ids=list(document_ids), include=[])["ids"])
+
+def add_document(collection, document_text: str, document_id: str, metadata: dict = None):
     """
     Adds a document text to the specified collection with a unique ID.
     """
+    # Chroma leaves an existing ID untouched, so its BM25 entry must stay as well
+    if _existing_ids(collection, [document_id]):
+        print(f"Document ID '{document_id}' already exists in collection '{collection.name}', skipped.")
+        return
+    now = int(time.time())
     collection.add(
         documents=[document_text],
-        ids=[document_id]
+        ids=[document_id],
+        metadatas=[{**(metadata or {}), "created_at": now, "updated_at": now}]
     )
+    get_lexical_index(collection.name).add([document_id], [document_text])
+    bump_generation()
     print(f"Document ID '{document_id}' added to collection '{collection.name}'.")
 
-def query_documents(collection, query_text: str, n_results: int = 2):
+def add_documents(collection, document_texts: list, document_ids: list, embeddings=None, upsert: bool = False,
+                  metadatas: list = None):
+    """
+    Adds several documents to the collection in a single write.
+    If embeddings are given they are stored as-is, otherwise Chroma embeds the whole batch at once.
+    With upsert=True, documents whose ID already exists are overwritten instead of skipped.
+    """
+    if not document_ids:
+        return
+    kwargs = {}
+    if embeddings is not None:
+        kwargs["embeddings"] = embeddings
+    if metadatas is not None:
+        kwargs["metadatas"] = metadatas
+    if upsert:
+        collection.upsert(documents=document_texts, ids=document_ids, **kwargs)
+        inserted = range(len(document_ids))
+    else:
+        # Chroma skips the IDs it already holds: only the inserted documents go to the BM25 index
+        existing = _existing_ids(collection, document_ids)
+        collection.add(documents=document_texts, ids=document_ids, **kwargs)
+        inserted = [number for number, doc_id in enumerate(document_ids) if doc_id not in existing]
+        if not inserted:
+            return
+    get_lexical_index(collection.name).add([document_ids[number] for number in inserted],
+                                           [document_texts[number] for number in inserted])
+    bump_generation()
+
+def delete_documents(collection, document_ids: list):
+    """
+    Removes the documents with the given IDs from the collection.
+    """
+    if document_ids:
+        collection.delete(ids=document_ids)
+        get_lexical_index(collection.name).delete(document_ids)
+        bump_generation()
+
+def get_max_batch_size(default: int = 5000) -> int:
+    """
+    Returns the largest number of records the Chroma client accepts in one write.
+    """
+    try:
+        return client.get_max_batch_size()
+    except Exception:
+        return default
+
+def query_documents(collection, query_text: str, n_results: int = 2, where: dict = None):
     """
     Queries the collection with a text and returns the n_results most similar documents.
+    With a where clause (see metadata_filter), only the matching documents are searched.
     """
+    kwargs = {"where": where} if where else {}
     results = collection.query(
         query_texts=[query_text],
-        n_results=n_results
+        n_results=n_results,
+        **kwargs
     )
     return results
 
@@ -45,23 +274,9 @@ if __name__ == "__main__":
     # Get or create the collection
     knowledge_collection = get_or_create_collection()
 
-    # Add some example documents
-    documents_to_add = {
-        "doc1": "Le ciel est bleu.",
-        "doc2": "L'herbe est verte.",
-        "doc3": "Paris est la capitale de la France.",
-        "doc4": "Les pommes sont généralement rouges ou vertes.",
-        "doc5": "Le soleil brille pendant la journée."
-    }
-
-    # Check existing documents to avoid adding duplicates if script is run multiple times
-    existing_ids = knowledge_collection.get(ids=list(documents_to_add.keys()))['ids']
-
-    for doc_id, text in documents_to_add.items():
-        if doc_id not in existing_ids:
-            add_document(knowledge_collection, text, doc_id)
-        else:
-            print(f"Document ID '{doc_id}' already exists in collection '{knowledge_collection.name}'.")
+    # Add the example documents. The content-hash manifest makes re-runs skip unchanged documents.
+    from ingest import sync_documents
+    sync_documents(knowledge_collection, SEED_DOCUMENTS.items(), source="seed")
 
     # Perform an example query
     query = "Quelle est la couleur du ciel ?"
@@ -0,0 +1,93 @@
+"""
+Loading of the causal language model with a selectable inference precision.
+
+Precision modes (RAG_PRECISION environment variable or precision argument):
+    fp16  float16 weights with device_map="auto" (historical default, best on GPU)
+    fp32  float32 weights on CPU
+    bf16  bfloat16 weights on CPU (half the memory of fp32, fast on CPUs with AVX512-BF16/AMX)
+    int8  dynamic int8 quantization of the nn.Linear layers on CPU
+
+Quantizing takes a while, so the int8 model is saved once in QUANTIZED_MODEL_DIR
+and loaded from there on the next starts.
+
+With RAG_SHARED_MODEL=1, fp32/bf16/fp16 weights are memory-mapped from a file
+shared by all the serving processes instead (see shared_model.py).
+"""
+import os
+import re
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+PRECISIONS = ("fp16", "fp32", "bf16", "int8")
+DEFAULT_PRECISION = os.environ.get("RAG_PRECISION", "fp16")
+QUANTIZED_MODEL_DIR = os.environ.get("RAG_QUANTIZED_MODEL_DIR", "quantized_models")
+
+_TORCH_DTYPES = {"fp16": torch.float16, "fp32": torch.float32, "bf16": torch.bfloat16}
+
+def load_tokenizer(model_name: str):
+    """
+    Loads the tokenizer, using EOS as padding token when the model has none.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    # Ensure pad_token_id is set if eos_token_id is used for padding
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token_id = tokenizer.eos_token_id
+    return tokenizer
+
+def _model_fingerprint(model_name: str) -> str:
+    # A local (e.g. fine-tuned) model directory changes over time: include its last modification
+    if os.path.isdir(model_name):
+        latest = max((entry.stat().st_mtime for entry in os.scandir(model_name) if entry.is_file()), default=0)
+        return f"{int(latest)}"
+    return "hub"
+
+def quantized_artifact_path(model_name: str) -> str:
+    """
+    Returns where the int8 version of a model is cached. The torch version is part of the
+    name because pickled quantized modules are not portable across torch releases.
+    """
+    slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name.strip("./"))
+    torch_version = torch.__version__.split("+")[0]
+    return os.path.join(QUANTIZED_MODEL_DIR,
+                        f"{slug}-{_model_fingerprint(model_name)}-int8-dynamic-torch{torch_version}.pt")
+
+def _load_int8_model(model_name: str):
+    path = quantized_artifact_path(model_name)
+    if os.path.exists(path):
+        print(f"Loading cached int8 model from {path}")
+        return torch.load(path, weights_only=False)
+
+    print("Quantizing the nn.Linear layers to int8 (done once, the result is cached)...")
+    model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32)
+    model.eval()
+    model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    os.makedirs(QUANTIZED_MODEL_DIR, exist_ok=True)
+    tmp_path = path + ".tmp"
+    torch.save(model, tmp_path)
+    os.replace(tmp_path, path)
+    print(f"Quantized model saved to {path}")
+    return model
+
+def load_model(model_name: str, precision: str = DEFAULT_PRECISION):
+    """
+    Loads the causal LM in the requested precision mode, ready for inference.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}', expected one of {', '.join(PRECISIONS)}.")
+    if os.environ.get("RAG_SHARED_MODEL", "0") == "1":
+        from shared_model import load_shared_model
+        return load_shared_model(model_name, precision)
+    print(f"Loading model {model_name} ({precision})")
+    if precision == "int8":
+        model = _load_int8_model(model_name)
+    elif precision == "fp16":
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            torch_dtype=torch.float16, # Using float16 for potentially lower memory
+            device_map="auto" # Let accelerate handle device mapping
+        )
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=_TORCH_DTYPES[precision])
+    model.eval()
+    return model
@@ -0,0 +1,140 @@
+"""
+Reuse of the attention key/value cache of fixed prompt prefixes.
+
+Every RAG prompt starts with the same instruction block of RAG_PROMPT_TEMPLATE
+("Utilisez les informations suivantes..."). Its past_key_values are computed
+once per model and kept here; a request whose tokens start with a cached prefix
+gets a copy of that cache and the model only prefills the remaining tokens
+(context and question).
+
+The cached prefix and the prompt are tokenized separately, so the cache is
+cropped to the longest common run of token IDs: a prefix ending with a space,
+which the tokenizer merges with the next word, still reuses all the tokens before it.
+
+Caches of several templates are kept in an LRU bounded by their size in bytes
+(RAG_PREFIX_CACHE_MB, default 64).
+"""
+import copy
+import os
+import string
+import threading
+from collections import OrderedDict
+
+import torch
+from transformers import DynamicCache
+
+DEFAULT_MAX_MEGABYTES = float(os.environ.get("RAG_PREFIX_CACHE_MB", "64"))
+# Below this many shared tokens, copying the cache costs more than it saves
+MIN_REUSED_TOKENS = 8
+
+def static_prefix(template: str) -> str:
+    """
+    Returns the text of a str.format template before its first placeholder.
+    """
+    literal, _, _, _ = next(string.Formatter().parse(template), ("", None, None, None))
+    return literal
+
+def cache_nbytes(past_key_values) -> int:
+    return sum(tensor.nelement() * tensor.element_size()
+               for layer in past_key_values.to_legacy_cache() for tensor in layer[:2])
+
+def _common_prefix_length(a: torch.Tensor, b: torch.Tensor) -> int:
+    length = min(len(a), len(b))
+    mismatches = (a[:length] != b[:length]).nonzero()
+    return int(mismatches[0]) if len(mismatches) else length
+
+class _Entry:
+    def __init__(self, input_ids, past_key_values, nbytes):
+        self.input_ids = input_ids
+        self.past_key_values = past_key_values
+        self.nbytes = nbytes
+
+class PrefixCache:
+    """
+    LRU of prefilled prompt prefixes, keyed by model and prefix text, bounded by max_bytes.
+    """
+
+    def __init__(self, max_bytes: int = int(DEFAULT_MAX_MEGABYTES * 1024 * 1024)):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._nbytes = 0
+        # Bumped by clear(): a prefix prefilled before a clear is not stored after it
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def add(self, model, tokenizer, prefix: str):
+        """
+        Prefills a prefix once for this model and keeps its key/value cache.
+        """
+        key = (id(model), prefix)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            epoch = self._epoch
+        input_ids = tokenizer(prefix, return_tensors="pt")["input_ids"].to(model.device)
+        with torch.no_grad():
+            past_key_values = model(input_ids=input_ids, use_cache=True).past_key_values
+        if not isinstance(past_key_values, DynamicCache):
+            past_key_values = DynamicCache.from_legacy_cache(past_key_values)
+        nbytes = cache_nbytes(past_key_values)
+        if nbytes > self.max_bytes:
+            print(f"Prefix of {input_ids.shape[1]} tokens is larger than the prefix cache, not cached.")
+            return
+        with self._lock:
+            if key in self._entries or epoch != self._epoch:
+                return
+            self._entries[key] = _Entry(input_ids[0], past_key_values, nbytes)
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+
+    def lookup(self, model, input_ids: torch.Tensor):
+        """
+        Returns (past_key_values, reused_tokens) for the 1-D input_ids of a prompt, or (None, 0).
+        The returned cache is a private copy that generate() may extend.
+        """
+        best, best_length = None, 0
+        with self._lock:
+            for key, entry in self._entries.items():
+                if key[0] != id(model):
+                    continue
+                # At least one token must be left for the model to compute the next-token logits
+                length = min(_common_prefix_length(entry.input_ids, input_ids), len(input_ids) - 1)
+                if length > best_length:
+                    best, best_length = key, length
+            if best is None or best_length < MIN_REUSED_TOKENS:
+                self.misses += 1
+                return None, 0
+            self._entries.move_to_end(best)
+            entry = self._entries[best]
+            self.hits += 1
+            self.reused_tokens += best_length
+            past_key_values = copy.deepcopy(entry.past_key_values)
+        if best_length < len(entry.input_ids):
+            past_key_values.crop(best_length)
+        return past_key_values, best_length
+
+    def clear(self):
+        """Drops every cached prefix (e.g. after the model weights changed)."""
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            self._epoch += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "megabytes": self._nbytes / (1024 * 1024),
+                "hits": self.hits,
+                "misses": self.misses,
+                "reused_tokens": self.reused_tokens,
+            }
+
+# Shared by every generation helper of the process
+prefix_cache = PrefixCache()
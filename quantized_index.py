@@ -0,0 +1,756 @@
+"""
+Compact vector index for large knowledge bases, an alternative to Chroma's HNSW.
+
+Chroma keeps every float32 vector and its HNSW graph in RAM. This index keeps
+int8 codes in memory-mapped files, grouped in inverted lists around k-means
+centroids (IVF): a question is compared to the centroids, then only to the
+codes of its nprobe closest lists, and the best candidates are re-scored
+exactly with float16 copies of their vectors that stay on disk. The pages in
+use are about dimension + 8 bytes per vector (a quarter of the float32
+vectors alone), and only the probed lists are read.
+
+The index of a collection lives in its own directory:
+
+    CURRENT              number of the active segment
+    segment-<n>/
+        meta.json          dimension, number of lists and vectors
+        centroids.npy      coarse centroids (float32, lists x dimension)
+        list_offsets.npy   first row of each list: rows are sorted by list
+        codes.npy          int8 codes, scales.npy their per-vector scale
+        sq_norms.npy       squared norms of the vectors
+        rescore.npy        float16 vectors, read for the exact re-score only
+        doc_ids.npy        document IDs, doc_id_order.npy sorts them for lookups
+        parent_ids.npy     parent_id metadata of the chunks ("" if none), parent_id_order.npy sorts them
+        documents.bin      UTF-8 texts, document_offsets.npy their boundaries
+        metadatas.bin      JSON metadata, metadata_offsets.npy their boundaries
+    ops-<n>.jsonl        adds and deletes made since segment <n> was written
+
+As in bm25_index.py, writes are appended to the ops log and replayed in memory
+(searched exactly) by every process, and the log is merged into a new segment
+once it holds a fifth of the segment.
+
+QuantizedCollection exposes the subset of the Chroma collection API used by
+the project (add, upsert, delete, get, query, count), so ingestion and the RAG
+retriever work unchanged with RAG_VECTOR_BACKEND=quantized (knowledge_base.py).
+Distances are squared L2, like Chroma's default.
+
+Usage:
+    python quantized_index.py build --collection llm_knowledge   (copy a Chroma collection)
+    python quantized_index.py search "capitale France"
+"""
+import argparse
+import fcntl
+import json
+import math
+import operator
+import os
+import shutil
+import threading
+
+import numpy as np
+
+DEFAULT_NPROBE = int(os.environ.get("RAG_QUANTIZED_NPROBE", "16"))
+# Candidates re-scored with the float16 vectors, per requested result (and at least MIN_RESCORE_CANDIDATES)
+RESCORE_FACTOR = 8
+MIN_RESCORE_CANDIDATES = 64
+# With a metadata filter, this many times more candidates are kept before filtering
+FILTER_OVERFETCH = 8
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_PER_LIST = 32
+# Compact once the ops log holds this many documents, or a fifth of the segment if larger
+MIN_DOCS_BEFORE_COMPACTION = 10000
+COMPACTION_RATIO = 0.2
+# Rows processed at once while writing a segment
+_ROWS_PER_CHUNK = 65536
+# Distance matrix entries computed at once while assigning vectors to lists
+_SCORES_PER_CHUNK = 1 << 24
+
+_OPERATORS = {
+    "$eq": operator.eq, "$ne": operator.ne, "$gt": operator.gt, "$gte": operator.ge,
+    "$lt": operator.lt, "$lte": operator.le,
+    "$in": lambda value, options: value in options, "$nin": lambda value, options: value not in options,
+}
+
+def matches(metadata: dict, where: dict) -> bool:
+    """
+    Evaluates a Chroma where clause ({"field": value}, operators, $and / $or) on a metadata dict.
+    """
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(matches(metadata, clause) for clause in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(metadata, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            for name, operand in condition.items():
+                if value is None and name not in ("$ne", "$nin"):
+                    return False
+                if not _OPERATORS[name](value, operand):
+                    return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+def _parent_id_condition(where: dict):
+    """
+    Returns the parent_id values a where clause requires ({"parent_id": value}, $eq, $in,
+    possibly inside $and), or None if it does not restrict parent_id.
+    """
+    condition = where.get("parent_id")
+    if condition is not None:
+        if not isinstance(condition, dict):
+            return [condition]
+        if "$eq" in condition:
+            return [condition["$eq"]]
+        if "$in" in condition:
+            return list(condition["$in"])
+    for clause in where.get("$and", []):
+        values = _parent_id_condition(clause)
+        if values is not None:
+            return values
+    return None
+
+def default_nlist(count: int) -> int:
+    """Number of inverted lists for a corpus: about its square root."""
+    return int(min(65536, max(1, round(math.sqrt(count)))))
+
+def quantize_int8(vectors: np.ndarray):
+    """
+    Symmetric per-vector int8 quantization: returns (codes, scales) with vector ~ codes * scale.
+    """
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # Nearest centroid: argmin ||x - c||^2 = argmin ||c||^2 - 2 x.c
+    centroid_sq_norms = (centroids ** 2).sum(axis=1)
+    chunk = max(1, _SCORES_PER_CHUNK // len(centroids))
+    return np.concatenate([
+        np.argmin(centroid_sq_norms[None, :] - 2.0 * vectors[start:start + chunk] @ centroids.T, axis=1)
+        for start in range(0, len(vectors), chunk)
+    ])
+
+def train_centroids(fetch, count: int, nlist: int, seed: int = 0) -> np.ndarray:
+    """
+    k-means (Lloyd) on a sample of the vectors; fetch(rows) returns float32 vectors.
+    """
+    rng = np.random.default_rng(seed)
+    nlist = min(nlist, count)
+    sample = fetch(np.sort(rng.choice(count, size=min(count, nlist * KMEANS_SAMPLE_PER_LIST), replace=False)))
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].astype(np.float32)
+    for _ in range(KMEANS_ITERATIONS):
+        assignment = _assign(sample, centroids)
+        order = np.argsort(assignment, kind="stable")
+        counts = np.bincount(assignment, minlength=nlist)
+        nonempty = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+        # Empty lists keep their previous centroid
+        centroids[nonempty] = np.add.reduceat(sample[order], starts, axis=0) / counts[nonempty, None]
+    return centroids
+
+class QuantizedIndex:
+    """
+    IVF index of int8 codes in an mmapped segment, plus the in-memory replay of the ops log.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.RLock()
+        self._load()
+
+    # --- Loading --------------------------------------------------------------------------------
+
+    def _current_path(self) -> str:
+        return os.path.join(self.directory, "CURRENT")
+
+    def _ops_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"ops-{segment}.jsonl")
+
+    def _segment_dir(self, segment: int) -> str:
+        return os.path.join(self.directory, f"segment-{segment}")
+
+    def _read_current(self) -> int:
+        try:
+            with open(self._current_path(), "r", encoding="utf-8") as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _load(self):
+        self.segment = self._read_current()
+        segment_dir = self._segment_dir(self.segment)
+        if os.path.isdir(segment_dir):
+            def load(name):
+                return np.load(os.path.join(segment_dir, f"{name}.npy"), mmap_mode="r")
+
+            def load_blob(name):
+                path = os.path.join(segment_dir, f"{name}.bin")
+                return np.memmap(path, dtype=np.uint8, mode="r") if os.path.getsize(path) else np.zeros(0, np.uint8)
+            with open(os.path.join(segment_dir, "meta.json"), "r", encoding="utf-8") as f:
+                self.dimension = json.load(f)["dimension"]
+            self._centroids = np.load(os.path.join(segment_dir, "centroids.npy"))
+            self._list_offsets = load("list_offsets")
+            self._codes = load("codes")
+            self._scales = load("scales")
+            self._sq_norms = load("sq_norms")
+            self._rescore = load("rescore")
+            self._doc_ids = load("doc_ids")
+            self._doc_id_order = load("doc_id_order")
+            # Segments written before the parent_id lookup existed are scanned instead
+            has_parents = os.path.exists(os.path.join(segment_dir, "parent_ids.npy"))
+            self._parent_ids = load("parent_ids") if has_parents else None
+            self._parent_id_order = load("parent_id_order") if has_parents else None
+            self._documents = load_blob("documents")
+            self._document_offsets = load("document_offsets")
+            self._metadatas = load_blob("metadatas")
+            self._metadata_offsets = load("metadata_offsets")
+        else:
+            # No segment yet: every document is in the ops log
+            self.dimension = None
+            self._centroids = np.zeros((0, 0), dtype=np.float32)
+            self._list_offsets = np.zeros(1, dtype=np.int64)
+            self._codes = np.zeros((0, 0), dtype=np.int8)
+            self._scales = np.zeros(0, dtype=np.float32)
+            self._sq_norms = np.zeros(0, dtype=np.float32)
+            self._rescore = np.zeros((0, 0), dtype=np.float16)
+            self._doc_ids = np.array([], dtype="<U1")
+            self._doc_id_order = np.zeros(0, dtype=np.int64)
+            self._parent_ids = np.array([], dtype="<U1")
+            self._parent_id_order = np.zeros(0, dtype=np.int64)
+            self._documents = self._metadatas = np.zeros(0, dtype=np.uint8)
+            self._document_offsets = self._metadata_offsets = np.zeros(1, dtype=np.int64)
+        self._centroid_sq_norms = (self._centroids ** 2).sum(axis=1)
+        self._deleted = np.zeros(len(self._doc_ids), dtype=bool)
+        self.count = len(self._doc_ids)
+        # Documents added since the segment was written: id -> (text, metadata, float32 vector)
+        self._delta = {}
+        self._delta_arrays = None
+        self._ops_offset = 0
+        self._replay()
+
+    def _replay(self):
+        path = self._ops_path(self.segment)
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            f.seek(self._ops_offset)
+            while True:
+                line = f.readline()
+                # A line still being written by another process is read at the next refresh
+                if not line.endswith("\n"):
+                    break
+                self._apply(json.loads(line))
+                self._ops_offset = f.tell()
+
+    def refresh(self):
+        """
+        Picks up the writes made by other processes since the last call.
+        """
+        with self._lock:
+            if self._read_current() != self.segment:
+                self._load()
+                return
+            try:
+                size = os.path.getsize(self._ops_path(self.segment))
+            except FileNotFoundError:
+                return
+            if size > self._ops_offset:
+                self._replay()
+
+    # --- Records --------------------------------------------------------------------------------
+
+    def _base_position(self, doc_id: str):
+        if not len(self._doc_ids):
+            return None
+        index = np.searchsorted(self._doc_ids, doc_id, sorter=self._doc_id_order)
+        if index < len(self._doc_ids):
+            position = int(self._doc_id_order[index])
+            if self._doc_ids[position] == doc_id:
+                return position
+        return None
+
+    def _base_text(self, position: int) -> str:
+        start, end = self._document_offsets[position], self._document_offsets[position + 1]
+        return bytes(self._documents[start:end]).decode("utf-8")
+
+    def _base_metadata(self, position: int) -> dict:
+        start, end = self._metadata_offsets[position], self._metadata_offsets[position + 1]
+        return json.loads(bytes(self._metadatas[start:end]))
+
+    def get_records(self, ids: list, where: dict = None) -> list:
+        """
+        Returns the (id, text, metadata) of the given IDs that exist (and match where), in the given order.
+        """
+        records = []
+        with self._lock:
+            for doc_id in ids:
+                if doc_id in self._delta:
+                    text, metadata, _ = self._delta[doc_id]
+                else:
+                    position = self._base_position(doc_id)
+                    if position is None or self._deleted[position]:
+                        continue
+                    text, metadata = self._base_text(position), self._base_metadata(position)
+                if where is None or matches(metadata, where):
+                    records.append((doc_id, text, metadata))
+        return records
+
+    def _parent_rows(self, parent_ids: list) -> np.ndarray:
+        # Segment rows whose parent_id is one of parent_ids, found in the sorted parent_ids.npy
+        values = np.array([str(parent_id) for parent_id in parent_ids], dtype=str)
+        starts = np.searchsorted(self._parent_ids, values, side="left", sorter=self._parent_id_order)
+        ends = np.searchsorted(self._parent_ids, values, side="right", sorter=self._parent_id_order)
+        rows = [np.asarray(self._parent_id_order[start:end]) for start, end in zip(starts, ends) if end > start]
+        return np.unique(np.concatenate(rows)) if rows else np.zeros(0, dtype=np.int64)
+
+    def iter_records(self, where: dict = None):
+        """
+        Yields the (id, text, metadata) of every document (matching where). Scans the whole segment,
+        unless where selects a parent_id value or list (the chunks of documents), which is looked up.
+        """
+        parent_ids = _parent_id_condition(where) if where else None
+        with self._lock:
+            deleted = self._deleted.copy()
+            delta = list(self._delta.items())
+            if parent_ids is not None and self._parent_ids is not None:
+                positions = self._parent_rows(parent_ids)
+                positions = positions[~deleted[positions]]
+            else:
+                positions = np.flatnonzero(~deleted)
+        for position in positions:
+            metadata = self._base_metadata(position)
+            if where is None or matches(metadata, where):
+                yield str(self._doc_ids[position]), self._base_text(position), metadata
+        for doc_id, (text, metadata, _) in delta:
+            if where is None or matches(metadata, where):
+                yield doc_id, text, metadata
+
+    # --- Writes ---------------------------------------------------------------------------------
+
+    def _remove(self, doc_id: str):
+        if doc_id in self._delta:
+            del self._delta[doc_id]
+        else:
+            position = self._base_position(doc_id)
+            if position is None or self._deleted[position]:
+                return
+            self._deleted[position] = True
+        self.count -= 1
+
+    def _apply(self, op: dict):
+        for doc_id in op["ids"]:
+            self._remove(doc_id)
+        if op["op"] == "add":
+            for doc_id, text, metadata, vector in zip(op["ids"], op["texts"], op["metadatas"], op["embeddings"]):
+                self._delta[doc_id] = (text, metadata or {}, np.asarray(vector, dtype=np.float32))
+                self.count += 1
+            if self.dimension is None and op["embeddings"]:
+                self.dimension = len(op["embeddings"][0])
+        self._delta_arrays = None
+
+    def _write_op(self, op: dict):
+        with self._lock, open(os.path.join(self.directory, "lock"), "w") as lock_file:
+            # Serializes the writers of every process; replaying first keeps the operations ordered
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.refresh()
+            with open(self._ops_path(self.segment), "a", encoding="utf-8") as f:
+                f.write(json.dumps(op, ensure_ascii=False) + "\n")
+                self._ops_offset = f.tell()
+            self._apply(op)
+            if len(self._delta) > max(MIN_DOCS_BEFORE_COMPACTION, COMPACTION_RATIO * len(self._doc_ids)):
+                self._compact()
+
+    def add(self, ids: list, texts: list, metadatas: list, embeddings):
+        """Indexes documents, replacing the ones with the same IDs."""
+        if ids:
+            vectors = np.asarray(embeddings, dtype=np.float32)
+            self._write_op({"op": "add", "ids": list(ids), "texts": list(texts),
+                            "metadatas": [metadata or {} for metadata in metadatas], "embeddings": vectors.tolist()})
+
+    def delete(self, ids: list):
+        if ids:
+            self._write_op({"op": "delete", "ids": list(ids)})
+
+    # --- Segments -------------------------------------------------------------------------------
+
+    def _write_segment(self, count: int, fetch, take_ids, take_parent_ids, take_records, centroids=None):
+        # Record numbers 0..count-1: fetch(rows) returns their float32 vectors, take_ids(rows) and
+        # take_parent_ids(rows) their IDs and parent_ids (str arrays), take_records(rows) their
+        # (UTF-8 text, JSON metadata) bytes. Everything is written chunk by chunk, never held whole.
+        segment = self.segment + 1
+        segment_dir = self._segment_dir(segment)
+        shutil.rmtree(segment_dir, ignore_errors=True)
+        os.makedirs(segment_dir)
+
+        def path(name):
+            return os.path.join(segment_dir, name)
+        dimension = fetch(np.arange(1)).shape[1] if count else (self.dimension or 0)
+        if count and centroids is None:
+            centroids = train_centroids(fetch, count, default_nlist(count))
+        if centroids is None:
+            centroids = np.zeros((0, dimension), dtype=np.float32)
+        assignment = np.concatenate([_assign(fetch(np.arange(start, min(start + _ROWS_PER_CHUNK, count))), centroids)
+                                     for start in range(0, count, _ROWS_PER_CHUNK)]) if count else np.zeros(0, int)
+        # Rows are stored list by list, so probing a list reads one contiguous range
+        order = np.argsort(assignment, kind="stable")
+        list_offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=len(centroids)), out=list_offsets[1:])
+        chunks = [(start, order[start:start + _ROWS_PER_CHUNK]) for start in range(0, count, _ROWS_PER_CHUNK)]
+
+        codes = np.lib.format.open_memmap(path("codes.npy"), mode="w+", dtype=np.int8, shape=(count, dimension))
+        rescore = np.lib.format.open_memmap(path("rescore.npy"), mode="w+", dtype=np.float16,
+                                            shape=(count, dimension))
+        scales = np.zeros(count, dtype=np.float32)
+        sq_norms = np.zeros(count, dtype=np.float32)
+        for start, rows in chunks:
+            end = start + len(rows)
+            vectors = fetch(rows)
+            codes[start:end], scales[start:end] = quantize_int8(vectors)
+            sq_norms[start:end] = (vectors ** 2).sum(axis=1)
+            rescore[start:end] = vectors.astype(np.float16)
+        codes.flush()
+        rescore.flush()
+        del codes, rescore
+
+        np.save(path("centroids.npy"), centroids.astype(np.float32))
+        np.save(path("list_offsets.npy"), list_offsets)
+        np.save(path("scales.npy"), scales)
+        np.save(path("sq_norms.npy"), sq_norms)
+        for name, take in (("doc_ids", take_ids), ("parent_ids", take_parent_ids)):
+            # A first pass finds the width of the fixed-size strings
+            width = max([take(rows).dtype.itemsize // 4 for _, rows in chunks], default=1)
+            values = np.lib.format.open_memmap(path(f"{name}.npy"), mode="w+", dtype=f"<U{max(1, width)}",
+                                               shape=(count,))
+            for start, rows in chunks:
+                values[start:start + len(rows)] = take(rows)
+            np.save(path(f"{name[:-1]}_order.npy"), np.argsort(values, kind="stable").astype(np.int64))
+            values.flush()
+            del values
+
+        document_lengths = np.zeros(count, dtype=np.int64)
+        metadata_lengths = np.zeros(count, dtype=np.int64)
+        with open(path("documents.bin"), "wb") as documents, open(path("metadatas.bin"), "wb") as metadatas:
+            for start, rows in chunks:
+                records = take_records(rows)
+                documents.writelines(text for text, _ in records)
+                metadatas.writelines(metadata for _, metadata in records)
+                document_lengths[start:start + len(rows)] = [len(text) for text, _ in records]
+                metadata_lengths[start:start + len(rows)] = [len(metadata) for _, metadata in records]
+        for name, lengths in (("document", document_lengths), ("metadata", metadata_lengths)):
+            offsets = np.zeros(count + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            np.save(path(f"{name}_offsets.npy"), offsets)
+        with open(path("meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"dimension": int(dimension), "lists": len(centroids), "vectors": count}, f)
+
+        open(self._ops_path(segment), "a").close()
+        tmp_path = self._current_path() + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(str(segment))
+        os.replace(tmp_path, self._current_path())
+        previous = self.segment
+        # Processes still reading the old segment keep their mapping until they reload
+        shutil.rmtree(self._segment_dir(previous), ignore_errors=True)
+        if os.path.exists(self._ops_path(previous)):
+            os.remove(self._ops_path(previous))
+        self._load()
+
+    def _compact(self):
+        # Records 0..len(live_rows)-1 are copied from the mapped segment, the others come from the ops log
+        live_rows = np.flatnonzero(~self._deleted)
+        base = len(live_rows)
+        delta_ids = list(self._delta)
+        delta_matrix = np.stack([self._delta[doc_id][2] for doc_id in delta_ids]) if delta_ids else None
+
+        def fetch(rows):
+            rows = np.asarray(rows)
+            vectors = np.empty((len(rows), self.dimension), dtype=np.float32)
+            in_base = rows < base
+            if in_base.any():
+                vectors[in_base] = self._rescore[live_rows[rows[in_base]]]
+            if delta_matrix is not None:
+                vectors[~in_base] = delta_matrix[rows[~in_base] - base]
+            return vectors
+
+        def column(take_base, delta_values):
+            def take(rows):
+                rows = np.asarray(rows)
+                in_base = rows < base
+                values = np.empty(len(rows), dtype=object)
+                values[in_base] = list(take_base(live_rows[rows[in_base]]))
+                values[~in_base] = [delta_values[row - base] for row in rows[~in_base]]
+                return values.astype(str) if len(values) else np.array([], dtype="<U1")
+            return take
+
+        def base_parent_ids(positions):
+            if self._parent_ids is not None:
+                return np.asarray(self._parent_ids[positions])
+            # Segment written before parent_ids.npy existed
+            return [str(self._base_metadata(position).get("parent_id", "")) for position in positions]
+
+        def take_records(rows):
+            records = []
+            for row in rows:
+                if row < base:
+                    position = live_rows[row]
+                    records.append((
+                        bytes(self._documents[self._document_offsets[position]:self._document_offsets[position + 1]]),
+                        bytes(self._metadatas[self._metadata_offsets[position]:self._metadata_offsets[position + 1]])))
+                else:
+                    text, metadata, _ = self._delta[delta_ids[row - base]]
+                    records.append((text.encode("utf-8"), json.dumps(metadata, ensure_ascii=False).encode("utf-8")))
+            return records
+
+        count = base + len(delta_ids)
+        # The centroids are kept until the corpus outgrows them
+        centroids = self._centroids if len(self._centroids) and default_nlist(count) <= 2 * len(self._centroids) \
+            else None
+        self._write_segment(count, fetch,
+                            column(lambda positions: np.asarray(self._doc_ids[positions]), delta_ids),
+                            column(base_parent_ids, [str(self._delta[doc_id][1].get("parent_id", ""))
+                                                     for doc_id in delta_ids]),
+                            take_records, centroids)
+
+    def compact(self):
+        """Merges the ops log into a new segment."""
+        with self._lock, open(os.path.join(self.directory, "lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.refresh()
+            self._compact()
+
+    def rebuild(self, ids: list, texts: list, metadatas: list, embeddings):
+        """
+        Replaces the whole index; embeddings is a (documents x dimension) array, possibly memory-mapped.
+        The centroids are trained again.
+        """
+        with self._lock, open(os.path.join(self.directory, "lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.segment = self._read_current()
+            metadatas = [metadata or {} for metadata in metadatas]
+            self._write_segment(
+                len(ids),
+                lambda rows: np.asarray(embeddings[np.asarray(rows)], dtype=np.float32),
+                lambda rows: np.array([ids[row] for row in rows], dtype=str),
+                lambda rows: np.array([str(metadatas[row].get("parent_id", "")) for row in rows], dtype=str),
+                lambda rows: [(texts[row].encode("utf-8"),
+                               json.dumps(metadatas[row], ensure_ascii=False).encode("utf-8")) for row in rows])
+
+    # --- Search ---------------------------------------------------------------------------------
+
+    def _search_base(self, query: np.ndarray, lists: np.ndarray, k: int, where: dict) -> list:
+        ranges = [(int(self._list_offsets[number]), int(self._list_offsets[number + 1])) for number in lists]
+        rows = np.concatenate([np.arange(start, end) for start, end in ranges])
+        if not len(rows):
+            return []
+        codes = np.concatenate([np.asarray(self._codes[start:end]) for start, end in ranges])
+        # ||x - q||^2 up to ||q||^2, with x ~ codes * scale
+        approximate = self._sq_norms[rows] - 2.0 * self._scales[rows] * (codes.astype(np.float32) @ query)
+        approximate[self._deleted[rows]] = np.inf
+        candidates = max(MIN_RESCORE_CANDIDATES, RESCORE_FACTOR * k) * (FILTER_OVERFETCH if where else 1)
+        if len(rows) > candidates:
+            top = np.argpartition(approximate, candidates - 1)[:candidates]
+        else:
+            top = np.arange(len(rows))
+        rows = np.sort(rows[top[np.isfinite(approximate[top])]]) # Sorted: sequential reads of rescore.npy
+        if where:
+            rows = np.array([row for row in rows if matches(self._base_metadata(row), where)], dtype=np.int64)
+        if not len(rows):
+            return []
+        distances = ((np.asarray(self._rescore[rows], dtype=np.float32) - query) ** 2).sum(axis=1)
+        best = np.argsort(distances)[:k]
+        return [(str(self._doc_ids[rows[index]]), float(distances[index])) for index in best]
+
+    def _search_delta(self, query: np.ndarray, k: int, where: dict) -> list:
+        if not self._delta:
+            return []
+        if self._delta_arrays is None:
+            ids = list(self._delta)
+            self._delta_arrays = ids, np.stack([self._delta[doc_id][2] for doc_id in ids])
+        ids, matrix = self._delta_arrays
+        distances = ((matrix - query) ** 2).sum(axis=1)
+        hits = []
+        for index in np.argsort(distances):
+            if where and not matches(self._delta[ids[index]][1], where):
+                continue
+            hits.append((ids[index], float(distances[index])))
+            if len(hits) == k:
+                break
+        return hits
+
+    def search(self, query_embeddings, k: int = 10, where: dict = None, nprobe: int = DEFAULT_NPROBE) -> list:
+        """
+        Returns, for each query vector, its k nearest (document_id, squared L2 distance) pairs, best first.
+        Writes of other processes are only seen after refresh().
+        """
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        with self._lock:
+            probes = None
+            if len(self._centroids):
+                nprobe = min(nprobe, len(self._centroids))
+                centroid_distances = self._centroid_sq_norms[None, :] - 2.0 * queries @ self._centroids.T
+                probes = np.argpartition(centroid_distances, nprobe - 1, axis=1)[:, :nprobe]
+            results = []
+            for number, query in enumerate(queries):
+                hits = self._search_base(query, probes[number], k, where) if probes is not None else []
+                hits += self._search_delta(query, k, where)
+                hits.sort(key=lambda hit: hit[1])
+                results.append(hits[:k])
+        return results
+
+    def stats(self) -> dict:
+        with self._lock:
+            segment_dir = self._segment_dir(self.segment)
+            disk_bytes = sum(entry.stat().st_size for entry in os.scandir(segment_dir)) \
+                if os.path.isdir(segment_dir) else 0
+            vectors = len(self._doc_ids)
+            return {
+                "segment": self.segment,
+                "documents": self.count,
+                "segment_documents": vectors,
+                "pending_documents": len(self._delta),
+                "dimension": self.dimension,
+                "lists": len(self._centroids),
+                # Searched data: int8 codes, scale, squared norm and deletion flag
+                "search_bytes_per_vector": (self.dimension or 0) + 9,
+                "disk_bytes_per_vector": disk_bytes / vectors if vectors else 0.0,
+            }
+
+class QuantizedCollection:
+    """
+    Chroma-collection-shaped access to a QuantizedIndex (the calls made by the project).
+    """
+
+    def __init__(self, name: str, index: QuantizedIndex, embedding_function):
+        self.name = name
+        self.index = index
+        self._embedding_function = embedding_function
+
+    def _embed(self, texts: list) -> np.ndarray:
+        return np.asarray(self._embedding_function(list(texts)), dtype=np.float32)
+
+    def upsert(self, ids, documents, embeddings=None, metadatas=None):
+        if embeddings is None:
+            embeddings = self._embed(documents)
+        self.index.add(list(ids), list(documents), list(metadatas or [None] * len(ids)), embeddings)
+
+    def add(self, ids, documents, embeddings=None, metadatas=None):
+        # Like Chroma, existing IDs are left untouched
+        existing = {doc_id for doc_id, _, _ in self.index.get_records(list(ids))}
+        keep = [number for number, doc_id in enumerate(ids) if doc_id not in existing]
+        if keep:
+            self.upsert([ids[number] for number in keep], [documents[number] for number in keep],
+                        None if embeddings is None else [embeddings[number] for number in keep],
+                        None if metadatas is None else [metadatas[number] for number in keep])
+
+    def delete(self, ids=None, where=None):
+        if ids is None:
+            ids = [doc_id for doc_id, _, _ in self.index.iter_records(where)]
+        self.index.delete(list(ids))
+
+    def count(self) -> int:
+        return self.index.count
+
+    def refresh(self):
+        self.index.refresh()
+
+    def get(self, ids=None, where=None, include=("documents", "metadatas"), limit=None, offset=None) -> dict:
+        if ids is not None:
+            records = self.index.get_records(list(ids), where)
+        else:
+            records = self.index.iter_records(where)
+        start = offset or 0
+        records = list(records)[start:None if limit is None else start + limit]
+        result = {"ids": [doc_id for doc_id, _, _ in records]}
+        if "documents" in include:
+            result["documents"] = [text for _, text, _ in records]
+        if "metadatas" in include:
+            result["metadatas"] = [metadata for _, _, metadata in records]
+        return result
+
+    def query(self, query_texts=None, query_embeddings=None, n_results: int = 10, where=None,
+              include=("documents", "metadatas", "distances")) -> dict:
+        if query_embeddings is None:
+            query_embeddings = self._embed(query_texts)
+        hits = self.index.search(query_embeddings, n_results, where)
+        result = {"ids": [[doc_id for doc_id, _ in row] for row in hits]}
+        if "distances" in include:
+            result["distances"] = [[distance for _, distance in row] for row in hits]
+        if "documents" in include or "metadatas" in include:
+            records = [{doc_id: (text, metadata) for doc_id, text, metadata in self.index.get_records(ids)}
+                       for ids in result["ids"]]
+            if "documents" in include:
+                result["documents"] = [[row[doc_id][0] for doc_id in ids] for row, ids in zip(records, result["ids"])]
+            if "metadatas" in include:
+                result["metadatas"] = [[row[doc_id][1] for doc_id in ids] for row, ids in zip(records, result["ids"])]
+        return result
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_quantized_index(directory: str) -> QuantizedIndex:
+    """
+    Returns the process-wide index stored in a directory, opening it on first use.
+    """
+    directory = os.path.abspath(directory)
+    with _indexes_lock:
+        if directory not in _indexes:
+            _indexes[directory] = QuantizedIndex(directory)
+        return _indexes[directory]
+
+def build_from_chroma(collection, index: QuantizedIndex, page_size: int = 5000):
+    """
+    Copies a Chroma collection (texts, metadata and stored embeddings) into the index.
+    The embeddings go through a temporary memory-mapped file rather than RAM.
+    """
+    count = collection.count()
+    ids, texts, metadatas = [], [], []
+    tmp_path = os.path.join(index.directory, "build-embeddings.tmp.npy")
+    embeddings = None
+    try:
+        for offset in range(0, count, page_size):
+            page = collection.get(include=["documents", "metadatas", "embeddings"], limit=page_size, offset=offset)
+            vectors = np.asarray(page["embeddings"], dtype=np.float32)
+            if embeddings is None:
+                embeddings = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32,
+                                                       shape=(count, vectors.shape[1]))
+            embeddings[len(ids):len(ids) + len(vectors)] = vectors
+            ids += page["ids"]
+            texts += page["documents"]
+            metadatas += [metadata or {} for metadata in page["metadatas"]]
+        index.rebuild(ids, texts, metadatas, embeddings[:len(ids)] if embeddings is not None else np.zeros((0, 0)))
+    finally:
+        del embeddings
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    print(f"Quantized index of '{collection.name}' built ({index.count} documents, {len(index._centroids)} lists).")
+
+def main():
+    from knowledge_base import COLLECTION_NAME, QUANTIZED_DIR, client, get_embedding_function
+
+    parser = argparse.ArgumentParser(description="Maintain the quantized vector index of a collection.")
+    parser.add_argument("command", choices=["build", "compact", "stats", "search"])
+    parser.add_argument("query", nargs="?")
+    parser.add_argument("--collection", default=COLLECTION_NAME)
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    index = get_quantized_index(os.path.join(QUANTIZED_DIR, args.collection))
+    if args.command == "build":
+        build_from_chroma(client.get_collection(name=args.collection), index)
+    if args.command == "compact":
+        index.compact()
+    if args.command == "search":
+        collection = QuantizedCollection(args.collection, index, get_embedding_function())
+        results = collection.query(query_texts=[args.query or ""], n_results=args.k, include=["distances"])
+        for doc_id, distance in zip(results["ids"][0], results["distances"][0]):
+            print(f"{distance:8.3f}  {doc_id}")
+        return
+    print(index.stats())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+"""
+Radiograph storage and preprocessing for the viewer.
+
+Uploaded files are streamed to disk in chunks (never held whole in memory) and
+stored under the SHA-256 of their content, so the same image uploaded twice is
+stored and processed once, and every derived file can be cached forever by the
+browser. Decoding, intensity normalization and downscaling run in a process
+pool (they are CPU-bound and would hold the GIL of the serving threads):
+
+    IMAGE_STORE_DIR/
+        originals/<id[:2]>/<id>            the uploaded bytes
+        derived/<id>-v<version>/
+            meta.json                      size, bit depth, window, pyramid levels (written last)
+            thumbnail.png, preview.png     256 and 1024 pixels on the long side
+            tiles/<level>/<col>_<row>.png  tile pyramid, level 0 at full resolution
+        derived/<id>-v<version>.error.json when the file could not be decoded
+        tmp/                               uploads and pyramids being written
+
+8 and 16-bit grayscale images (PNG, TIFF, ...) are mapped to 8 bits with a
+window between the 0.5th and 99.5th percentiles of their pixel values; color
+images are converted to grayscale. Bumping PIPELINE_VERSION rebuilds the
+derived files on next access.
+"""
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+IMAGE_STORE_DIR = os.environ.get(
+    "RADIO_IMAGE_DIR",
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "image_store")),
+)
+IMAGE_WORKERS = int(os.environ.get("RADIO_IMAGE_WORKERS", "0")) or max(1, (os.cpu_count() or 1) // 2)
+MAX_UPLOAD_BYTES = int(os.environ.get("RADIO_MAX_UPLOAD_MB", "512")) * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+PIPELINE_VERSION = 1
+TILE_SIZE = 256
+THUMBNAIL_SIZE = 256
+PREVIEW_SIZE = 1024
+# Percentiles of the pixel values mapped to black and white
+WINDOW_PERCENTILES = (0.5, 99.5)
+# Pixels sampled to estimate the window, and rows converted at once (bounds the float32 copy)
+_WINDOW_SAMPLES = 1_000_000
+_NORMALIZE_ROWS = 512
+# Pool processes are replaced after this many images, returning their memory to the system
+_TASKS_PER_WORKER = 50
+
+IMAGE_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+_DERIVED_NAME_PATTERN = re.compile(r"^(thumbnail\.png|preview\.png|meta\.json|tiles/\d{1,2}/\d{1,5}_\d{1,5}\.png)$")
+
+# --- Processing (runs in the pool processes) ----------------------------------------------------
+
+def _read_grayscale(path: str):
+    """Decodes an image to a 2-D array: uint16 or int32 for high bit depth images, uint8 otherwise."""
+    from PIL import Image, ImageOps
+    with Image.open(path) as image:
+        image_format = image.format
+        mimetype = Image.MIME.get(image_format, "application/octet-stream")
+        # The EXIF orientation applies to every bit depth
+        oriented = ImageOps.exif_transpose(image)
+        if oriented.mode.startswith("I") or oriented.mode == "F":
+            pixels = np.asarray(oriented)
+            bits = 16 if oriented.mode.startswith("I;16") or pixels.max(initial=0) > 255 else 8
+        else:
+            pixels = np.asarray(oriented.convert("L"))
+            bits = 8
+    return pixels, bits, image_format, mimetype
+
+def _window(pixels: np.ndarray):
+    # Percentiles of a strided sample: exact enough for display, cheap on 30-megapixel images
+    step = max(1, int(math.sqrt(pixels.size / _WINDOW_SAMPLES)))
+    low, high = np.percentile(pixels[::step, ::step], WINDOW_PERCENTILES)
+    return float(low), float(max(high, low + 1))
+
+def normalize(pixels: np.ndarray, low: float, high: float) -> np.ndarray:
+    """Maps [low, high] to [0, 255], a block of rows at a time."""
+    normalized = np.empty(pixels.shape, dtype=np.uint8)
+    scale = 255.0 / (high - low)
+    for start in range(0, pixels.shape[0], _NORMALIZE_ROWS):
+        block = pixels[start:start + _NORMALIZE_ROWS].astype(np.float32)
+        block -= low
+        block *= scale
+        np.clip(block, 0, 255, out=block)
+        normalized[start:start + _NORMALIZE_ROWS] = np.rint(block)
+    return normalized
+
+def _save_scaled(source, size: int, path: str):
+    from PIL import Image
+    image = source.copy()
+    image.thumbnail((size, size), Image.Resampling.LANCZOS)
+    image.save(path, compress_level=1)
+
+def build_derived(original_path: str, derived_dir: str, tmp_dir: str) -> dict:
+    """
+    Writes the thumbnail, preview and tile pyramid of an image in derived_dir and returns its metadata.
+    Files are written to a temporary directory renamed at the end, so derived_dir is always complete.
+    A file that cannot be decoded gets an error file instead: {"error": "..."} is returned.
+    """
+    from PIL import Image, UnidentifiedImageError
+    start_time = time.perf_counter()
+    build_dir = os.path.join(tmp_dir, f"derived-{uuid.uuid4().hex}")
+    try:
+        pixels, bits, image_format, mimetype = _read_grayscale(original_path)
+        if pixels.ndim != 2 or not pixels.size:
+            raise ValueError(f"Unsupported image shape {pixels.shape}.")
+        low, high = _window(pixels)
+        level_image = Image.fromarray(normalize(pixels, low, high))
+        del pixels
+        height, width = level_image.height, level_image.width
+
+        os.makedirs(build_dir)
+        level = 0
+        preview_done = thumbnail_done = False
+        while True:
+            # Each level is the previous one halved: the small ones are cheap sources for the previews
+            if not preview_done and max(level_image.size) <= 2 * PREVIEW_SIZE:
+                _save_scaled(level_image, PREVIEW_SIZE, os.path.join(build_dir, "preview.png"))
+                preview_done = True
+            if not thumbnail_done and max(level_image.size) <= 2 * THUMBNAIL_SIZE:
+                _save_scaled(level_image, THUMBNAIL_SIZE, os.path.join(build_dir, "thumbnail.png"))
+                thumbnail_done = True
+            level_dir = os.path.join(build_dir, "tiles", str(level))
+            os.makedirs(level_dir)
+            for row in range(math.ceil(level_image.height / TILE_SIZE)):
+                for col in range(math.ceil(level_image.width / TILE_SIZE)):
+                    box = (col * TILE_SIZE, row * TILE_SIZE, min((col + 1) * TILE_SIZE, level_image.width),
+                           min((row + 1) * TILE_SIZE, level_image.height))
+                    level_image.crop(box).save(os.path.join(level_dir, f"{col}_{row}.png"), compress_level=1)
+            if max(level_image.size) <= TILE_SIZE:
+                break
+            level_image = level_image.reduce(2)
+            level += 1
+
+        meta = {
+            "id": os.path.basename(original_path),
+            "width": width,
+            "height": height,
+            "bits": bits,
+            "format": image_format,
+            "mimetype": mimetype,
+            "window": [low, high],
+            "tile_size": TILE_SIZE,
+            "levels": level + 1,
+            "pipeline_version": PIPELINE_VERSION,
+            "seconds": time.perf_counter() - start_time,
+            # Peak memory of the pool process so far (ru_maxrss is in kilobytes on Linux)
+            "worker_peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        }
+        with open(os.path.join(build_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        try:
+            os.rename(build_dir, derived_dir)
+        except OSError:
+            # Built concurrently by another process: its copy is identical
+            shutil.rmtree(build_dir, ignore_errors=True)
+        return meta
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError) as e:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        # The message may quote the server path of the file
+        error = {"error": f"{type(e).__name__}: {str(e).replace(original_path, 'image')}"}
+        with open(f"{derived_dir}.error.json", "w", encoding="utf-8") as f:
+            json.dump(error, f)
+        return error
+
+# --- Store (runs in the serving processes) ------------------------------------------------------
+
+class UploadTooLarge(ValueError):
+    """
+    Raised by ImageStore.save_upload() when the stream is larger than the allowed size.
+    """
+
+class ImageStore:
+    """
+    Content-addressed radiograph store with a process pool for the derived images.
+    """
+
+    def __init__(self, directory: str = IMAGE_STORE_DIR, workers: int = IMAGE_WORKERS):
+        self.directory = directory
+        self.workers = workers
+        self.tmp_dir = os.path.join(directory, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        os.makedirs(os.path.join(directory, "derived"), exist_ok=True)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._futures = {}
+        self.uploads = 0
+        self.uploaded_bytes = 0
+        self.upload_seconds = 0.0
+        self.processed = 0
+        self.failed = 0
+
+    def original_path(self, image_id: str) -> str:
+        return os.path.join(self.directory, "originals", image_id[:2], image_id)
+
+    def derived_dir(self, image_id: str) -> str:
+        return os.path.join(self.directory, "derived", f"{image_id}-v{PIPELINE_VERSION}")
+
+    def exists(self, image_id: str) -> bool:
+        return bool(IMAGE_ID_PATTERN.match(image_id)) and os.path.exists(self.original_path(image_id))
+
+    def save_upload(self, stream, max_bytes: int = MAX_UPLOAD_BYTES, chunk_size: int = UPLOAD_CHUNK_SIZE):
+        """
+        Copies a binary stream to the store chunk by chunk, hashing it on the way.
+        Returns (image_id, size, created); created is False when the same content was already stored.
+        Raises UploadTooLarge for a stream larger than max_bytes, ValueError for an empty one.
+        """
+        start_time = time.perf_counter()
+        digest = hashlib.sha256()
+        size = 0
+        tmp_path = os.path.join(self.tmp_dir, f"upload-{uuid.uuid4().hex}")
+        try:
+            with open(tmp_path, "wb") as f:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise UploadTooLarge(f"The image is larger than {max_bytes // (1024 * 1024)} MB.")
+                    digest.update(chunk)
+                    f.write(chunk)
+            if not size:
+                raise ValueError("The request body is empty: send the image file as the body.")
+            image_id = digest.hexdigest()
+            path = self.original_path(image_id)
+            created = not os.path.exists(path)
+            if created:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with self._lock:
+            self.uploads += 1
+            self.uploaded_bytes += size
+            self.upload_seconds += time.perf_counter() - start_time
+        return image_id, size, created
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        # Created on first use, in the serving process (after gunicorn's fork). "spawn" starts clean
+        # interpreters: forking a process running torch and request threads is not safe.
+        if self._pool is None:
+            context = multiprocessing.get_context("spawn")
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                             max_tasks_per_child=_TASKS_PER_WORKER)
+        return self._pool
+
+    def submit(self, image_id: str):
+        """
+        Starts building the derived images unless they exist, are being built by this process, or failed.
+        Returns the pending future, or None.
+        """
+        with self._lock:
+            future = self._futures.get(image_id)
+            if future is not None or self.status(image_id) != "pending":
+                return future
+            arguments = (self.original_path(image_id), self.derived_dir(image_id), self.tmp_dir)
+            try:
+                future = self._get_pool().submit(build_derived, *arguments)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for its memory): start a new pool
+                self._pool = None
+                future = self._get_pool().submit(build_derived, *arguments)
+            self._futures[image_id] = future
+        future.add_done_callback(lambda done: self._on_done(image_id, done))
+        return future
+
+    def _on_done(self, image_id: str, future):
+        with self._lock:
+            self._futures.pop(image_id, None)
+            # A future cancelled at shutdown raises CancelledError from exception()
+            if future.cancelled() or future.exception() is not None or "error" in future.result():
+                self.failed += 1
+            else:
+                self.processed += 1
+
+    def wait(self, image_id: str, timeout: float = None) -> str:
+        """Waits up to timeout seconds for the derived images; returns the status."""
+        future = self.submit(image_id)
+        if future is not None:
+            try:
+                future.result(timeout=timeout)
+            except Exception:
+                pass
+        return self.status(image_id)
+
+    def status(self, image_id: str) -> str:
+        """ready, failed, processing (in this process) or pending."""
+        derived_dir = self.derived_dir(image_id)
+        if os.path.exists(os.path.join(derived_dir, "meta.json")):
+            return "ready"
+        if os.path.exists(f"{derived_dir}.error.json"):
+            return "failed"
+        return "processing" if image_id in self._futures else "pending"
+
+    def describe(self, image_id: str) -> dict:
+        """Status of an image with its metadata once ready, or its error."""
+        status = self.status(image_id)
+        description = {"id": image_id, "size": os.path.getsize(self.original_path(image_id)), "status": status}
+        if status == "ready":
+            with open(os.path.join(self.derived_dir(image_id), "meta.json"), "r", encoding="utf-8") as f:
+                description["meta"] = json.load(f)
+        elif status == "failed":
+            with open(f"{self.derived_dir(image_id)}.error.json", "r", encoding="utf-8") as f:
+                description.update(json.load(f))
+        return description
+
+    def derived_path(self, image_id: str, name: str):
+        """Path of a derived file (e.g. "thumbnail.png", "tiles/0/3_2.png"), or None if it does not exist."""
+        if not _DERIVED_NAME_PATTERN.match(name):
+            return None
+        path = os.path.join(self.derived_dir(image_id), *name.split("/"))
+        return path if os.path.isfile(path) else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "uploads": self.uploads,
+                "uploaded_mb": self.uploaded_bytes / (1024 * 1024),
+                "upload_mb_per_sec": self.uploaded_bytes / (1024 * 1024) / self.upload_seconds
+                if self.upload_seconds else 0.0,
+                "processed": self.processed,
+                "failed": self.failed,
+                "processing": len(self._futures),
+                "workers": self.workers,
+            }
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+_image_store = None
+_image_store_lock = threading.Lock()
+
+def get_image_store() -> ImageStore:
+    """Returns the process-wide image store, created on first use."""
+    global _image_store
+    with _image_store_lock:
+        if _image_store is None:
+            _image_store = ImageStore()
+        return _image_store
@@ -1,16 +1,370 @@
-from flask import Flask, jsonify
+import json
+import os
+import sys
+import uuid
+
+from flask import Flask, jsonify, request, Response, send_file, stream_with_context
+
+# The RAG modules (rag_module.py, knowledge_base.py, ...) live at the root of the repository.
+RAG_PROJECT_DIR = os.environ.get(
+    "RAG_PROJECT_DIR",
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "..")),
+)
+if RAG_PROJECT_DIR not in sys.path:
+    sys.path.insert(0, RAG_PROJECT_DIR)
+# Use the project's ChromaDB store whatever the working directory of the server is
+os.environ.setdefault("CHROMA_DB_DIR", os.path.join(RAG_PROJECT_DIR, "chroma_db_store"))
+
+from app.rag_service import rag_service
+from app.imaging import IMAGE_ID_PATTERN, MAX_UPLOAD_BYTES, UploadTooLarge, get_image_store
 
 app = Flask(__name__)
 
+# Seconds a question waits for the model to finish loading before getting a 503
+ASK_WAIT_TIMEOUT = float(os.environ.get("RAG_ASK_WAIT_TIMEOUT", "300"))
+# Seconds a synchronous POST /api/documents waits for its ingestion job before answering 202
+INGEST_WAIT_TIMEOUT = float(os.environ.get("RAG_INGEST_WAIT_TIMEOUT", "60"))
+# Maximum seconds an image upload with ?wait= waits for its thumbnails and tiles
+IMAGE_WAIT_TIMEOUT = float(os.environ.get("RADIO_IMAGE_WAIT_TIMEOUT", "120"))
+# Images and their derived files are content-addressed: they never change once served
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+DEFAULT_SEARCH_RESULTS = 2
+MAX_SEARCH_RESULTS = 50
+
+if os.environ.get("RAG_WARMUP", "lazy") == "eager":
+    rag_service.start_warm_up()
+
+def serialize_document(doc):
+    """Converts a LangChain document to a JSON-serializable dict."""
+    return {"content": doc.page_content, "metadata": doc.metadata or {}}
+
+def get_question(payload):
+    """Returns the stripped question of a request payload, or None if missing."""
+    question = (payload.get("question") or "").strip()
+    return question or None
+
+def get_scope(payload):
+    """
+    Returns the (tenant, filters) of a request payload: "tenant" selects the tenant's collection,
+    "filters" ({"source": "...", "created_at": {"$gte": ...}}) restricts the search to matching metadata.
+    Raises ValueError if they are malformed.
+    """
+    tenant = payload.get("tenant")
+    filters = payload.get("filters")
+    if tenant is not None and not isinstance(tenant, str):
+        raise ValueError("'tenant' must be a string.")
+    if filters is not None and not isinstance(filters, dict):
+        raise ValueError("'filters' must be an object mapping metadata fields to values.")
+    return tenant, filters
+
+def model_unavailable_response(error):
+    return jsonify({"error": str(error), "status": rag_service.status()}), 503
+
 @app.route("/api/health")
 def health_check():
-    """Health check endpoint"""
+    """Health check endpoint (liveness: the process answers, the model may still be loading)"""
     return jsonify({"status": "ok", "message": "Backend is running!"})
 
+@app.route("/api/ready")
+def readiness_check():
+    """Readiness endpoint: 200 once the model is loaded, 503 while it is loading. Triggers the warm-up."""
+    rag_service.start_warm_up()
+    status = rag_service.status()
+    return jsonify(status), (200 if rag_service.is_ready() else 503)
+
+@app.route("/api/stats")
+def stats():
+    """
+    Runtime statistics: LLM batching (occupancy, queueing delay), embedding and answer cache counters,
+    image uploads and processing.
+    """
+    return jsonify({**rag_service.stats(), "imaging": get_image_store().stats()})
+
+@app.route("/api/metrics")
+def metrics():
+    """
+    Prometheus metrics: per-stage RAG latencies and token counts (when RAG_TRACE=1),
+    batching and cache counters.
+    """
+    from rag_tracing import render_prometheus
+    return Response(render_prometheus(rag_service.metric_samples()), mimetype="text/plain; version=0.0.4")
+
+@app.route("/api/ask", methods=["POST"])
+def ask():
+    """Answers a question with the RAG chain, optionally within a tenant and/or metadata filters."""
+    payload = request.get_json(silent=True) or {}
+    question = get_question(payload)
+    if question is None:
+        return jsonify({"error": "The 'question' field is required."}), 400
+    try:
+        tenant, filters = get_scope(payload)
+        chain = rag_service.get_chain(timeout=ASK_WAIT_TIMEOUT)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RuntimeError as e:
+        return model_unavailable_response(e)
+
+    from rag_module import ask_question_with_rag, get_retriever
+    try:
+        retriever = get_retriever(chain, tenant, filters)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    # Filtered answers depend on the filters: they bypass the answer cache
+    answer_cache = None if filters else rag_service.get_answer_cache(tenant)
+    result = ask_question_with_rag(chain, question, answer_cache=answer_cache, retriever=retriever)
+    return jsonify({
+        "question": question,
+        "answer": result["result"],
+        "source_documents": [serialize_document(doc) for doc in result["source_documents"]],
+    })
+
+@app.route("/api/ask/stream", methods=["POST"])
+def ask_stream():
+    """
+    Streams the RAG answer as newline-delimited JSON: a "sources" event with the
+    retrieved documents first, then one "token" event per piece of generated text
+    and a final "done" event.
+    """
+    payload = request.get_json(silent=True) or {}
+    question = get_question(payload)
+    if question is None:
+        return jsonify({"error": "The 'question' field is required."}), 400
+    try:
+        tenant, filters = get_scope(payload)
+        chain = rag_service.get_chain(timeout=ASK_WAIT_TIMEOUT)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RuntimeError as e:
+        return model_unavailable_response(e)
+
+    from rag_module import stream_question_with_rag, get_retriever
+    try:
+        retriever = get_retriever(chain, tenant, filters)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    answer_cache = None if filters else rag_service.get_answer_cache(tenant)
+
+    def generate():
+        for event in stream_question_with_rag(chain, question, answer_cache=answer_cache, retriever=retriever):
+            if event["type"] == "sources":
+                event = {"type": "sources",
+                         "source_documents": [serialize_document(doc) for doc in event["source_documents"]]}
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+        yield json.dumps({"type": "done"}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+@app.route("/api/search", methods=["POST"])
+def search():
+    """
+    Retrieval only: returns the documents closest to the query, without running the LLM.
+    Accepts the same "tenant" and "filters" as /api/ask.
+    """
+    payload = request.get_json(silent=True) or {}
+    query = (payload.get("query") or "").strip()
+    if not query:
+        return jsonify({"error": "The 'query' field is required."}), 400
+    try:
+        n_results = min(int(payload.get("n_results", DEFAULT_SEARCH_RESULTS)), MAX_SEARCH_RESULTS)
+    except (TypeError, ValueError):
+        return jsonify({"error": "'n_results' must be an integer."}), 400
+
+    from knowledge_base import query_documents, metadata_filter
+    try:
+        tenant, filters = get_scope(payload)
+        collection = rag_service.get_collection(tenant)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    results = query_documents(collection, query, n_results=n_results, where=metadata_filter(filters))
+    hits = [
+        {"id": doc_id, "content": document, "metadata": metadata or {}, "distance": distance}
+        for doc_id, document, metadata, distance in zip(results["ids"][0], results["documents"][0],
+                                                        results["metadatas"][0], results["distances"][0])
+    ]
+    return jsonify({"query": query, "results": hits})
+
+@app.route("/api/documents", methods=["POST"])
+def add_documents():
+    """
+    Bulk add: {"documents": [{"id": "...", "text": "...", "metadata": {...}}, ...], "tenant": "...",
+    "source": "api", "upsert": false, "async": false}. Documents without an ID get a generated UUID;
+    they are stored in the tenant's collection with their source, tenant and timestamps in their metadata. They are ingested by the background
+    ingestion queue: with "async": true the request returns 202 with the job right away,
+    otherwise it waits for the job (up to INGEST_WAIT_TIMEOUT seconds).
+    """
+    payload = request.get_json(silent=True) or {}
+    documents = payload.get("documents")
+    if not isinstance(documents, list) or not documents:
+        return jsonify({"error": "The 'documents' field must be a non-empty list."}), 400
+    items = []
+    for document in documents:
+        text = (document.get("text") or "").strip() if isinstance(document, dict) else ""
+        if not text:
+            return jsonify({"error": "Every document needs a non-empty 'text'."}), 400
+        metadata = document.get("metadata") or {}
+        if not isinstance(metadata, dict) or not all(
+                isinstance(value, (str, int, float, bool)) for value in metadata.values()):
+            return jsonify({"error": "A document 'metadata' must map fields to strings, numbers or booleans."}), 400
+        items.append((str(document.get("id") or uuid.uuid4()), text, metadata))
+
+    from ingest_queue import get_ingest_queue
+    from knowledge_base import tenant_collection_name, document_metadata
+    try:
+        tenant, _ = get_scope(payload)
+        collection_name = tenant_collection_name(tenant)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    job = get_ingest_queue().submit(items, collection_name, upsert=bool(payload.get("upsert", False)),
+                                    metadata=document_metadata(source=payload.get("source") or "api", tenant=tenant))
+    if payload.get("async") or not job.wait(INGEST_WAIT_TIMEOUT):
+        return jsonify({**job.to_dict(), "status_url": f"/api/ingest/{job.job_id}"}), 202
+    if job.status == "failed":
+        return jsonify(job.to_dict()), 500
+    return jsonify(job.to_dict()), 201
+
+@app.route("/api/ingest")
+def ingest_status():
+    """Ingestion queue counters (jobs by status) and the current knowledge base generation."""
+    from ingest_queue import get_ingest_queue
+    return jsonify(get_ingest_queue().stats())
+
+@app.route("/api/ingest/<job_id>")
+def ingest_job_status(job_id):
+    """Status of an ingestion job: queued, running, done or failed."""
+    from ingest_queue import get_ingest_queue
+    job = get_ingest_queue().get_job(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown ingestion job '{job_id}'."}), 404
+    return jsonify(job.to_dict())
+
+@app.route("/api/documents", methods=["DELETE"])
+def delete_documents():
+    """
+    Bulk delete: {"ids": ["...", ...], "tenant": "...", "async": false}. The deletion is queued behind
+    the ingestion jobs already submitted, so it never overtakes an earlier POST; like a POST it waits
+    for its job unless "async" is true. "deleted" is the number of IDs that were found and removed.
+    """
+    payload = request.get_json(silent=True) or {}
+    ids = payload.get("ids")
+    if not isinstance(ids, list) or not ids:
+        return jsonify({"error": "The 'ids' field must be a non-empty list."}), 400
+
+    from ingest_queue import get_ingest_queue
+    from knowledge_base import tenant_collection_name
+    try:
+        tenant, _ = get_scope(payload)
+        collection_name = tenant_collection_name(tenant)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    job = get_ingest_queue().submit_delete([str(doc_id) for doc_id in ids], collection_name)
+    if payload.get("async") or not job.wait(INGEST_WAIT_TIMEOUT):
+        return jsonify({**job.to_dict(), "status_url": f"/api/ingest/{job.job_id}"}), 202
+    if job.status == "failed":
+        return jsonify(job.to_dict()), 500
+    return jsonify(job.to_dict())
+
+@app.route("/api/adapter", methods=["POST"])
+def load_adapter():
+    """
+    Loads the LoRA adapter written by fine_tune_model.py --lora in place of the current one:
+    {"path": "tinyllama_lora"} (optional). The other workers load it before their next answer.
+    """
+    payload = request.get_json(silent=True) or {}
+    try:
+        adapter_name = rag_service.load_adapter(payload.get("path"))
+    except RuntimeError as e:
+        return model_unavailable_response(e)
+    except (OSError, ValueError) as e:
+        return jsonify({"error": f"Cannot load the adapter: {e}"}), 400
+    return jsonify({"adapter": adapter_name, "pid": os.getpid()})
+
+@app.route("/api/adapter", methods=["DELETE"])
+def unload_adapter():
+    """Removes the LoRA adapter: answers come from the base weights again, in every worker."""
+    try:
+        unloaded = rag_service.unload_adapter()
+    except RuntimeError as e:
+        return model_unavailable_response(e)
+    return jsonify({"unloaded": unloaded, "pid": os.getpid()})
+
+def image_not_found_response(image_id):
+    return jsonify({"error": f"Unknown image '{image_id}'."}), 404
+
+def send_immutable_file(path, mimetype):
+    """Serves a content-addressed file with range requests (206) and long-lived browser caching."""
+    response = send_file(path, mimetype=mimetype, conditional=True, max_age=IMMUTABLE_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
+@app.route("/api/images", methods=["POST"])
+def upload_image():
+    """
+    Streaming upload of a radiograph: the request body is the image file itself (not a multipart form),
+    written to disk in chunks. The image is identified by the SHA-256 of its content; its thumbnail,
+    preview and tiles are built in the background. ?wait=<seconds> waits for them (up to IMAGE_WAIT_TIMEOUT).
+    """
+    if request.mimetype.startswith("multipart/"):
+        return jsonify({"error": "Send the image file as the raw request body, not as a multipart form."}), 400
+    if request.content_length is not None and request.content_length > MAX_UPLOAD_BYTES:
+        return jsonify({"error": f"The image is larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB."}), 413
+    try:
+        wait = min(float(request.args.get("wait", 0)), IMAGE_WAIT_TIMEOUT)
+    except ValueError:
+        return jsonify({"error": "'wait' must be a number of seconds."}), 400
+    image_store = get_image_store()
+    try:
+        image_id, _, created = image_store.save_upload(request.stream)
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if wait > 0:
+        image_store.wait(image_id, wait)
+    else:
+        image_store.submit(image_id)
+    return jsonify({**image_store.describe(image_id), "created": created,
+                    "url": f"/api/images/{image_id}"}), (201 if created else 200)
+
+@app.route("/api/images/<image_id>")
+def image_status(image_id):
+    """
+    Status of an image (pending, processing, ready or failed) with its size, bit depth, intensity
+    window and tile pyramid once ready. Starts the processing if no process has done it yet.
+    """
+    image_store = get_image_store()
+    if not image_store.exists(image_id):
+        return image_not_found_response(image_id)
+    image_store.submit(image_id)
+    description = image_store.describe(image_id)
+    return jsonify(description), (202 if description["status"] in ("pending", "processing") else 200)
+
+@app.route("/api/images/<image_id>/original")
+def image_original(image_id):
+    """The uploaded file, with range requests for progressive loading of large images."""
+    image_store = get_image_store()
+    if not image_store.exists(image_id):
+        return image_not_found_response(image_id)
+    meta = image_store.describe(image_id).get("meta") or {}
+    return send_immutable_file(image_store.original_path(image_id), meta.get("mimetype", "application/octet-stream"))
+
+@app.route("/api/images/<image_id>/<path:name>")
+def image_derived(image_id, name):
+    """Derived files: thumbnail.png, preview.png and tiles/<level>/<col>_<row>.png (level 0 is full size)."""
+    image_store = get_image_store()
+    if not IMAGE_ID_PATTERN.match(image_id):
+        return image_not_found_response(image_id)
+    path = image_store.derived_path(image_id, name)
+    if path is None:
+        status = image_store.status(image_id) if image_store.exists(image_id) else "unknown"
+        if status in ("pending", "processing"):
+            image_store.submit(image_id)
+            return jsonify({"error": f"Image '{image_id}' is still being processed.", "status": status}), 202
+        return jsonify({"error": f"No '{name}' for image '{image_id}'.", "status": status}), 404
+    return send_immutable_file(path, "image/png")
+
 # Point d'entrée principal pour l'exécution directe (optionnel avec flask run)
 if __name__ == '__main__':
     # Note: 'flask run' est généralement préféré pour le développement
     # et gunicorn/waitress pour la production.
     # Le host='0.0.0.0' est important pour Docker.
     app.run(host='0.0.0.0', port=5000, debug=True)
-
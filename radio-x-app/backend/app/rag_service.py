@@ -0,0 +1,280 @@
+"""
+Process-wide RAG components shared by every request of the Flask backend.
+
+The knowledge collection (and its ChromaDB client) is opened on first use and
+is enough for retrieval and ingestion. The LLM and the RAG chain are loaded
+once per process in a background thread ("warm-up"), so the server answers
+health and readiness probes while the model is loading.
+
+A LoRA adapter loaded or removed through the API is recorded in ADAPTER_STATE_FILE
+(next to the knowledge base); every worker process compares it with the version it
+applied before answering, so all the gunicorn workers serve the same weights.
+"""
+import json
+import os
+import threading
+import time
+
+ADAPTER_STATE_FILE = "adapter.json"
+
+class RagService:
+    """
+    Holds the single LLM, RAG chain and knowledge collection of the process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._warm_up_thread = None
+        self._tenant_answer_caches = {}
+        # Serializes the adapter changes of this process; _adapter_version is the last state applied
+        self._adapter_lock = threading.Lock()
+        self._adapter_version = 0
+        self.llm = None
+        self.chain = None
+        self.batcher = None
+        self.answer_cache = None
+        self.error = None
+        self.load_seconds = None
+
+    def get_collection(self, tenant: str = None):
+        """
+        Returns the knowledge collection (or a tenant's), opening it on first use (no LLM needed).
+        Raises ValueError for an invalid tenant name.
+        """
+        from knowledge_base import get_tenant_collection
+        return get_tenant_collection(tenant) # Handles are cached by knowledge_base
+
+    def get_answer_cache(self, tenant: str = None):
+        """Returns the answer cache of a tenant (the shared one without tenant); None until ready."""
+        if tenant is None or self.answer_cache is None:
+            return self.answer_cache
+        with self._lock:
+            if tenant not in self._tenant_answer_caches:
+                from rag_module import create_answer_cache
+                self._tenant_answer_caches[tenant] = create_answer_cache()
+            return self._tenant_answer_caches[tenant]
+
+    def start_warm_up(self):
+        """Starts loading the LLM and the RAG chain in the background, unless already loading or loaded."""
+        with self._lock:
+            if self._ready.is_set() or (self._warm_up_thread is not None and self._warm_up_thread.is_alive()):
+                return
+            self.error = None
+            self._warm_up_thread = threading.Thread(target=self._warm_up, name="rag-warm-up", daemon=True)
+            self._warm_up_thread.start()
+
+    def _warm_up(self):
+        start_time = time.perf_counter()
+        try:
+            from rag_module import load_llm, setup_rag_chain, create_answer_cache, COLLECTION_NAME, EMBEDDING_MODEL_NAME
+            from batching import create_batched_llm, DEFAULT_MAX_BATCH_SIZE
+            self.get_collection()
+            llm = load_llm()
+            if DEFAULT_MAX_BATCH_SIZE > 1:
+                # Concurrent questions share padded generate() calls
+                llm = create_batched_llm(llm)
+                self.batcher = llm.batcher
+            self.llm = llm
+            self.chain = setup_rag_chain(llm, COLLECTION_NAME, EMBEDDING_MODEL_NAME)
+            self.answer_cache = create_answer_cache()
+            self.load_seconds = time.perf_counter() - start_time
+            self._ready.set()
+            print(f"RAG service ready in {self.load_seconds:.1f}s.")
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            print(f"RAG service warm-up failed: {self.error}")
+
+    def is_ready(self) -> bool:
+        return self._ready.is_set()
+
+    def get_chain(self, timeout: float = None):
+        """
+        Returns the RAG chain, starting the warm-up if needed and waiting up to timeout seconds.
+        Raises RuntimeError if the chain is not available.
+        """
+        self.start_warm_up()
+        if not self._ready.wait(timeout):
+            raise RuntimeError(self.error or "The model is still loading.")
+        self.sync_adapter()
+        return self.chain
+
+    @staticmethod
+    def _adapter_state_path() -> str:
+        from knowledge_base import DB_DIR
+        return os.path.join(DB_DIR, ADAPTER_STATE_FILE)
+
+    def _read_adapter_state(self) -> dict:
+        try:
+            with open(self._adapter_state_path(), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {"version": 0, "path": None}
+
+    def _write_adapter_state(self, state: dict):
+        path = self._adapter_state_path()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+
+    def _apply_adapter_state(self, state: dict):
+        # Called with _adapter_lock held. Returns the adapter name, or whether an adapter was removed.
+        from rag_module import load_adapter, unload_adapter
+        if state["path"]:
+            result = changed = load_adapter(self.llm, state["path"])
+        else:
+            result = changed = unload_adapter(self.llm)
+        if changed:
+            # The answers were given with the previous weights
+            with self._lock:
+                for answer_cache in [self.answer_cache, *self._tenant_answer_caches.values()]:
+                    answer_cache.clear()
+        self._adapter_version = state["version"]
+        return result
+
+    def sync_adapter(self):
+        """
+        Applies the adapter change made by another worker process since the last call, if any.
+        """
+        if self._read_adapter_state()["version"] == self._adapter_version:
+            return
+        with self._adapter_lock:
+            state = self._read_adapter_state()
+            if state["version"] == self._adapter_version:
+                return
+            try:
+                self._apply_adapter_state(state)
+            except Exception as e:
+                # Not retried on every request: the next change through the API is applied again
+                self._adapter_version = state["version"]
+                print(f"Cannot apply the adapter state {state}: {type(e).__name__}: {e}")
+
+    def load_adapter(self, adapter_dir: str = None) -> str:
+        """
+        Swaps the LoRA adapter of the loaded model (see rag_module.load_adapter) and clears
+        the answers given with the previous weights. The other worker processes follow
+        before their next answer (see sync_adapter).
+        """
+        from rag_module import LORA_ADAPTER_DIR
+        self.get_chain()
+        with self._adapter_lock:
+            state = {"version": time.time_ns(), "path": adapter_dir or LORA_ADAPTER_DIR}
+            # Applied here first: an adapter that fails to load is not published
+            adapter_name = self._apply_adapter_state(state)
+            self._write_adapter_state(state)
+        return adapter_name
+
+    def unload_adapter(self) -> bool:
+        """Goes back to the base weights, in every worker; returns False if no adapter was loaded."""
+        self.get_chain()
+        with self._adapter_lock:
+            state = {"version": time.time_ns(), "path": None}
+            unloaded = self._apply_adapter_state(state)
+            if unloaded:
+                self._write_adapter_state(state)
+        return unloaded
+
+    def active_adapter(self):
+        if not self.is_ready():
+            return None
+        from rag_module import active_adapter
+        return active_adapter(self.llm)
+
+    def status(self) -> dict:
+        if self.is_ready():
+            state = "ready"
+        elif self.error:
+            state = "error"
+        elif self._warm_up_thread is not None:
+            state = "loading"
+        else:
+            state = "idle"
+        return {"state": state, "error": self.error, "load_seconds": self.load_seconds,
+                "adapter": self.active_adapter()}
+
+    def stats(self) -> dict:
+        """Returns the runtime statistics of the shared components."""
+        from knowledge_base import get_embedding_function
+        return {
+            "service": self.status(),
+            "batching": self.batcher.get_metrics() if self.batcher is not None else None,
+            "embedding_cache": get_embedding_function().stats(),
+            "answer_cache": self.answer_cache.stats() if self.answer_cache is not None else None,
+            "prefix_cache": self._prefix_cache_stats(),
+            "reranker": self._reranker_stats(),
+            "speculative": self._speculative_stats(),
+        }
+
+    def _reranker_stats(self):
+        reranker = getattr(self.chain.retriever, "reranker", None) if self.is_ready() else None
+        return reranker.stats() if reranker is not None else None
+
+    def _prefix_cache_stats(self):
+        # prefix_cache imports torch: only read once the model is loaded
+        if not self.is_ready():
+            return None
+        from prefix_cache import prefix_cache
+        return prefix_cache.stats()
+
+    def _speculative_stats(self):
+        if not self.is_ready():
+            return None
+        from generation import SPECULATIVE_MODE, speculative_stats
+        return speculative_stats(self.llm) if SPECULATIVE_MODE != "off" else None
+
+    def metric_samples(self) -> list:
+        """
+        Returns the statistics as (name, type, help, value) tuples for rag_tracing.render_prometheus().
+        """
+        stats = self.stats()
+        samples = [("rag_model_ready", "gauge", "1 once the LLM is loaded in this process.", int(self.is_ready()))]
+        batching = stats["batching"]
+        if batching is not None:
+            samples += [
+                ("rag_batches_total", "counter", "LLM generate() calls made by the batching scheduler.",
+                 batching["batches"]),
+                ("rag_batch_occupancy", "gauge", "Mean LLM batch size relative to the maximum batch size.",
+                 batching["occupancy"]),
+                ("rag_batch_queue_delay_p95_seconds", "gauge", "95th percentile of the time prompts wait in the queue.",
+                 batching["queue_delay_ms"]["p95"] / 1000.0),
+            ]
+        embedding_cache = stats["embedding_cache"]
+        samples += [
+            ("rag_embedding_cache_hits_total", "counter", "Texts whose embedding was read from the cache.",
+             embedding_cache["hits"]),
+            ("rag_embedding_cache_misses_total", "counter", "Texts embedded by the model.",
+             embedding_cache["misses"]),
+        ]
+        answer_cache = stats["answer_cache"]
+        if answer_cache is not None:
+            samples += [
+                ("rag_answer_cache_lookups_total", "counter", "Answer cache lookups by result.",
+                 answer_cache["exact_hits"], {"result": "exact_hit"}),
+                ("rag_answer_cache_lookups_total", "counter", "Answer cache lookups by result.",
+                 answer_cache["semantic_hits"], {"result": "semantic_hit"}),
+                ("rag_answer_cache_lookups_total", "counter", "Answer cache lookups by result.",
+                 answer_cache["misses"], {"result": "miss"}),
+            ]
+        reranker = stats["reranker"]
+        if reranker is not None:
+            samples += [
+                ("rag_rerank_questions_total", "counter", "Questions by reranking decision.",
+                 reranker["reranked"], {"decision": "reranked"}),
+                ("rag_rerank_questions_total", "counter", "Questions by reranking decision.",
+                 reranker["skipped"], {"decision": "skipped"}),
+                ("rag_rerank_batch_occupancy", "gauge", "Mean cross-encoder batch size relative to the maximum.",
+                 reranker["batching"]["occupancy"]),
+            ]
+        prefix = stats["prefix_cache"]
+        if prefix is not None:
+            samples += [
+                ("rag_prefix_cache_reused_tokens_total", "counter",
+                 "Prompt tokens whose key/value cache was reused instead of prefilled.", prefix["reused_tokens"]),
+                ("rag_prefix_cache_bytes", "gauge", "Memory held by the cached prompt prefixes.",
+                 int(prefix["megabytes"] * 1024 * 1024)),
+            ]
+        return samples
+
+# Single instance per process
+rag_service = RagService()
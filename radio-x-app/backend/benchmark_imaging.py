@@ -0,0 +1,155 @@
+"""
+Throughput and memory benchmark of the radiograph pipeline (app/imaging.py).
+
+Synthetic 16-bit radiographs (smooth anatomy-like shapes plus noise, saved as
+uncompressed TIFF: 40 MB at 4096 x 5120) are generated in worker processes,
+then:
+    upload      streamed into a fresh image store in chunks, as POST /api/images does;
+                the growth of the serving process's peak RSS shows that files are
+                not buffered in memory
+    processing  decoded, normalized and cut into thumbnails and tiles by the process
+                pool: images/sec, MB/sec and the peak RSS of the pool processes
+    serving     range requests on the originals and tile requests through the Flask
+                routes (test client): requests/sec
+
+Usage:
+    python benchmark_imaging.py --num-images 8 --width 4096 --height 5120 --workers 4
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+def synthesize_radiograph(path: str, width: int, height: int, seed: int):
+    """Writes a 16-bit grayscale TIFF with a few soft elliptical structures and noise."""
+    from PIL import Image
+    rng = np.random.default_rng(seed)
+    ys, xs = np.ogrid[0:height, 0:width]
+    pixels = np.full((height, width), 6000.0, dtype=np.float32)
+    for _ in range(6):
+        center_x, center_y = rng.uniform(0.2, 0.8) * width, rng.uniform(0.2, 0.8) * height
+        radius_x, radius_y = rng.uniform(0.05, 0.3) * width, rng.uniform(0.05, 0.3) * height
+        distance = ((xs - center_x) / radius_x) ** 2 + ((ys - center_y) / radius_y) ** 2
+        pixels += rng.uniform(4000, 20000) * np.exp(-distance)
+    pixels += rng.normal(0, 800, size=pixels.shape).astype(np.float32)
+    Image.fromarray(np.clip(pixels, 0, 65535).astype(np.uint16)).save(path, format="TIFF")
+    return os.path.getsize(path)
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def run_benchmark(args) -> dict:
+    work_dir = tempfile.mkdtemp(prefix="imaging_benchmark_")
+    os.environ["RADIO_IMAGE_DIR"] = os.path.join(work_dir, "store")
+    from app.imaging import ImageStore
+    try:
+        # Generated in other processes, so this process's peak RSS stays at its baseline
+        paths = [os.path.join(work_dir, f"radiograph-{index}.tif") for index in range(args.num_images)]
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            sizes = list(pool.map(synthesize_radiograph, paths, [args.width] * len(paths),
+                                  [args.height] * len(paths), range(len(paths))))
+        total_mb = sum(sizes) / (1024 * 1024)
+        print(f"Generated {len(paths)} images of {args.width}x{args.height} (16-bit, {total_mb:.0f} MB in total)")
+
+        store = ImageStore(os.environ["RADIO_IMAGE_DIR"], workers=args.workers)
+        rss_before = peak_rss_mb()
+        start_time = time.perf_counter()
+        image_ids = []
+        for path in paths:
+            with open(path, "rb") as f:
+                image_ids.append(store.save_upload(f)[0])
+        upload_seconds = time.perf_counter() - start_time
+        upload_rss_growth = peak_rss_mb() - rss_before
+        print(f"Uploaded in {upload_seconds:.2f}s ({total_mb / upload_seconds:.0f} MB/s), "
+              f"peak RSS growth {upload_rss_growth:.1f} MB")
+
+        start_time = time.perf_counter()
+        futures = [store.submit(image_id) for image_id in image_ids]
+        metas = [future.result() for future in futures]
+        processing_seconds = time.perf_counter() - start_time
+        store.shutdown()
+        failures = [meta["error"] for meta in metas if "error" in meta]
+        if failures:
+            raise RuntimeError(f"Processing failed: {failures[0]}")
+        print(f"Processed in {processing_seconds:.2f}s ({len(paths) / processing_seconds:.2f} images/s)")
+
+        from app.main import app
+        client = app.test_client()
+        rng = random.Random(0)
+        requests = []
+        for image_id, meta in zip(image_ids, metas):
+            size = os.path.getsize(store.original_path(image_id))
+            for _ in range(args.requests_per_image):
+                start = rng.randrange(size)
+                requests.append((f"/api/images/{image_id}/original",
+                                 {"Range": f"bytes={start}-{min(size, start + 1024 * 1024) - 1}"}))
+                level = rng.randrange(meta["levels"])
+                scale = 2 ** level
+                col = rng.randrange(-(-meta["width"] // scale // meta["tile_size"]) or 1)
+                row = rng.randrange(-(-meta["height"] // scale // meta["tile_size"]) or 1)
+                requests.append((f"/api/images/{image_id}/tiles/{level}/{col}_{row}.png", {}))
+        served_bytes = 0
+        start_time = time.perf_counter()
+        for url, headers in requests:
+            response = client.get(url, headers=headers)
+            if response.status_code not in (200, 206):
+                raise RuntimeError(f"GET {url} returned {response.status_code}")
+            served_bytes += len(response.data)
+        serving_seconds = time.perf_counter() - start_time
+        print(f"Served {len(requests)} requests in {serving_seconds:.2f}s "
+              f"({len(requests) / serving_seconds:.0f} requests/s)")
+
+        return {
+            "num_images": len(paths),
+            "width": args.width,
+            "height": args.height,
+            "workers": args.workers,
+            "total_mb": total_mb,
+            "upload_seconds": upload_seconds,
+            "upload_mb_per_sec": total_mb / upload_seconds,
+            "upload_peak_rss_growth_mb": upload_rss_growth,
+            "processing_seconds": processing_seconds,
+            "images_per_sec": len(paths) / processing_seconds,
+            "processing_mb_per_sec": total_mb / processing_seconds,
+            "mean_image_seconds": sum(meta["seconds"] for meta in metas) / len(metas),
+            "pool_process_peak_rss_mb": max(meta["worker_peak_rss_mb"] for meta in metas),
+            "tiles_per_image": sum(len(files) for _, _, files in
+                                   os.walk(os.path.join(store.derived_dir(image_ids[0]), "tiles"))),
+            "serving_requests": len(requests),
+            "serving_requests_per_sec": len(requests) / serving_seconds,
+            "serving_mb_per_sec": served_bytes / (1024 * 1024) / serving_seconds,
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark radiograph upload, processing and serving.")
+    parser.add_argument("--num-images", type=int, default=8)
+    parser.add_argument("--width", type=int, default=4096)
+    parser.add_argument("--height", type=int, default=5120)
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 1) // 2))
+    parser.add_argument("--requests-per-image", type=int, default=50,
+                        help="Range requests on the original and tile requests per image.")
+    parser.add_argument("--output", default="imaging_benchmark.json")
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nPool process peak RSS: {results['pool_process_peak_rss_mb']:.0f} MB "
+          f"for {results['total_mb'] / results['num_images']:.0f} MB images")
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Multi-process serving of the backend with a single copy of the LLM weights.
+
+The master process maps the weights from the shared file (shared_model.py) before
+forking the workers; the workers inherit the model and its read-only memory-mapped
+pages, so adding workers adds their activations and caches, not 2 GB of weights.
+Each worker loads the rest of the RAG service (ChromaDB client, embeddings,
+batching threads) itself after the fork.
+
+    gunicorn -c gunicorn.conf.py app.main:app
+
+Configuration (environment variables):
+    GUNICORN_WORKERS   number of worker processes (default 2)
+    GUNICORN_THREADS   request threads per worker (default 8, they share the worker's batching queue)
+    RAG_TORCH_THREADS  torch threads per worker (default: CPU cores / workers)
+
+With RAG_PRECISION=int8 the weights cannot be mapped (see shared_model.py): each
+worker loads its own quantized copy instead.
+"""
+import os
+import sys
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("GUNICORN_WORKERS", "2"))
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+worker_class = "gthread"
+timeout = 120
+# The application (and the shared model below) is loaded once, before the workers are forked
+preload_app = True
+
+RAG_PROJECT_DIR = os.environ.get(
+    "RAG_PROJECT_DIR",
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")),
+)
+# int8 dynamic quantization rewrites the modules after loading: its weights cannot be shared
+SHAREABLE_PRECISION = os.environ.get("RAG_PRECISION", "fp16") != "int8"
+os.environ.setdefault("RAG_SHARED_MODEL", "1" if SHAREABLE_PRECISION else "0")
+# The warm-up thread must run in the workers: threads are not inherited through fork()
+WARM_UP_WORKERS = os.environ.get("RAG_WARMUP", "lazy") == "eager"
+os.environ["RAG_WARMUP"] = "lazy"
+
+def on_starting(server):
+    if os.environ["RAG_SHARED_MODEL"] != "1":
+        return
+    if not SHAREABLE_PRECISION:
+        # Set explicitly: the workers (which inherit the environment) load the model themselves
+        server.log.warning("RAG_SHARED_MODEL=1 is not supported with RAG_PRECISION=int8: "
+                           "each worker loads its own copy of the model.")
+        os.environ["RAG_SHARED_MODEL"] = "0"
+        return
+    if RAG_PROJECT_DIR not in sys.path:
+        sys.path.insert(0, RAG_PROJECT_DIR)
+    # Only torch and transformers are imported here: the ChromaDB client and its SQLite
+    # connections must be opened by each worker, not inherited through fork()
+    from shared_model import DEFAULT_MODEL_NAME, load_shared_model
+    from model_loader import DEFAULT_PRECISION
+    load_shared_model(DEFAULT_MODEL_NAME, DEFAULT_PRECISION)
+    server.log.info("Shared model weights mapped before forking the workers.")
+
+def post_fork(server, worker):
+    # Workers share the CPU cores instead of each starting one torch thread per core
+    torch_threads = int(os.environ.get("RAG_TORCH_THREADS", "0")) or max(1, (os.cpu_count() or 1) // workers)
+    import torch
+    torch.set_num_threads(torch_threads)
+    if WARM_UP_WORKERS:
+        from app.rag_service import rag_service
+        rag_service.start_warm_up()
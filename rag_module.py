@@ -1,115 +1,318 @@
-import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline as hf_pipeline
+from transformers import pipeline as hf_pipeline
 
-from langchain_huggingface import HuggingFacePipeline, HuggingFaceEmbeddings
-from langchain_community.vectorstores import Chroma
+from langchain_huggingface import HuggingFacePipeline
 from langchain.prompts import PromptTemplate
 from langchain.chains import RetrievalQA
 
 # Functions from knowledge_base.py (simplified for direct use here)
-import chromadb
 import os
+import threading
+import time
+from knowledge_base import DB_DIR, COLLECTION_NAME, SEED_DOCUMENTS, EMBEDDING_MODEL_NAME, get_embedding_function, \
+                           get_generation, get_lexical_index, rebuild_lexical_index, client as kb_client, \
+                           get_tenant_collection, metadata_filter, VECTOR_BACKEND, get_quantized_collection, \
+                           get_or_create_collection
+from answer_cache import AnswerCache
+from ingest import sync_documents
+from generation import MAX_NEW_TOKENS, get_model_and_tokenizer, generate_text, register_prompt_prefix, stream_generate, \
+                       change_weights
+from batching import BatchedLLM
+from rag_tracing import trace_request, trace_stage
+from model_loader import DEFAULT_PRECISION, load_model, load_tokenizer
+from retrievers import TokenBudgetRetriever
+from reranker import RERANK_ENABLED, DEFAULT_RERANK_CANDIDATES, get_reranker
 
-DB_DIR = "chroma_db_store"
-COLLECTION_NAME = "llm_knowledge"
 
 def initialize_and_get_collection():
     if not os.path.exists(DB_DIR):
         os.makedirs(DB_DIR)
-    persistent_client = chromadb.PersistentClient(path=DB_DIR)
+    # Reuse the process-wide client from knowledge_base.py instead of opening another one
+    persistent_client = kb_client
+    embedding_function = get_embedding_function()
+    if VECTOR_BACKEND == "quantized":
+        return get_quantized_collection(COLLECTION_NAME, embedding_function)
     try:
-        collection = persistent_client.get_collection(name=COLLECTION_NAME)
+        collection = persistent_client.get_collection(name=COLLECTION_NAME, embedding_function=embedding_function)
         print(f"Collection '{COLLECTION_NAME}' retrieved.")
     except:
-        collection = persistent_client.create_collection(name=COLLECTION_NAME)
+        collection = persistent_client.create_collection(name=COLLECTION_NAME, embedding_function=embedding_function)
         print(f"Collection '{COLLECTION_NAME}' created.")
     return collection
 
 def add_documents_if_not_exist(collection):
-    documents_to_add = {
-        "doc1": "Le ciel est bleu.",
-        "doc2": "L'herbe est verte.",
-        "doc3": "Paris est la capitale de la France.",
-        "doc4": "Les pommes sont généralement rouges ou vertes.",
-        "doc5": "Le soleil brille pendant la journée."
-    }
-    existing_ids = collection.get(ids=list(documents_to_add.keys()))['ids']
-    added_new = False
-    for doc_id, text in documents_to_add.items():
-        if doc_id not in existing_ids:
-            collection.add(documents=[text], ids=[doc_id])
-            print(f"Document ID '{doc_id}' added to collection '{collection.name}'.")
-            added_new = True
-    if not added_new and existing_ids:
-        print("All documents already exist in the collection.")
+    # Only new or modified seed documents are embedded, see ingest.sync_documents
+    sync_documents(collection, SEED_DOCUMENTS.items(), source="seed")
 
 # --- RAG Module specific code ---
 
 MODEL_NAME = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
-EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2" # Chroma's default
+MAX_CONTEXT_TOKENS = 2048 # TinyLlama context window
+# Tokens of retrieved context per question, and number of chunks fetched before packing
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("RAG_CONTEXT_TOKENS", "512"))
+MAX_RETRIEVED_CHUNKS = int(os.environ.get("RAG_MAX_CHUNKS", "4"))
+# "hybrid" fuses the vector search with the BM25 index, "vector" uses the vector search only
+RETRIEVAL_MODE = os.environ.get("RAG_RETRIEVAL_MODE", "hybrid")
+# LoRA adapter written by fine_tune_model.py --lora
+LORA_ADAPTER_DIR = os.environ.get("RAG_LORA_ADAPTER_DIR", "tinyllama_lora")
 
-def load_llm():
+RAG_PROMPT_TEMPLATE = """
+    Utilisez les informations suivantes issues de la base de connaissances pour répondre à la question. Si vous ne connaissez pas la réponse ou que l'information n'est pas présente, dites simplement que vous ne savez pas. Ne faites pas d'hypothèses.
+
+    Contexte: {context}
+
+    Question: {question}
+
+    Réponse utile:"""
+
+def load_llm(precision: str = DEFAULT_PRECISION, timings: dict = None):
+    """
+    Loads the tokenizer and the model and wraps them in a LangChain pipeline.
+    If a timings dict is given, the seconds spent in each step are recorded in it.
+    """
+    timings = timings if timings is not None else {}
     print(f"Loading LLM: {MODEL_NAME}")
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-    model = AutoModelForCausalLM.from_pretrained(
-        MODEL_NAME,
-        torch_dtype=torch.float16, # Using float16 for potentially lower memory
-        device_map="auto" # Let accelerate handle device mapping
-    )
-    # Ensure pad_token_id is set if eos_token_id is used for padding
-    if tokenizer.pad_token_id is None:
-        tokenizer.pad_token_id = tokenizer.eos_token_id
+    step_start = time.perf_counter()
+    tokenizer = load_tokenizer(MODEL_NAME)
+    timings["tokenizer"] = time.perf_counter() - step_start
+    # fp16 (default), fp32, bf16 or int8, see model_loader.py
+    step_start = time.perf_counter()
+    model = load_model(MODEL_NAME, precision=precision)
+    timings[f"model ({precision})"] = time.perf_counter() - step_start
 
+    step_start = time.perf_counter()
     pipe = hf_pipeline(
         "text-generation",
         model=model,
         tokenizer=tokenizer,
-        max_new_tokens=150, # Max tokens to generate
+        max_new_tokens=MAX_NEW_TOKENS,
         #temperature=0.7,
         #top_k=50,
         #do_sample=True
     )
-    return HuggingFacePipeline(pipeline=pipe)
+    llm = HuggingFacePipeline(pipeline=pipe)
+    timings["pipeline"] = time.perf_counter() - step_start
+    return llm
 
 def setup_rag_chain(llm, collection_name, embedding_model_name):
     print(f"Setting up RAG chain with embedding model: {embedding_model_name}")
-    # Configure embeddings
-    embeddings = HuggingFaceEmbeddings(model_name=embedding_model_name)
-
-    # Configure vector store retriever from existing ChromaDB
-    vector_store = Chroma(
-        client=chromadb.PersistentClient(path=DB_DIR),
-        collection_name=collection_name,
-        embedding_function=embeddings,
-    )
-    retriever = vector_store.as_retriever(search_kwargs={"k": 2}) # Retrieve top 2 documents
+    # Configure embeddings (shared with knowledge_base.py and backed by the persistent embedding cache)
+    embeddings = get_embedding_function(embedding_model_name)
 
-    # Define the prompt template
-    template = """
-    Utilisez les informations suivantes issues de la base de connaissances pour répondre à la question. Si vous ne connaissez pas la réponse ou que l'information n'est pas présente, dites simplement que vous ne savez pas. Ne faites pas d'hypothèses.
-
-    Contexte: {context}
+    # Collection of the ChromaDB (or its quantized index), queried with the cached embeddings.
+    # It is created if missing, so the chain can be built before anything was ingested.
+    if embedding_model_name == EMBEDDING_MODEL_NAME:
+        collection = get_or_create_collection(collection_name) # Cached handle, as for the tenants
+    elif VECTOR_BACKEND == "quantized":
+        collection = get_quantized_collection(collection_name, embeddings)
+    else:
+        collection = kb_client.get_or_create_collection(name=collection_name, embedding_function=embeddings)
+    lexical_index = _lexical_index_for(collection) if RETRIEVAL_MODE == "hybrid" else None
 
-    Question: {question}
+    # Retrieve the best chunks that fit in the token budget, so prefill cost stays bounded
+    template_tokens = _count_tokens(llm, RAG_PROMPT_TEMPLATE.format(context="", question=""))
+    retriever = TokenBudgetRetriever(
+        collection=collection,
+        count_tokens=lambda text: _count_tokens(llm, text),
+        token_budget=CONTEXT_TOKEN_BUDGET,
+        max_prompt_tokens=MAX_CONTEXT_TOKENS - MAX_NEW_TOKENS - template_tokens,
+        # With reranking, the first stage over-fetches and the cross-encoder keeps the best few
+        max_candidates=DEFAULT_RERANK_CANDIDATES if RERANK_ENABLED else MAX_RETRIEVED_CHUNKS,
+        lexical_index=lexical_index,
+        reranker=get_reranker() if RERANK_ENABLED else None,
+        # New documents (see ingest_queue.py) are picked up without a restart
+        generation_fn=get_generation,
+    )
 
-    Réponse utile:"""
-    prompt = PromptTemplate(template=template, input_variables=["context", "question"])
+    # Define the prompt template
+    prompt = PromptTemplate(template=RAG_PROMPT_TEMPLATE, input_variables=["context", "question"])
+    # The instruction block before {context} is prefilled once and reused by every question
+    register_prompt_prefix(llm, RAG_PROMPT_TEMPLATE)
 
     # Create RetrievalQA chain
     qa_chain = RetrievalQA.from_chain_type(
         llm=llm,
-        chain_type="stuff", # Uses all retrieved text chunks in the context
+        chain_type="stuff", # Uses all packed chunks in the context
         retriever=retriever,
         return_source_documents=True, # Optionally return source documents
         chain_type_kwargs={"prompt": prompt}
     )
     return qa_chain
 
-def ask_question_with_rag(chain, question: str):
+def _lexical_index_for(collection):
+    lexical_index = get_lexical_index(collection.name)
+    # Collections filled before the BM25 index existed are indexed once
+    if lexical_index.num_docs != collection.count():
+        lexical_index = rebuild_lexical_index(collection)
+    return lexical_index
+
+# Retrievers of the tenants' collections, built on first use: {(chain retriever id, tenant): retriever}
+_tenant_retrievers = {}
+_tenant_retrievers_lock = threading.Lock()
+
+def get_retriever(chain, tenant: str = None, filters: dict = None):
+    """
+    Returns the retriever of the chain, scoped to a tenant's collection and/or to the documents
+    whose metadata match filters (see knowledge_base.metadata_filter). Without either, chain.retriever.
+    Raises ValueError for an invalid tenant name.
+    """
+    retriever = chain.retriever
+    if tenant is not None:
+        key = (id(chain.retriever), tenant)
+        with _tenant_retrievers_lock:
+            if key not in _tenant_retrievers:
+                collection = get_tenant_collection(tenant)
+                lexical_index = _lexical_index_for(collection) if retriever.lexical_index is not None else None
+                _tenant_retrievers[key] = retriever.scoped(collection=collection, lexical_index=lexical_index)
+            retriever = _tenant_retrievers[key]
+    where = metadata_filter(filters)
+    if where:
+        retriever = retriever.scoped(where=where)
+    return retriever
+
+def load_adapter(llm, adapter_dir: str = LORA_ADAPTER_DIR) -> str:
+    """
+    Loads a LoRA adapter (fine_tune_model.py --lora) into the running model and activates it
+    in place of the previous one. The base weights are neither reloaded nor copied.
+    The swap waits for the running generations (see generation.change_weights).
+    Returns the name of the new adapter. Answer caches must be cleared by the caller.
+    """
+    adapter_name = f"adapter-{time.time_ns()}"
+
+    def swap(model):
+        previous = list(model.peft_config) if getattr(model, "_hf_peft_config_loaded", False) else []
+        print(f"Loading LoRA adapter from {adapter_dir}")
+        model.load_adapter(adapter_dir, adapter_name=adapter_name)
+        model.set_adapter(adapter_name)
+        if previous:
+            model.delete_adapter(previous)
+        model.enable_adapters()
+    change_weights(llm, swap, templates=(RAG_PROMPT_TEMPLATE,))
+    return adapter_name
+
+def unload_adapter(llm) -> bool:
+    """
+    Removes the loaded LoRA adapters: the model answers with its base weights again.
+    Returns False if no adapter was loaded.
+    """
+    model, _ = get_model_and_tokenizer(llm)
+    if not getattr(model, "_hf_peft_config_loaded", False) or not model.peft_config:
+        return False
+
+    def unload(model):
+        model.delete_adapter(list(model.peft_config))
+    change_weights(llm, unload, templates=(RAG_PROMPT_TEMPLATE,))
+    return True
+
+def active_adapter(llm):
+    """Returns the name of the active LoRA adapter, or None."""
+    model, _ = get_model_and_tokenizer(llm)
+    if not getattr(model, "_hf_peft_config_loaded", False) or not model.peft_config:
+        return None
+    return model.active_adapters()[0]
+
+def create_answer_cache(**kwargs):
+    """
+    Creates an answer cache using the shared (cached) question embeddings for near-duplicate lookups.
+    It is invalidated whenever the knowledge base is written to.
+    """
+    embeddings = get_embedding_function()
+    return AnswerCache(embed_fn=embeddings.embed_query, generation_fn=get_generation, **kwargs)
+
+def _count_tokens(llm, text: str) -> int:
+    _, tokenizer = get_model_and_tokenizer(llm)
+    return len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+def _record_token_counts(trace, llm, prompt: str, answer: str):
+    # Only computed when the question is traced
+    if trace is not None:
+        trace.prompt_tokens = _count_tokens(llm, prompt)
+        trace.generated_tokens = _count_tokens(llm, answer)
+
+def ask_question_with_rag(chain, question: str, answer_cache=None, retriever=None):
+    """
+    Answers a question with the RAG chain: retrieval, "stuff" prompt, generation.
+    Equivalent to chain.invoke({"query": question}), run stage by stage so each stage can be traced.
+    retriever replaces chain.retriever, e.g. a tenant's or filtered one from get_retriever().
+    """
     print(f"\nProcessing RAG question: {question}")
-    result = chain.invoke({"query": question}) # Using invoke and query for RetrievalQA
+    with trace_request(question) as trace:
+        if answer_cache is not None:
+            with trace_stage("answer_cache"):
+                # Taken before the lookup: a write to the knowledge base during the answer discards it
+                cache_version = answer_cache.version()
+                cached = answer_cache.get(question)
+            if cached is not None:
+                if trace is not None:
+                    trace.cache_hit = True
+                return cached
+
+        with trace_stage("vector_search"): # The question embedding is recorded as its own stage
+            source_documents = (retriever or chain.retriever).invoke(question)
+        with trace_stage("prompt_assembly"):
+            prompt = build_rag_prompt(chain, question, source_documents)
+        llm = chain.combine_documents_chain.llm_chain.llm
+        with trace_stage("generation"):
+            # The batching queue reuses the prefix cache for batches of one prompt
+            answer = llm.invoke(prompt) if isinstance(llm, BatchedLLM) else generate_text(llm, prompt)
+        _record_token_counts(trace, llm, prompt, answer)
+
+    result = {"query": question, "result": answer, "source_documents": source_documents}
+    if answer_cache is not None:
+        answer_cache.put(question, result, cache_version)
     return result
 
+def build_rag_prompt(chain, question: str, source_documents: list) -> str:
+    """
+    Builds the prompt the "stuff" chain would send to the LLM for these documents.
+    """
+    combine_chain = chain.combine_documents_chain
+    context = combine_chain.document_separator.join(doc.page_content for doc in source_documents)
+    return combine_chain.llm_chain.prompt.format(context=context, question=question)
+
+def stream_question_with_rag(chain, question: str, answer_cache=None, retriever=None):
+    """
+    Same as ask_question_with_rag, but yields the answer while it is being generated.
+    The first event carries the retrieved documents: {"type": "sources", "source_documents": [...]},
+    then each piece of generated text is yielded as {"type": "token", "text": "..."}.
+    A cached answer is yielded as a single token event.
+    """
+    print(f"\nProcessing RAG question (streaming): {question}")
+    with trace_request(question) as trace:
+        if answer_cache is not None:
+            with trace_stage("answer_cache"):
+                # Taken before the lookup: a write to the knowledge base during the answer discards it
+                cache_version = answer_cache.version()
+                cached = answer_cache.get(question)
+            if cached is not None:
+                if trace is not None:
+                    trace.cache_hit = True
+                yield {"type": "sources", "source_documents": cached["source_documents"]}
+                yield {"type": "token", "text": cached["result"]}
+                return
+
+        with trace_stage("vector_search"): # The question embedding is recorded as its own stage
+            source_documents = (retriever or chain.retriever).invoke(question)
+        yield {"type": "sources", "source_documents": source_documents}
+
+        with trace_stage("prompt_assembly"):
+            prompt = build_rag_prompt(chain, question, source_documents)
+        llm = chain.combine_documents_chain.llm_chain.llm
+        pieces = []
+        generation_start = time.perf_counter()
+        with trace_stage("generation"):
+            for text in stream_generate(llm, prompt):
+                if not pieces and trace is not None:
+                    trace.time_to_first_token = time.perf_counter() - generation_start
+                pieces.append(text)
+                yield {"type": "token", "text": text}
+        answer = "".join(pieces)
+        _record_token_counts(trace, llm, prompt, answer)
+
+    # Only complete answers are cached (not the ones whose stream was interrupted)
+    if answer_cache is not None:
+        answer_cache.put(question, {"query": question, "result": answer, "source_documents": source_documents},
+                         cache_version)
+
 if __name__ == "__main__":
     # 1. Ensure ChromaDB has documents
     chroma_collection = initialize_and_get_collection()
@@ -0,0 +1,294 @@
+"""
+Opt-in per-request tracing of the RAG pipeline.
+
+When enabled (RAG_TRACE=1 or enable_tracing()), every question records the time
+spent in each stage, the prompt and generated token counts and the generation
+speed:
+
+    answer_cache     lookup in the answer cache
+    embed_question   question embedding (recorded by the embedding function)
+    vector_search    ChromaDB search
+    lexical_search   BM25 search (hybrid retrieval)
+    rerank           cross-encoder scoring of the candidates (when enabled and not skipped)
+    prompt_assembly  "stuff" prompt formatting
+    generation       LLM generation (including the wait in the batching queue)
+
+Stages may be nested (the retriever embeds the question itself): each stage
+records its exclusive time, so the stages of a question add up to its total.
+
+Traces are appended to a JSONL file (RAG_TRACE_FILE, default rag_traces.jsonl)
+and aggregated in memory for the Prometheus endpoint of the backend.
+
+Summary of a trace file, showing which stage dominates:
+    python rag_tracing.py summarize rag_traces.jsonl
+"""
+import argparse
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+STAGES = ("answer_cache", "embed_question", "vector_search", "lexical_search", "rerank", "prompt_assembly", "generation")
+DEFAULT_TRACE_FILE = os.environ.get("RAG_TRACE_FILE", "rag_traces.jsonl")
+# Upper bounds (seconds) of the Prometheus histogram buckets
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_enabled = os.environ.get("RAG_TRACE", "0") == "1"
+_trace_file = DEFAULT_TRACE_FILE
+_current_trace = contextvars.ContextVar("rag_trace", default=None)
+_lock = threading.Lock()
+
+class RequestTrace:
+    """
+    Timings and token counts of one question.
+    """
+
+    def __init__(self, question: str):
+        self.trace_id = uuid.uuid4().hex
+        self.question = question
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.stages = {}
+        # Time spent in nested stages, one accumulator per open stage
+        self._stage_stack = []
+        self.prompt_tokens = None
+        self.generated_tokens = None
+        self.time_to_first_token = None
+        self.cache_hit = False
+        self.total_seconds = None
+
+    def add_stage(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def finish(self):
+        self.total_seconds = time.perf_counter() - self._start
+
+    @property
+    def tokens_per_sec(self):
+        generation = self.stages.get("generation")
+        if not self.generated_tokens or not generation:
+            return None
+        return self.generated_tokens / generation
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "timestamp": self.started_at,
+            "question": self.question,
+            "cache_hit": self.cache_hit,
+            "total_seconds": self.total_seconds,
+            "stages": self.stages,
+            "prompt_tokens": self.prompt_tokens,
+            "generated_tokens": self.generated_tokens,
+            "tokens_per_sec": self.tokens_per_sec,
+            "time_to_first_token": self.time_to_first_token,
+        }
+
+class _Metrics:
+    """
+    In-memory aggregation of the traces for the Prometheus exposition format.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.cache_hits = 0
+        self.prompt_tokens = 0
+        self.generated_tokens = 0
+        self.stage_buckets = {}
+        self.stage_sums = {}
+        self.stage_counts = {}
+
+    def observe(self, trace: RequestTrace):
+        self.requests += 1
+        self.cache_hits += int(trace.cache_hit)
+        self.prompt_tokens += trace.prompt_tokens or 0
+        self.generated_tokens += trace.generated_tokens or 0
+        observations = dict(trace.stages)
+        observations["total"] = trace.total_seconds
+        for stage, seconds in observations.items():
+            buckets = self.stage_buckets.setdefault(stage, [0] * len(HISTOGRAM_BUCKETS))
+            for index, bound in enumerate(HISTOGRAM_BUCKETS):
+                if seconds <= bound:
+                    buckets[index] += 1
+            self.stage_sums[stage] = self.stage_sums.get(stage, 0.0) + seconds
+            self.stage_counts[stage] = self.stage_counts.get(stage, 0) + 1
+
+_metrics = _Metrics()
+
+def is_enabled() -> bool:
+    return _enabled
+
+def enable_tracing(trace_file: str = None):
+    """Turns tracing on for this process, optionally writing to another JSONL file."""
+    global _enabled, _trace_file
+    _enabled = True
+    if trace_file:
+        _trace_file = trace_file
+
+def disable_tracing():
+    global _enabled
+    _enabled = False
+
+def current_trace():
+    """Returns the trace of the question being processed, or None when tracing is off."""
+    return _current_trace.get()
+
+@contextmanager
+def trace_request(question: str):
+    """
+    Traces one question; yields the RequestTrace (or None when tracing is disabled).
+    """
+    if not _enabled:
+        yield None
+        return
+    trace = RequestTrace(question)
+    _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        # Not reset with a token: streaming generators may resume in another context
+        _current_trace.set(None)
+        trace.finish()
+        _record(trace)
+
+@contextmanager
+def trace_stage(name: str):
+    """
+    Adds the time spent in the block, minus nested stages, to the given stage of the current trace.
+    No-op when no question is being traced.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    trace._stage_stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = trace._stage_stack.pop()
+        trace.add_stage(name, elapsed - nested)
+        if trace._stage_stack:
+            trace._stage_stack[-1] += elapsed
+
+def _record(trace: RequestTrace):
+    line = json.dumps(trace.to_dict(), ensure_ascii=False)
+    with _lock:
+        _metrics.observe(trace)
+        with open(_trace_file, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+def render_prometheus(extra_metrics=None) -> str:
+    """
+    Renders the aggregated traces in the Prometheus text format.
+    extra_metrics is a list of (name, type, help, value) or (name, type, help, value, labels) tuples
+    for metrics owned by other components (batching, caches).
+    """
+    lines = []
+
+    def metric(name, metric_type, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for sample_name, labels, value in samples:
+            lines.append(f"{sample_name}{_format_labels(labels)} {value}")
+
+    with _lock:
+        metric("rag_requests_total", "counter", "Number of traced RAG questions.",
+               [("rag_requests_total", {}, _metrics.requests)])
+        metric("rag_answer_cache_hits_total", "counter", "Traced questions answered from the answer cache.",
+               [("rag_answer_cache_hits_total", {}, _metrics.cache_hits)])
+        metric("rag_prompt_tokens_total", "counter", "Prompt tokens sent to the LLM.",
+               [("rag_prompt_tokens_total", {}, _metrics.prompt_tokens)])
+        metric("rag_generated_tokens_total", "counter", "Tokens generated by the LLM.",
+               [("rag_generated_tokens_total", {}, _metrics.generated_tokens)])
+        samples = []
+        for stage in sorted(_metrics.stage_buckets):
+            for bound, count in zip(HISTOGRAM_BUCKETS, _metrics.stage_buckets[stage]):
+                samples.append(("rag_stage_duration_seconds_bucket", {"stage": stage, "le": bound}, count))
+            samples.append(("rag_stage_duration_seconds_bucket", {"stage": stage, "le": "+Inf"},
+                            _metrics.stage_counts[stage]))
+            samples.append(("rag_stage_duration_seconds_sum", {"stage": stage}, _metrics.stage_sums[stage]))
+            samples.append(("rag_stage_duration_seconds_count", {"stage": stage}, _metrics.stage_counts[stage]))
+        metric("rag_stage_duration_seconds", "histogram", "Time spent in each RAG stage ('total' is the whole question).",
+               samples)
+
+    # Samples sharing a name (with different labels) are rendered under a single HELP/TYPE header
+    grouped = {}
+    for extra in extra_metrics or []:
+        name, metric_type, help_text, value = extra[:4]
+        labels = extra[4] if len(extra) > 4 else {}
+        if value is not None:
+            grouped.setdefault(name, (metric_type, help_text, []))[2].append((name, labels, value))
+    for name, (metric_type, help_text, samples) in grouped.items():
+        metric(name, metric_type, help_text, samples)
+    return "\n".join(lines) + "\n"
+
+def _percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+def summarize(trace_file: str) -> dict:
+    """
+    Aggregates a JSONL trace file: per-stage mean/p95 and share of the total time, token throughput.
+    """
+    traces = []
+    with open(trace_file, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                traces.append(json.loads(line))
+    stage_values = {}
+    for trace in traces:
+        for stage, seconds in trace["stages"].items():
+            stage_values.setdefault(stage, []).append(seconds)
+    grand_total = sum(sum(values) for values in stage_values.values())
+    stages = {
+        stage: {
+            "mean": sum(values) / len(values),
+            "p95": _percentile(values, 0.95),
+            "share": sum(values) / grand_total if grand_total else 0.0,
+        }
+        for stage, values in stage_values.items()
+    }
+    speeds = [trace["tokens_per_sec"] for trace in traces if trace.get("tokens_per_sec")]
+    first_tokens = [trace["time_to_first_token"] for trace in traces if trace.get("time_to_first_token")]
+    return {
+        "requests": len(traces),
+        "cache_hits": sum(1 for trace in traces if trace.get("cache_hit")),
+        "stages": stages,
+        "dominant_stage": max(stages, key=lambda stage: stages[stage]["share"]) if stages else None,
+        "mean_tokens_per_sec": sum(speeds) / len(speeds) if speeds else None,
+        "mean_time_to_first_token": sum(first_tokens) / len(first_tokens) if first_tokens else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG tracing tools.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summarize_parser = subparsers.add_parser("summarize", help="Show which stage dominates the RAG latency.")
+    summarize_parser.add_argument("trace_file", nargs="?", default=DEFAULT_TRACE_FILE)
+    args = parser.parse_args()
+
+    summary = summarize(args.trace_file)
+    print(f"{summary['requests']} traced questions ({summary['cache_hits']} answered from the cache)")
+    print(f"\n{'stage':<16} {'mean (s)':>9} {'p95 (s)':>9} {'share':>7}")
+    for stage in sorted(summary["stages"], key=lambda stage: -summary["stages"][stage]["share"]):
+        values = summary["stages"][stage]
+        print(f"{stage:<16} {values['mean']:>9.3f} {values['p95']:>9.3f} {values['share']:>6.1%}")
+    if summary["dominant_stage"]:
+        print(f"\nDominant stage: {summary['dominant_stage']}")
+    if summary["mean_tokens_per_sec"] is not None:
+        print(f"Mean generation speed: {summary['mean_tokens_per_sec']:.2f} tokens/sec")
+    if summary["mean_time_to_first_token"] is not None:
+        print(f"Mean time to first token: {summary['mean_time_to_first_token']:.2f} s")
+
+if __name__ == "__main__":
+    main()
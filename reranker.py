@@ -0,0 +1,107 @@
+"""
+Optional cross-encoder reranking of the retrieved passages.
+
+The first stage (vector or hybrid search) over-fetches candidates cheaply; a
+small multilingual cross-encoder then scores every (question, passage) pair and
+only the best few passages go into the prompt.
+
+Pairs are scored through a MicroBatcher (see batching.py): the passages of
+concurrent questions share one forward pass of the cross-encoder.
+
+Configuration (environment variables):
+    RAG_RERANK              1 to enable reranking in the RAG chain (default 0)
+    RAG_RERANKER_MODEL      cross-encoder model (default: multilingual MiniLM trained on mMARCO)
+    RAG_RERANK_CANDIDATES   candidates fetched by the first stage (default 10)
+    RAG_RERANK_TOP_N        passages kept after reranking (default 2)
+    RAG_RERANK_SKIP_MARGIN  distance gap that makes the first stage decisive (default 0.15)
+"""
+import os
+import threading
+
+from batching import MicroBatcher
+
+RERANK_ENABLED = os.environ.get("RAG_RERANK", "0") == "1"
+RERANKER_MODEL_NAME = os.environ.get("RAG_RERANKER_MODEL", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1")
+DEFAULT_RERANK_CANDIDATES = int(os.environ.get("RAG_RERANK_CANDIDATES", "10"))
+DEFAULT_RERANK_TOP_N = int(os.environ.get("RAG_RERANK_TOP_N", "2"))
+DEFAULT_SKIP_MARGIN = float(os.environ.get("RAG_RERANK_SKIP_MARGIN", "0.15"))
+# Pairs scored per cross-encoder call, and how long the first pair waits for others
+DEFAULT_MAX_PAIRS = 64
+DEFAULT_WINDOW_MS = 5
+
+def is_decisive(distances: list, top_n: int, margin: float) -> bool:
+    """
+    True when the first-stage distances (in candidate order) already separate the top_n kept
+    passages from the rest by at least margin: reranking could not change the kept set.
+    The candidates may be ordered by rank fusion rather than by distance, so the farthest
+    kept passage is compared with the closest dropped one.
+    A missing distance (a passage found by BM25 only) is never decisive.
+    """
+    if len(distances) <= top_n:
+        return True
+    if any(distance is None for distance in distances):
+        return False
+    return min(distances[top_n:]) - max(distances[:top_n]) >= margin
+
+class CrossEncoderReranker:
+    """
+    Scores (question, passage) pairs with a cross-encoder, batched across concurrent questions.
+    """
+
+    def __init__(self, model_name: str = RERANKER_MODEL_NAME, max_pairs: int = DEFAULT_MAX_PAIRS,
+                 window_ms: float = DEFAULT_WINDOW_MS):
+        from sentence_transformers import CrossEncoder
+        self.model_name = model_name
+        self.model = CrossEncoder(model_name)
+        self.batcher = MicroBatcher(self._score_pairs, max_batch_size=max_pairs, window_ms=window_ms,
+                                    name="rerank-batcher")
+        self._lock = threading.Lock()
+        self.reranked = 0
+        self.skipped = 0
+
+    def _score_pairs(self, pairs: list) -> list:
+        return [float(score) for score in self.model.predict(pairs, batch_size=len(pairs))]
+
+    def score(self, question: str, passages: list) -> list:
+        """Returns the relevance score of each passage for the question (higher is better)."""
+        futures = [self.batcher.submit((question, passage)) for passage in passages]
+        return [future.result() for future in futures]
+
+    def rerank(self, question: str, documents: list, top_n: int = DEFAULT_RERANK_TOP_N) -> list:
+        """
+        Returns the top_n LangChain documents for the question, best first.
+        """
+        scores = self.score(question, [document.page_content for document in documents])
+        order = sorted(range(len(documents)), key=lambda index: -scores[index])
+        with self._lock:
+            self.reranked += 1
+        return [documents[index] for index in order[:top_n]]
+
+    def record_skip(self):
+        with self._lock:
+            self.skipped += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            questions = self.reranked + self.skipped
+            return {
+                "model": self.model_name,
+                "reranked": self.reranked,
+                "skipped": self.skipped,
+                "skip_rate": self.skipped / questions if questions else 0.0,
+                "batching": self.batcher.get_metrics(),
+            }
+
+_reranker = None
+_reranker_lock = threading.Lock()
+
+def get_reranker() -> CrossEncoderReranker:
+    """
+    Returns the process-wide reranker, loading the cross-encoder on first use.
+    """
+    global _reranker
+    with _reranker_lock:
+        if _reranker is None:
+            print(f"Loading reranker: {RERANKER_MODEL_NAME}")
+            _reranker = CrossEncoderReranker()
+        return _reranker
@@ -0,0 +1,167 @@
+"""
+LangChain retrievers used by the RAG chain.
+
+TokenBudgetRetriever replaces the fixed top-k retriever: it over-fetches
+candidates and keeps the best-ranked ones that fit in a token budget, so the
+prompt (and the prefill time of the LLM) stays bounded whatever the size of the
+retrieved chunks.
+
+Candidates come from the vector search alone, or, in hybrid mode, from the
+vector search and the BM25 index (bm25_index.py) merged by reciprocal rank
+fusion: exact terms such as proper nouns and codes are found even when their
+embedding is not close to the question's.
+
+With a reranker (reranker.py), more candidates are fetched and a cross-encoder
+keeps the best few, unless the first-stage distances are already decisive.
+
+A metadata filter (Chroma where clause) is pushed down into the vector search;
+scoped() returns a copy of a retriever for one tenant's collection or one filter.
+"""
+from typing import Any, Callable, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from chunking import pack_documents
+from rag_tracing import trace_stage
+from reranker import DEFAULT_RERANK_TOP_N, DEFAULT_SKIP_MARGIN, is_decisive
+
+# Rank offset of reciprocal rank fusion (60 in the original paper): damps the weight of the very first ranks
+RRF_K = 60
+
+def reciprocal_rank_fusion(rankings: list, k: int = RRF_K) -> list:
+    """
+    Merges several ranked lists of IDs into one, best first: score(id) = sum of 1 / (k + rank).
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda doc_id: -scores[doc_id])
+
+def _to_document(doc_id: str, text: str, metadata: dict) -> Document:
+    return Document(page_content=text, metadata={**(metadata or {}), "id": doc_id})
+
+class TokenBudgetRetriever(BaseRetriever):
+    """
+    Packs retrieved documents up to a token budget instead of returning a fixed number of them.
+    """
+    # Chroma collection opened with the cached embedding function (knowledge_base.get_or_create_collection)
+    collection: Any
+    count_tokens: Callable[[str], int]
+    # Tokens of context per question
+    token_budget: int
+    # Largest prompt the context may grow to: model context minus the answer and the template
+    max_prompt_tokens: int
+    max_candidates: int = 4
+    # BM25 index of the collection for hybrid retrieval, None for vector search only
+    lexical_index: Any = None
+    # Results taken from each ranking before fusion
+    fusion_depth: int = 10
+    # CrossEncoderReranker applied to the max_candidates first-stage results, None to keep their order
+    reranker: Any = None
+    rerank_top_n: int = DEFAULT_RERANK_TOP_N
+    rerank_skip_margin: float = DEFAULT_SKIP_MARGIN
+    # Returns the knowledge base generation (knowledge_base.get_generation); checked before every search
+    generation_fn: Optional[Callable[[], int]] = None
+    # Generation of the knowledge base the last search ran against
+    generation: int = -1
+    # Chroma where clause applied to every search (knowledge_base.metadata_filter), None to search everything
+    where: Optional[dict] = None
+
+    def scoped(self, collection=None, lexical_index=None, where: Optional[dict] = None) -> "TokenBudgetRetriever":
+        """
+        Returns a copy searching another collection (and its BM25 index) and/or with a metadata filter.
+        The copy is cheap: the collection handles, the index and the reranker are shared.
+        """
+        update = {"where": where}
+        if collection is not None:
+            update.update(collection=collection, lexical_index=lexical_index, generation=-1)
+        return self.model_copy(update=update)
+
+    def sync_generation(self):
+        """
+        Picks up the writes made since the previous search (by the ingestion queue or another process).
+        Chroma sees the writes of this process immediately; the BM25 and quantized vector indexes
+        replay the new operations.
+        """
+        if self.generation_fn is None:
+            return
+        generation = self.generation_fn()
+        if generation != self.generation:
+            refresh = getattr(self.collection, "refresh", None)
+            if refresh is not None:
+                refresh()
+            if self.lexical_index is not None:
+                self.lexical_index.refresh()
+            self.generation = generation
+
+    def context_budget(self, query: str) -> int:
+        """Returns the context budget of a question: the configured budget, reduced for long questions."""
+        return min(self.token_budget, self.max_prompt_tokens - self.count_tokens(query))
+
+    def _vector_search(self, queries: list, n_results: int, query_embeddings=None) -> list:
+        # One Chroma query for all the questions (their embeddings are computed in one call too).
+        # Returns, per question, {id: Document} in rank order and {id: distance}
+        kwargs = {"where": self.where} if self.where else {}
+        if query_embeddings is not None:
+            kwargs["query_embeddings"] = query_embeddings
+        else:
+            kwargs["query_texts"] = queries
+        results = self.collection.query(n_results=n_results, include=["documents", "metadatas", "distances"],
+                                        **kwargs)
+        hits = []
+        for ids, texts, metadatas, distances_row in zip(results["ids"], results["documents"],
+                                                         results["metadatas"], results["distances"]):
+            documents, distances = {}, {}
+            for doc_id, text, metadata, distance in zip(ids, texts, metadatas, distances_row):
+                documents[doc_id] = _to_document(doc_id, text, metadata)
+                distances[doc_id] = distance
+            hits.append((documents, distances))
+        return hits
+
+    def _hybrid_search(self, query: str, vector_hits: dict, distances: dict):
+        with trace_stage("lexical_search"):
+            lexical_ids = [doc_id for doc_id, _ in self.lexical_index.search(query, self.fusion_depth)]
+        fused_ids = reciprocal_rank_fusion([list(vector_hits), lexical_ids])
+        if not self.where:
+            fused_ids = fused_ids[:self.max_candidates]
+        missing = [doc_id for doc_id in fused_ids if doc_id not in vector_hits]
+        if missing:
+            # The BM25 index has no metadata: the filter is applied while fetching its hits
+            kwargs = {"where": self.where} if self.where else {}
+            found = self.collection.get(ids=missing, include=["documents", "metadatas"], **kwargs)
+            for doc_id, text, metadata in zip(found["ids"], found["documents"], found["metadatas"]):
+                vector_hits[doc_id] = _to_document(doc_id, text, metadata)
+        # An ID may be missing from Chroma if it was deleted between the two searches (or filtered out)
+        fused_ids = [doc_id for doc_id in fused_ids if doc_id in vector_hits][:self.max_candidates]
+        return [vector_hits[doc_id] for doc_id in fused_ids], [distances.get(doc_id) for doc_id in fused_ids]
+
+    def _rerank(self, query: str, candidates: list, distances: list) -> list:
+        if is_decisive(distances, self.rerank_top_n, self.rerank_skip_margin):
+            self.reranker.record_skip()
+            return candidates[:self.rerank_top_n]
+        with trace_stage("rerank"):
+            return self.reranker.rerank(query, candidates, self.rerank_top_n)
+
+    def batch_retrieve(self, queries: list, query_embeddings=None) -> list:
+        """
+        Returns the packed documents of each question, with a single vector search for all of them
+        (e.g. batch_qa.py). query_embeddings, if given, are used instead of embedding the questions.
+        """
+        self.sync_generation()
+        n_results = self.max_candidates if self.lexical_index is None else max(self.fusion_depth, self.max_candidates)
+        results = []
+        for query, (documents, distances) in zip(queries, self._vector_search(queries, n_results, query_embeddings)):
+            if self.lexical_index is None:
+                candidates, candidate_distances = list(documents.values()), list(distances.values())
+            else:
+                candidates, candidate_distances = self._hybrid_search(query, documents, distances)
+            if self.reranker is not None:
+                candidates = self._rerank(query, candidates, candidate_distances)
+            results.append(pack_documents(candidates, self.count_tokens, self.context_budget(query)))
+        return results
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.batch_retrieve([query])[0]
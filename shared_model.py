@@ -0,0 +1,109 @@
+"""
+LLM weights shared read-only between serving processes.
+
+The weights are exported once, in the serving precision, to a single file in
+SHARED_MODEL_DIR. Every process then builds the model skeleton without
+allocating its parameters and maps the file into memory (torch.load(mmap=True)):
+the parameters are views on the file's pages, which the kernel keeps once in the
+page cache for all the processes mapping them. Each process keeps its own
+activations and key/value caches.
+
+With gunicorn's preload_app (see radio-x-app/backend/gunicorn.conf.py) the model
+is mapped in the master process before the workers are forked, so the workers
+also share the Python objects of the model.
+
+Enabled with RAG_SHARED_MODEL=1 (model_loader.load_model then returns the shared
+model). Supported precisions: fp32, bf16 and fp16; int8 dynamic quantization
+rewrites the modules and cannot be mapped this way.
+
+Usage:
+    python shared_model.py export --precision bf16
+"""
+import argparse
+import fcntl
+import os
+import subprocess
+import sys
+import threading
+
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM
+
+from model_loader import DEFAULT_PRECISION, _TORCH_DTYPES, _model_fingerprint
+
+SHARED_MODEL_DIR = os.environ.get("RAG_SHARED_MODEL_DIR", "shared_models")
+DEFAULT_MODEL_NAME = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
+
+_models = {}
+_models_lock = threading.Lock()
+
+def shared_weights_path(model_name: str, precision: str) -> str:
+    slug = "".join(char if char.isalnum() or char in "_.-" else "_" for char in model_name.strip("./"))
+    return os.path.join(SHARED_MODEL_DIR, f"{slug}-{_model_fingerprint(model_name)}-{precision}.pt")
+
+def _check_precision(precision: str):
+    if precision not in _TORCH_DTYPES:
+        raise ValueError(f"Shared weights support {', '.join(_TORCH_DTYPES)}, not '{precision}'.")
+
+def export_shared_weights(model_name: str, precision: str) -> str:
+    """
+    Writes the state dict of the model in the given precision to the shared weights file.
+    """
+    _check_precision(precision)
+    path = shared_weights_path(model_name, precision)
+    print(f"Exporting {model_name} ({precision}) weights to {path}")
+    model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=_TORCH_DTYPES[precision])
+    os.makedirs(SHARED_MODEL_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(model.state_dict(), tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+def _ensure_exported(model_name: str, precision: str) -> str:
+    path = shared_weights_path(model_name, precision)
+    os.makedirs(SHARED_MODEL_DIR, exist_ok=True)
+    # Several workers may start at once: only one exports, the others wait for the file
+    with open(path + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if not os.path.exists(path):
+            # In a subprocess: the full-size copy of the weights is freed with it, and the
+            # (possibly pre-fork) caller does not start torch's thread pools
+            subprocess.run([sys.executable, os.path.abspath(__file__), "export", "--model", model_name,
+                            "--precision", precision], check=True)
+    return path
+
+def load_shared_model(model_name: str = DEFAULT_MODEL_NAME, precision: str = DEFAULT_PRECISION):
+    """
+    Returns the model with its parameters memory-mapped from the shared weights file
+    (exported on first use). The model is built once per process.
+    """
+    _check_precision(precision)
+    key = (model_name, precision)
+    with _models_lock:
+        if key not in _models:
+            from accelerate import init_empty_weights
+            path = _ensure_exported(model_name, precision)
+            print(f"Mapping shared weights from {path}")
+            config = AutoConfig.from_pretrained(model_name)
+            # Parameters are created on the meta device (no memory), buffers such as the rotary
+            # frequencies are computed normally since they are not in the state dict
+            with init_empty_weights(include_buffers=False):
+                model = AutoModelForCausalLM.from_config(config, torch_dtype=_TORCH_DTYPES[precision])
+            state_dict = torch.load(path, mmap=True, weights_only=True, map_location="cpu")
+            model.load_state_dict(state_dict, assign=True)
+            model.tie_weights()
+            model.eval()
+            _models[key] = model
+        return _models[key]
+
+def main():
+    parser = argparse.ArgumentParser(description="Export LLM weights for memory-mapped sharing between processes.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export")
+    export_parser.add_argument("--model", default=DEFAULT_MODEL_NAME)
+    export_parser.add_argument("--precision", default=DEFAULT_PRECISION, choices=sorted(_TORCH_DTYPES))
+    args = parser.parse_args()
+    export_shared_weights(args.model, args.precision)
+
+if __name__ == "__main__":
+    main()
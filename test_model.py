@@ -1,23 +1,17 @@
-import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+from transformers import pipeline
+from model_loader import DEFAULT_PRECISION, load_model, load_tokenizer
 
 model_name = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
 
-# Load tokenizer and model
-tokenizer = AutoTokenizer.from_pretrained(model_name)
-model = AutoModelForCausalLM.from_pretrained(
-    model_name,
-    torch_dtype="auto",
-    device_map="auto"
-)
+# Load tokenizer and model (precision selected with RAG_PRECISION: fp16, fp32, bf16 or int8)
+tokenizer = load_tokenizer(model_name)
+model = load_model(model_name, precision=DEFAULT_PRECISION)
 
 # Create text generation pipeline
 pipe = pipeline(
     "text-generation",
     model=model,
     tokenizer=tokenizer,
-    torch_dtype="auto",
-    device_map="auto"
 )
 
 # Generate text
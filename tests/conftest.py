@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules live at the root of the repository, the viewer backend's package in radio-x-app/backend
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.append(os.path.join(ROOT, "radio-x-app", "backend"))
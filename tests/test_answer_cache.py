@@ -0,0 +1,82 @@
+import numpy as np
+
+from answer_cache import AnswerCache, normalize_question
+
+# Questions are embedded by their first word: questions starting alike are near-duplicates
+VECTORS = {"couleur": [1.0, 0.0, 0.0], "capitale": [0.0, 1.0, 0.0], "pommes": [0.0, 0.0, 1.0]}
+
+def embed(question: str) -> np.ndarray:
+    return np.asarray(VECTORS[normalize_question(question).split()[0]])
+
+class Generation:
+    def __init__(self):
+        self.value = 0
+
+    def __call__(self) -> int:
+        return self.value
+
+def result(answer: str) -> dict:
+    return {"query": "", "result": answer, "source_documents": []}
+
+def test_normalize_question():
+    assert normalize_question("Quelle est la  Capitale de la France ?") == "quelle est la capitale de la france"
+
+def test_exact_and_semantic_hits():
+    cache = AnswerCache(embed_fn=embed)
+    assert cache.get("couleur du ciel ?") is None
+    cache.put("couleur du ciel ?", result("bleu"))
+    assert cache.get("Couleur du ciel") == {**result("bleu"), "query": "Couleur du ciel"}
+    assert cache.get("couleur de la mer")["result"] == "bleu"
+    assert cache.get("capitale de la France") is None
+    stats = cache.stats()
+    assert (stats["exact_hits"], stats["semantic_hits"], stats["misses"]) == (1, 1, 2)
+
+def test_without_embeddings_only_exact_hits():
+    cache = AnswerCache()
+    cache.put("couleur du ciel", result("bleu"))
+    assert cache.get("couleur de la mer") is None
+    assert cache.get("couleur du ciel ?")["result"] == "bleu"
+
+def test_lru_eviction():
+    cache = AnswerCache(max_entries=2)
+    cache.put("a", result("1"))
+    cache.put("b", result("2"))
+    cache.get("a")
+    cache.put("c", result("3"))
+    assert cache.get("b") is None
+    assert cache.get("a")["result"] == "1"
+    assert cache.get("c")["result"] == "3"
+
+def test_ttl():
+    cache = AnswerCache(ttl_seconds=-1)
+    cache.put("a", result("1"))
+    assert cache.get("a") is None
+
+def test_generation_change_invalidates():
+    generation = Generation()
+    cache = AnswerCache(embed_fn=embed, generation_fn=generation)
+    cache.put("couleur du ciel", result("bleu"))
+    generation.value += 1
+    assert cache.get("couleur du ciel") is None
+    assert cache.stats()["entries"] == 0
+
+def test_answer_computed_before_a_write_is_not_stored():
+    generation = Generation()
+    cache = AnswerCache(generation_fn=generation)
+    version = cache.version()
+    assert cache.get("couleur du ciel") is None
+    # The knowledge base is written while the answer is being generated
+    generation.value += 1
+    cache.put("couleur du ciel", result("bleu"), version)
+    assert cache.get("couleur du ciel") is None
+
+    version = cache.version()
+    cache.put("couleur du ciel", result("vert"), version)
+    assert cache.get("couleur du ciel")["result"] == "vert"
+
+def test_answer_computed_before_a_clear_is_not_stored():
+    cache = AnswerCache()
+    version = cache.version()
+    cache.clear()
+    cache.put("couleur du ciel", result("bleu"), version)
+    assert cache.get("couleur du ciel") is None
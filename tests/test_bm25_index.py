@@ -0,0 +1,67 @@
+import bm25_index
+from bm25_index import BM25Index, tokenize
+
+DOCUMENTS = [
+    ("doc1", "Le ciel est bleu."),
+    ("doc2", "L'herbe est verte."),
+    ("doc3", "Paris est la capitale de la France."),
+    ("doc4", "Les pommes sont généralement rouges ou vertes."),
+    ("doc5", "Le soleil brille pendant la journée."),
+]
+
+def test_tokenize():
+    assert tokenize("L'herbe de la Forêt") == ["herbe", "foret"]
+
+def test_rebuild_and_search(tmp_path):
+    index = BM25Index(str(tmp_path))
+    index.rebuild(DOCUMENTS)
+    assert index.stats()["segment_documents"] == len(DOCUMENTS)
+    assert index.search("capitale France", k=1)[0][0] == "doc3"
+    assert index.search("inconnu") == []
+
+    # A rebuild replaces everything, including pending writes
+    index.add(["doc6"], ["Berlin est la capitale de l'Allemagne."])
+    index.rebuild(DOCUMENTS[:2])
+    assert BM25Index(str(tmp_path)).num_docs == 2
+    assert index.search("capitale") == []
+
+def test_ops_log_replay(tmp_path):
+    writer = BM25Index(str(tmp_path))
+    writer.rebuild(DOCUMENTS)
+    reader = BM25Index(str(tmp_path))
+
+    writer.add(["doc6"], ["Berlin est la capitale de l'Allemagne."])
+    writer.add(["doc3"], ["Lyon est une grande ville."])
+    writer.delete(["doc1"])
+    assert reader.search("Berlin") == []
+    reader.refresh()
+    for index in (reader, BM25Index(str(tmp_path))):
+        assert index.num_docs == 5
+        assert [doc_id for doc_id, _ in index.search("capitale")] == ["doc6"]
+        assert index.search("Lyon")[0][0] == "doc3"
+        assert index.search("ciel") == []
+
+def test_compaction(tmp_path, monkeypatch):
+    monkeypatch.setattr(bm25_index, "MIN_DOCS_BEFORE_COMPACTION", 3)
+    index = BM25Index(str(tmp_path))
+    for doc_id, text in DOCUMENTS:
+        index.add([doc_id], [text])
+    # The fourth add went over the threshold and was merged into segment 1
+    stats = index.stats()
+    assert stats["segment"] == 1
+    assert stats["segment_documents"] == 4
+    assert stats["pending_documents"] == 1
+
+    index.delete(["doc2"])
+    index.add(["doc4"], ["Les cerises sont rouges."])
+    scores_before = index.search("rouges vertes soleil")
+    index.compact()
+    reloaded = BM25Index(str(tmp_path))
+    stats = reloaded.stats()
+    assert (stats["segment"], stats["documents"], stats["pending_documents"]) == (2, 4, 0)
+    assert reloaded.search("herbe") == []
+    assert reloaded.search("cerises")[0][0] == "doc4"
+    # Compaction does not change the scores
+    scores_after = reloaded.search("rouges vertes soleil")
+    assert [doc_id for doc_id, _ in scores_after] == [doc_id for doc_id, _ in scores_before]
+    assert all(abs(a - b) < 1e-4 for (_, a), (_, b) in zip(scores_before, scores_after))
@@ -0,0 +1,24 @@
+from types import SimpleNamespace
+
+from chunking import pack_documents
+
+def documents(*texts):
+    return [SimpleNamespace(page_content=text) for text in texts]
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+def test_pack_documents_keeps_ranking_order_within_budget():
+    docs = documents("a b c", "d e", "f g h i")
+    # 3 + 2 and 2 + 2 fit in 10 tokens with their separators, the third document does not
+    assert pack_documents(docs, count_words, token_budget=10) == docs[:2]
+    assert pack_documents(docs, count_words, token_budget=100) == docs
+
+def test_pack_documents_skips_documents_that_do_not_fit():
+    docs = documents("a b c", "d e f g h i j k", "l")
+    assert pack_documents(docs, count_words, token_budget=8) == [docs[0], docs[2]]
+
+def test_pack_documents_always_keeps_the_first_document():
+    docs = documents("a b c d e f", "g")
+    assert pack_documents(docs, count_words, token_budget=4) == docs[:1]
+    assert pack_documents([], count_words, token_budget=4) == []
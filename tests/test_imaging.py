@@ -0,0 +1,92 @@
+import hashlib
+import io
+import json
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app.imaging import ImageStore, UploadTooLarge, build_derived, TILE_SIZE
+
+def make_store(directory) -> ImageStore:
+    # The tests call build_derived() directly: the process pool is never started
+    return ImageStore(str(directory), workers=1)
+
+def image_bytes(pixels: np.ndarray, orientation: int = None) -> bytes:
+    buffer = io.BytesIO()
+    exif = Image.Exif()
+    if orientation is not None:
+        exif[0x0112] = orientation
+    Image.fromarray(pixels).save(buffer, "PNG", exif=exif)
+    return buffer.getvalue()
+
+def gradient_16bit(height: int, width: int) -> np.ndarray:
+    return (np.arange(height * width, dtype=np.uint32).reshape(height, width) % 4000 + 100).astype(np.uint16)
+
+def test_save_upload_deduplicates_by_hash(tmp_path):
+    store = make_store(tmp_path)
+    content = b"radiograph" * 1000
+    image_id, size, created = store.save_upload(io.BytesIO(content), chunk_size=4096)
+    assert (image_id, size, created) == (hashlib.sha256(content).hexdigest(), len(content), True)
+    with open(store.original_path(image_id), "rb") as f:
+        assert f.read() == content
+    assert store.save_upload(io.BytesIO(content)) == (image_id, len(content), False)
+    assert store.exists(image_id)
+    assert store.stats()["uploads"] == 2
+    assert os.listdir(store.tmp_dir) == []
+
+def test_save_upload_rejects_large_and_empty_bodies(tmp_path):
+    store = make_store(tmp_path)
+    with pytest.raises(UploadTooLarge):
+        store.save_upload(io.BytesIO(b"x" * 10), max_bytes=8, chunk_size=4)
+    with pytest.raises(ValueError, match="empty"):
+        store.save_upload(io.BytesIO(b""))
+    # Nothing is stored, and the partial uploads are removed
+    assert os.listdir(store.tmp_dir) == []
+    assert not os.path.exists(os.path.join(str(tmp_path), "originals"))
+
+def test_build_derived_16bit(tmp_path):
+    store = make_store(tmp_path)
+    image_id, _, _ = store.save_upload(io.BytesIO(image_bytes(gradient_16bit(300, 600))))
+    meta = build_derived(store.original_path(image_id), store.derived_dir(image_id), store.tmp_dir)
+    assert (meta["width"], meta["height"], meta["bits"], meta["format"]) == (600, 300, 16, "PNG")
+    low, high = meta["window"]
+    assert 100 <= low < high <= 4099
+    # 600 -> 300 -> 150 pixels wide
+    assert meta["levels"] == 3
+    assert store.status(image_id) == "ready"
+    assert store.describe(image_id)["meta"] == meta
+    with Image.open(store.derived_path(image_id, "tiles/0/2_1.png")) as tile:
+        assert tile.mode == "L"
+        assert tile.size == (600 - 2 * TILE_SIZE, 300 - TILE_SIZE)
+    with Image.open(store.derived_path(image_id, "thumbnail.png")) as thumbnail:
+        assert thumbnail.size == (256, 128)
+
+def test_build_derived_applies_exif_orientation_to_16bit(tmp_path):
+    store = make_store(tmp_path)
+    # Orientation 6: the stored image is displayed rotated by 90 degrees
+    image_id, _, _ = store.save_upload(io.BytesIO(image_bytes(gradient_16bit(100, 200), orientation=6)))
+    meta = build_derived(store.original_path(image_id), store.derived_dir(image_id), store.tmp_dir)
+    assert (meta["width"], meta["height"], meta["bits"]) == (100, 200, 16)
+
+def test_build_derived_undecodable_file(tmp_path):
+    store = make_store(tmp_path)
+    image_id, _, _ = store.save_upload(io.BytesIO(b"not an image"))
+    error = build_derived(store.original_path(image_id), store.derived_dir(image_id), store.tmp_dir)
+    assert error["error"].startswith("UnidentifiedImageError")
+    assert store.original_path(image_id) not in error["error"]
+    assert store.status(image_id) == "failed"
+    assert os.listdir(store.tmp_dir) == []
+
+def test_derived_path_rejects_traversal(tmp_path):
+    store = make_store(tmp_path)
+    image_id, _, _ = store.save_upload(io.BytesIO(image_bytes(np.zeros((10, 10), dtype=np.uint8))))
+    build_derived(store.original_path(image_id), store.derived_dir(image_id), store.tmp_dir)
+    with open(os.path.join(str(tmp_path), "secret.json"), "w", encoding="utf-8") as f:
+        json.dump({}, f)
+    assert store.derived_path(image_id, "meta.json") is not None
+    assert store.derived_path(image_id, "tiles/0/0_0.png") is not None
+    for name in ["../meta.json", "../../secret.json", "tiles/../meta.json", "tiles/0/../../meta.json",
+                 "/etc/passwd", "tiles/0/0_0.png/..", "", "tiles/0/5_5.png"]:
+        assert store.derived_path(image_id, name) is None
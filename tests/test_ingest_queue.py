@@ -0,0 +1,125 @@
+import importlib
+import sys
+import threading
+import types
+
+import pytest
+
+class FakeCollection:
+    """
+    Documents kept in a dict. Writes containing an ID of fail_ids are rejected whole, like a
+    failed batch; pause() makes the next write wait until resume().
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.documents = {}
+        self.writes = []
+        self.fail_ids = set()
+        self.entered = threading.Event()
+        self._gate = threading.Event()
+        self._gate.set()
+
+    def pause(self):
+        self._gate.clear()
+
+    def resume(self):
+        self._gate.set()
+
+    def write(self, documents: list, upsert: bool):
+        self.entered.set()
+        self._gate.wait(5)
+        ids = [doc_id for doc_id, _, _ in documents]
+        self.writes.append(ids)
+        if self.fail_ids & set(ids):
+            raise ValueError("rejected batch")
+        for doc_id, text, metadata in documents:
+            if upsert or doc_id not in self.documents:
+                self.documents[doc_id] = (text, metadata)
+
+    def get(self, ids=None, where=None, include=()):
+        if where is not None:
+            parent_ids = set(where["parent_id"]["$in"])
+            found = [doc_id for doc_id, (_, metadata) in self.documents.items()
+                     if metadata.get("parent_id") in parent_ids]
+        else:
+            found = [doc_id for doc_id in ids if doc_id in self.documents]
+        return {"ids": found, "metadatas": [self.documents[doc_id][1] for doc_id in found]}
+
+    def delete(self, ids):
+        for doc_id in ids:
+            self.documents.pop(doc_id, None)
+
+@pytest.fixture
+def ingest_queue(monkeypatch):
+    # ingest_queue is imported against in-memory knowledge_base and ingest modules (no ChromaDB, no model)
+    collections = {}
+    knowledge_base = types.ModuleType("knowledge_base")
+    knowledge_base.COLLECTION_NAME = "knowledge"
+    knowledge_base.get_or_create_collection = lambda name: collections.setdefault(name, FakeCollection(name))
+    knowledge_base.get_generation = lambda: sum(len(collection.writes) for collection in collections.values())
+    knowledge_base.delete_documents = lambda collection, ids: collection.delete(ids)
+    ingest = types.ModuleType("ingest")
+    ingest.ingest_documents = lambda collection, documents, upsert=False: collection.write(list(documents), upsert)
+    monkeypatch.setitem(sys.modules, "knowledge_base", knowledge_base)
+    monkeypatch.setitem(sys.modules, "ingest", ingest)
+    sys.modules.pop("ingest_queue", None)
+    module = importlib.import_module("ingest_queue")
+    module.collections = collections
+    yield module
+    sys.modules.pop("ingest_queue", None)
+
+def make_job(ingest_queue, *ids):
+    return ingest_queue.IngestJob([(doc_id, f"text {doc_id}") for doc_id in ids], "knowledge", False)
+
+def test_check_documents(ingest_queue):
+    assert ingest_queue._check_documents([("a", "A"), ("b", "B", {"source": "x"})]) is None
+    assert ingest_queue._check_documents([]) is None
+    for document in [("a",), ("", "A"), ("a", None), ("a", "A", "metadata"), "a", ("a", "A", {}, 1)]:
+        assert ingest_queue._check_documents([document]).startswith("Invalid document")
+    assert ingest_queue._check_documents([("a", "A"), ("a", "B")]) == "Duplicate document ID 'a' in the job"
+
+def test_split_shared_ids(ingest_queue):
+    jobs = [make_job(ingest_queue, "a", "b"), make_job(ingest_queue, "c"), make_job(ingest_queue, "a"),
+            make_job(ingest_queue, "d"), make_job(ingest_queue, "d", "e")]
+    runs = ingest_queue._split_shared_ids(jobs)
+    assert runs == [jobs[:2], jobs[2:4], jobs[4:]]
+    assert ingest_queue._split_shared_ids([]) == []
+
+def test_merged_jobs_are_retried_one_by_one(ingest_queue):
+    queue = ingest_queue.IngestQueue(chunk_tokens=0)
+    collection = ingest_queue.collections.setdefault("knowledge", FakeCollection("knowledge"))
+    collection.fail_ids = {"bad"}
+    jobs = [make_job(ingest_queue, "a"), make_job(ingest_queue, "bad", "b"), make_job(ingest_queue, "c")]
+    queue._ingest("knowledge", False, jobs)
+
+    assert collection.writes == [["a", "bad", "b", "c"], ["a"], ["bad", "b"], ["c"]]
+    assert [job.status for job in jobs] == ["done", "failed", "done"]
+    assert jobs[1].error == "ValueError: rejected batch"
+    assert sorted(collection.documents) == ["a", "c"]
+    assert queue.documents_ingested == 2
+
+def test_delete_is_applied_in_submission_order(ingest_queue):
+    queue = ingest_queue.IngestQueue(chunk_tokens=0)
+    collection = ingest_queue.get_or_create_collection("knowledge")
+    collection.pause()
+    first = queue.submit([("a", "A1"), ("doc#chunk0", "chunk", {"parent_id": "doc"})])
+    assert collection.entered.wait(5)
+    # Queued while the first job is being written: taken together by the worker
+    jobs = [
+        queue.submit([("b", "B")]),
+        queue.submit([("bad", "X")]),
+        queue.submit([("malformed",)]),
+        queue.submit_delete(["a", "doc", "b", "missing"]),
+        queue.submit([("a", "A2")]),
+    ]
+    collection.fail_ids = {"bad"}
+    collection.resume()
+    assert queue.wait_all(5)
+
+    assert [job.status for job in [first] + jobs] == ["done", "done", "failed", "failed", "done", "done"]
+    assert jobs[2].error.startswith("Invalid document")
+    # The additions queued before the deletion are written before it, the one after it is not deleted
+    assert collection.writes == [["a", "doc#chunk0"], ["b", "bad"], ["b"], ["bad"], ["a"]]
+    assert jobs[3].deleted == 3
+    assert collection.documents == {"a": ("A2", {})}
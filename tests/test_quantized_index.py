@@ -0,0 +1,127 @@
+import numpy as np
+
+import quantized_index
+from quantized_index import QuantizedCollection, QuantizedIndex
+
+DIMENSION = 16
+
+def random_vectors(count: int, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).normal(size=(count, DIMENSION)).astype(np.float32)
+
+def make_collection(directory) -> QuantizedCollection:
+    # Embeddings are always given explicitly, so the embedding function is never called
+    return QuantizedCollection("test", QuantizedIndex(str(directory)), embedding_function=None)
+
+def test_add_upsert_delete_and_where(tmp_path):
+    collection = make_collection(tmp_path)
+    vectors = random_vectors(4)
+    collection.add(ids=["a", "b", "c"], documents=["A", "B", "C"], embeddings=vectors[:3],
+                   metadatas=[{"tenant": "x"}, {"tenant": "y"}, {"tenant": "x", "year": 2024}])
+    assert collection.count() == 3
+
+    # add leaves existing IDs untouched, upsert replaces them
+    collection.add(ids=["a"], documents=["A2"], embeddings=vectors[3:], metadatas=[{"tenant": "z"}])
+    assert collection.get(ids=["a"])["documents"] == ["A"]
+    collection.upsert(ids=["a"], documents=["A3"], embeddings=vectors[3:], metadatas=[{"tenant": "z"}])
+    assert collection.get(ids=["a"])["documents"] == ["A3"]
+
+    assert sorted(collection.get(where={"tenant": "x"})["ids"]) == ["c"]
+    assert collection.get(where={"year": {"$gte": 2024}})["ids"] == ["c"]
+    hits = collection.query(query_embeddings=vectors[1:2], n_results=3, where={"tenant": {"$in": ["y", "z"]}})
+    assert hits["ids"][0][0] == "b"
+    assert sorted(hits["ids"][0]) == ["a", "b"]
+
+    collection.delete(ids=["b"])
+    assert collection.count() == 2
+    assert collection.get(ids=["b"])["ids"] == []
+    collection.delete(where={"tenant": "z"})
+    assert collection.get()["ids"] == ["c"]
+
+def test_compaction_of_index_without_segment(tmp_path, monkeypatch):
+    monkeypatch.setattr(quantized_index, "MIN_DOCS_BEFORE_COMPACTION", 5)
+    index = QuantizedIndex(str(tmp_path))
+    vectors = random_vectors(8)
+    ids = [f"doc{number}" for number in range(len(vectors))]
+    for doc_id, vector in zip(ids, vectors):
+        index.add([doc_id], [f"text {doc_id}"], [{"n": doc_id}], vector[None, :])
+    stats = index.stats()
+    assert stats["segment"] == 1
+    assert stats["segment_documents"] == 6
+    assert stats["pending_documents"] == 2
+
+    index.delete(["doc0"])
+    index.compact()
+    reloaded = QuantizedIndex(str(tmp_path))
+    assert reloaded.count == 7
+    assert reloaded.stats()["pending_documents"] == 0
+    assert reloaded.get_records(["doc3"]) == [("doc3", "text doc3", {"n": "doc3"})]
+    assert reloaded.get_records(["doc0"]) == []
+    assert reloaded.search(vectors[5], k=1)[0][0][0] == "doc5"
+
+def test_compact_command_on_empty_index(tmp_path):
+    index = QuantizedIndex(str(tmp_path))
+    index.compact()
+    assert QuantizedIndex(str(tmp_path)).count == 0
+
+def test_recall_against_brute_force(tmp_path):
+    vectors = random_vectors(2000)
+    ids = [f"doc{number}" for number in range(len(vectors))]
+    index = QuantizedIndex(str(tmp_path))
+    index.rebuild(ids, ids, [{}] * len(ids), vectors)
+    queries = random_vectors(50, seed=1)
+    k = 10
+    exact = np.argsort(((queries[:, None, :] - vectors[None, :, :]) ** 2).sum(axis=2), axis=1)[:, :k]
+    results = index.search(queries, k=k, nprobe=len(index._centroids))
+    found = sum(len({ids[row] for row in rows} & {doc_id for doc_id, _ in hits}) for rows, hits in zip(exact, results))
+    assert found / exact.size >= 0.95
+
+    # Probing a few lists still finds most neighbours
+    results = index.search(queries, k=k, nprobe=8)
+    found = sum(len({ids[row] for row in rows} & {doc_id for doc_id, _ in hits}) for rows, hits in zip(exact, results))
+    assert found / exact.size >= 0.5
+
+def test_parent_id_lookup(tmp_path):
+    vectors = random_vectors(40)
+    ids = [f"doc{number // 4}#chunk{number % 4}" for number in range(len(vectors))]
+    metadatas = [{"parent_id": f"doc{number // 4}", "tenant": "x" if number % 2 else "y"}
+                 for number in range(len(vectors))]
+    index = QuantizedIndex(str(tmp_path))
+    index.rebuild(ids, ids, metadatas, vectors)
+    collection = QuantizedCollection("test", index, embedding_function=None)
+    collection.delete(ids=["doc1#chunk0"])
+    collection.upsert(ids=["doc1#chunk9"], documents=["new"], embeddings=random_vectors(1, seed=2),
+                      metadatas=[{"parent_id": "doc1"}])
+
+    parsed = []
+    base_metadata = index._base_metadata
+    index._base_metadata = lambda position: parsed.append(position) or base_metadata(position)
+    found = collection.get(where={"parent_id": {"$in": ["doc1", "doc3", "missing"]}}, include=[])["ids"]
+    assert sorted(found) == ["doc1#chunk1", "doc1#chunk2", "doc1#chunk3", "doc1#chunk9",
+                             "doc3#chunk0", "doc3#chunk1", "doc3#chunk2", "doc3#chunk3"]
+    # Only the matching rows of the segment were read
+    assert len(parsed) == 7
+    assert sorted(collection.get(where={"$and": [{"parent_id": "doc3"}, {"tenant": "x"}]})["ids"]) == \
+        ["doc3#chunk1", "doc3#chunk3"]
+    assert collection.get(where={"parent_id": {"$in": []}})["ids"] == []
+
+def test_compaction_copies_segment_records(tmp_path):
+    vectors = random_vectors(30)
+    ids = [f"doc{number // 3}#chunk{number % 3}" for number in range(len(vectors))]
+    metadatas = [{"parent_id": f"doc{number // 3}", "titre": f"é{number}"} for number in range(len(vectors))]
+    index = QuantizedIndex(str(tmp_path))
+    index.rebuild(ids, [f"texte {doc_id} ü" for doc_id in ids], metadatas, vectors)
+    index.delete(["doc0#chunk0"])
+    index.add(["doc0#chunk5"], ["nouveau"], [{"parent_id": "doc0"}], random_vectors(1, seed=3))
+
+    # The segment records are copied as stored, not parsed
+    index._base_text = index._base_metadata = None
+    index.compact()
+    reloaded = QuantizedIndex(str(tmp_path))
+    assert reloaded.count == 30
+    assert reloaded.stats()["pending_documents"] == 0
+    assert reloaded.get_records(["doc4#chunk1", "doc0#chunk5"]) == [
+        ("doc4#chunk1", "texte doc4#chunk1 ü", {"parent_id": "doc4", "titre": "é13"}),
+        ("doc0#chunk5", "nouveau", {"parent_id": "doc0"})]
+    assert sorted(QuantizedCollection("test", reloaded, embedding_function=None)
+                  .get(where={"parent_id": "doc0"})["ids"]) == ["doc0#chunk1", "doc0#chunk2", "doc0#chunk5"]
+    assert reloaded.search(vectors[7], k=1)[0][0][0] == "doc2#chunk1"
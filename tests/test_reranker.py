@@ -0,0 +1,18 @@
+import pytest
+
+reranker = pytest.importorskip("reranker")
+
+def test_is_decisive_with_sorted_distances():
+    assert reranker.is_decisive([0.1, 0.2, 0.5, 0.6], top_n=2, margin=0.15)
+    assert not reranker.is_decisive([0.1, 0.2, 0.3, 0.6], top_n=2, margin=0.15)
+    assert reranker.is_decisive([0.1, 0.2], top_n=2, margin=0.15)
+
+def test_is_decisive_with_non_monotonic_distances():
+    # Ordered by rank fusion: the last candidate is closer than the second kept one
+    assert not reranker.is_decisive([0.1, 0.5, 0.9, 0.2], top_n=2, margin=0.15)
+    assert not reranker.is_decisive([0.5, 0.1, 0.6, 0.9], top_n=2, margin=0.15)
+    assert reranker.is_decisive([0.2, 0.1, 0.9, 0.7], top_n=2, margin=0.15)
+
+def test_is_decisive_with_missing_distances():
+    assert not reranker.is_decisive([0.1, 0.2, 0.9, None], top_n=2, margin=0.15)
+    assert not reranker.is_decisive([None, 0.2, 0.9], top_n=2, margin=0.15)
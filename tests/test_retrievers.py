@@ -0,0 +1,13 @@
+import pytest
+
+retrievers = pytest.importorskip("retrievers")
+
+def test_reciprocal_rank_fusion():
+    fused = retrievers.reciprocal_rank_fusion([["a", "b", "c"], ["c", "a", "d"]], k=60)
+    # a: 1/61 + 1/62, c: 1/63 + 1/61, b: 1/62, d: 1/63
+    assert fused == ["a", "c", "b", "d"]
+
+def test_reciprocal_rank_fusion_single_and_empty_rankings():
+    assert retrievers.reciprocal_rank_fusion([["x", "y"]]) == ["x", "y"]
+    assert retrievers.reciprocal_rank_fusion([[], ["y"]]) == ["y"]
+    assert retrievers.reciprocal_rank_fusion([]) == []
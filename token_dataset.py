@@ -0,0 +1,177 @@
+"""
+Pre-tokenized, packed training data for fine_tune_model.py.
+
+learning_data.txt only grows (CLI option 3 appends one line per entry), so its
+tokens are kept in a flat uint16 file next to a small JSON state recording how
+many bytes of the text were already tokenized. Each update tokenizes the new
+complete lines only, separates them with the EOS token and appends their IDs to
+the file.
+
+PackedTokenDataset maps that file (np.memmap) and cuts it into blocks of the
+model's full context length: no padding between short lines, and the corpus is
+never loaded in RAM, only the pages of the blocks being trained on.
+
+If the text file was rewritten instead of appended to (it shrank, or the bytes
+before the recorded offset changed), or the tokenizer changed, the token file is
+rebuilt from scratch.
+
+Usage:
+    python token_dataset.py learning_data.txt
+"""
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+TOKEN_CACHE_DIR = os.environ.get("RAG_TOKEN_CACHE_DIR", "token_cache")
+TOKEN_DTYPE = np.uint16
+# Lines tokenized per tokenizer call
+DEFAULT_BATCH_LINES = 1024
+# Bytes before the tokenized offset hashed to detect a rewritten text file
+_TAIL_BYTES = 4096
+
+def token_file_paths(source_path: str, directory: str = TOKEN_CACHE_DIR):
+    """Returns the (token file, state file) paths of a text file."""
+    name = os.path.basename(source_path)
+    return os.path.join(directory, f"{name}.tokens.bin"), os.path.join(directory, f"{name}.tokens.json")
+
+def _tail_hash(f, offset: int) -> str:
+    f.seek(max(0, offset - _TAIL_BYTES))
+    return hashlib.sha256(f.read(offset - max(0, offset - _TAIL_BYTES))).hexdigest()
+
+def _read_state(state_path: str):
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _write_state(state_path: str, state: dict):
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+def _tokenizer_id(tokenizer) -> str:
+    return f"{tokenizer.name_or_path}:{len(tokenizer)}"
+
+def _append_tokens(tokens_file, tokenizer, lines: list) -> int:
+    # Each line is followed by EOS; returns the number of tokens written
+    encoded = tokenizer(lines, add_special_tokens=False)["input_ids"]
+    ids = [token_id for line_ids in encoded for token_id in line_ids + [tokenizer.eos_token_id]]
+    np.asarray(ids, dtype=TOKEN_DTYPE).tofile(tokens_file)
+    return len(ids)
+
+def update_token_file(source_path: str, tokenizer, directory: str = TOKEN_CACHE_DIR,
+                      batch_lines: int = DEFAULT_BATCH_LINES) -> dict:
+    """
+    Appends the tokens of the lines added to source_path since the previous update, read
+    batch_lines at a time. Only complete lines (ending with a newline) are tokenized. Returns the state:
+    {"tokenizer", "source_bytes", "source_tail_sha256", "num_tokens"}.
+    """
+    if len(tokenizer) > np.iinfo(TOKEN_DTYPE).max + 1:
+        raise ValueError(f"Vocabulary of {len(tokenizer)} tokens does not fit in {np.dtype(TOKEN_DTYPE).name}.")
+    if tokenizer.eos_token_id is None:
+        raise ValueError("The tokenizer needs an EOS token to separate the lines.")
+    os.makedirs(directory, exist_ok=True)
+    tokens_path, state_path = token_file_paths(source_path, directory)
+    state = _read_state(state_path)
+
+    with open(source_path, "rb") as source:
+        source_size = os.fstat(source.fileno()).st_size
+        if (state is None or state["tokenizer"] != _tokenizer_id(tokenizer) or not os.path.exists(tokens_path)
+                or state["source_bytes"] > source_size
+                or _tail_hash(source, state["source_bytes"]) != state["source_tail_sha256"]):
+            if state is not None:
+                print(f"{source_path} was rewritten or the tokenizer changed: tokenizing it from the start.")
+            state = {"tokenizer": _tokenizer_id(tokenizer), "source_bytes": 0,
+                     "source_tail_sha256": _tail_hash(source, 0), "num_tokens": 0}
+            open(tokens_path, "wb").close()
+
+        source.seek(state["source_bytes"])
+        consumed = added = tokenized_lines = 0
+        with open(tokens_path, "r+b") as tokens_file:
+            # Drops tokens appended by an update interrupted before its state was written
+            tokens_file.truncate(state["num_tokens"] * np.dtype(TOKEN_DTYPE).itemsize)
+            tokens_file.seek(0, os.SEEK_END)
+            lines = []
+            for line in source:
+                if not line.endswith(b"\n"):
+                    break # An unfinished last line is left for the next update
+                consumed += len(line)
+                if line.strip():
+                    lines.append(line.decode("utf-8").rstrip("\r\n"))
+                if len(lines) == batch_lines:
+                    added += _append_tokens(tokens_file, tokenizer, lines)
+                    tokenized_lines += len(lines)
+                    lines = []
+            if lines:
+                added += _append_tokens(tokens_file, tokenizer, lines)
+                tokenized_lines += len(lines)
+        if not consumed:
+            return state
+
+        state["source_bytes"] += consumed
+        state["source_tail_sha256"] = _tail_hash(source, state["source_bytes"])
+        state["num_tokens"] += added
+    _write_state(state_path, state)
+    print(f"Tokenized {tokenized_lines} new line(s) of {source_path}: {added} tokens ({state['num_tokens']} in total).")
+    return state
+
+class PackedTokenDataset(Dataset):
+    """
+    Fixed-length blocks of a token file written by update_token_file(), read through a memory map.
+    The last block is shorter when the tokens do not fill it. Items have input_ids and labels.
+    """
+
+    def __init__(self, tokens_path: str, num_tokens: int, block_size: int):
+        self.tokens_path = tokens_path
+        self.num_tokens = num_tokens
+        self.block_size = block_size
+        self._tokens = None
+
+    def _map(self):
+        # Opened on first access, so the dataset can be sent to DataLoader worker processes
+        if self._tokens is None:
+            self._tokens = np.memmap(self.tokens_path, dtype=TOKEN_DTYPE, mode="r", shape=(self.num_tokens,))
+        return self._tokens
+
+    def __getstate__(self):
+        return {**self.__dict__, "_tokens": None}
+
+    def __len__(self) -> int:
+        return -(-self.num_tokens // self.block_size)
+
+    def __getitem__(self, index: int) -> dict:
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        start = index * self.block_size
+        input_ids = torch.from_numpy(self._map()[start:start + self.block_size].astype(np.int64))
+        # Explicit labels: EOS doubles as the pad token, and a collator deriving the labels from
+        # the input IDs would mask every end of line along with the padding
+        return {"input_ids": input_ids, "labels": input_ids.clone()}
+
+def load_packed_dataset(source_path: str, tokenizer, block_size: int,
+                        directory: str = TOKEN_CACHE_DIR) -> PackedTokenDataset:
+    """
+    Brings the token file of source_path up to date and returns its packed blocks.
+    """
+    state = update_token_file(source_path, tokenizer, directory)
+    tokens_path, _ = token_file_paths(source_path, directory)
+    return PackedTokenDataset(tokens_path, state["num_tokens"], block_size)
+
+def main():
+    parser = argparse.ArgumentParser(description="Tokenize the new lines of a training text file.")
+    parser.add_argument("source", nargs="?", default="learning_data.txt")
+    parser.add_argument("--tokenizer", default="TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+    parser.add_argument("--block-size", type=int, default=2048)
+    args = parser.parse_args()
+    from transformers import AutoTokenizer
+    dataset = load_packed_dataset(args.source, AutoTokenizer.from_pretrained(args.tokenizer), args.block_size)
+    print(f"{dataset.num_tokens} tokens, {len(dataset)} block(s) of up to {args.block_size} tokens.")
+
+if __name__ == "__main__":
+    main()